@@ -0,0 +1,224 @@
+import hashlib
+import json
+import time
+from pathlib import Path
+from typing import Dict, Any, Optional, List
+
+from loguru import logger
+
+from . import metrics
+from .config import ACCOUNT_PROBE_INTERVAL, ACCOUNT_PROBE_MAX_INTERVAL
+from .limiter import get_chat_lock
+
+ACCOUNT_HEALTH_PATH = Path('./config/account_health.json')
+
+HEALTHY = "healthy"
+# 按分片间隔特征疑似封号，尽快探测确认
+SUSPECTED = "suspected"
+BANNED = "banned"
+PROBING = "probing"
+
+
+def mask_rt(rt: str) -> str:
+    return f"{rt[:8]}..." if len(rt) > 8 else rt
+
+
+# rt 对应的健康表键，缓存避免每次路由都计算哈希
+_keys: Dict[str, str] = {}
+
+
+def health_key(rt: str) -> str:
+    """健康表按 rt 的哈希索引，持久化文件中不出现 rt 明文"""
+    key = _keys.get(rt)
+    if key is None:
+        key = _keys[rt] = hashlib.blake2b(rt.encode('utf-8'), digest_size=16).hexdigest()
+    return key
+
+
+class AccountHealth:
+    """单个账号的健康状态，时间均为 Unix 时间戳，便于持久化"""
+
+    def __init__(self, key: str):
+        self.key = key
+        self.state = HEALTHY
+        self.reason: Optional[str] = None
+        self.changed_at = time.time()
+        self.last_probe_at: Optional[float] = None
+        self.next_probe_at: Optional[float] = None
+        self.probe_interval = ACCOUNT_PROBE_INTERVAL
+        self.probes = 0
+        # 探测进行中时记录探测前的状态，探测无结论时恢复
+        self.previous_state = HEALTHY
+
+    def set_state(self, state: str, reason: Optional[str] = None):
+        if state != self.state:
+            self.changed_at = time.time()
+        self.state = state
+        self.reason = reason
+
+    @property
+    def blocked(self) -> bool:
+        """已确认封禁（或正在探测已封禁的账号），该账号的请求直接失败"""
+        return self.state == BANNED or (self.state == PROBING and self.previous_state == BANNED)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "key": self.key,
+            "state": self.state,
+            "reason": self.reason,
+            "changed_at": self.changed_at,
+            "last_probe_at": self.last_probe_at,
+            "next_probe_at": self.next_probe_at,
+            "probe_interval": self.probe_interval,
+            "probes": self.probes,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "AccountHealth":
+        # 旧版本的文件直接保存 rt，读取时转换为哈希，下次保存时不再写入明文
+        health = cls(data["key"] if "key" in data else health_key(data["rt"]))
+        health.state = data.get("state", HEALTHY)
+        health.reason = data.get("reason")
+        health.changed_at = data.get("changed_at", health.changed_at)
+        health.last_probe_at = data.get("last_probe_at")
+        health.next_probe_at = data.get("next_probe_at")
+        health.probe_interval = data.get("probe_interval", ACCOUNT_PROBE_INTERVAL)
+        health.probes = data.get("probes", 0)
+        if health.state == PROBING:
+            # 上次退出时探测未完成，按封禁处理并尽快重新探测
+            health.state = BANNED
+            health.next_probe_at = time.time()
+        return health
+
+
+# 账号健康表，格式：{health_key(rt): AccountHealth}，只记录出过问题的账号，不在表中视为健康
+account_health: Dict[str, AccountHealth] = {}
+
+
+def probing_enabled() -> bool:
+    return ACCOUNT_PROBE_INTERVAL > 0
+
+
+def load_account_health():
+    """
+    加载持久化的健康表；未开启探测时不加载也不保存，封禁只在本次运行内有效，
+    否则封禁的账号没有机会恢复，会一直被排除在账号池之外
+    """
+    account_health.clear()
+    if not probing_enabled() or not ACCOUNT_HEALTH_PATH.is_file():
+        return
+    with open(ACCOUNT_HEALTH_PATH, 'r', encoding='utf-8') as f:
+        for item in json.load(f):
+            health = AccountHealth.from_dict(item)
+            account_health[health.key] = health
+    banned = sum(1 for health in account_health.values() if health.state != HEALTHY)
+    if banned:
+        logger.info(f"加载账号健康表，异常账号 {banned} 个")
+
+
+def save_account_health():
+    if not probing_enabled():
+        return
+    ACCOUNT_HEALTH_PATH.parent.mkdir(parents=True, exist_ok=True)
+    with open(ACCOUNT_HEALTH_PATH, 'w', encoding='utf-8') as f:
+        json.dump([health.to_dict() for health in account_health.values()], f, ensure_ascii=False, indent=4)
+
+
+def _get_or_create(rt: str) -> AccountHealth:
+    key = health_key(rt)
+    health = account_health.get(key)
+    if health is None:
+        health = account_health[key] = AccountHealth(key)
+    return health
+
+
+def get_health(rt: str) -> Optional[AccountHealth]:
+    return account_health.get(health_key(rt))
+
+
+def is_live(rt: str) -> bool:
+    """账号是否可以参与路由（疑似封号、已封禁、探测中的账号都不参与）"""
+    health = get_health(rt)
+    return health is None or health.state == HEALTHY
+
+
+def is_blocked(rt: str) -> bool:
+    health = get_health(rt)
+    return health is not None and health.blocked
+
+
+def mark_banned(rt: str, reason: str = "ban content"):
+    get_chat_lock(rt).record_failure("ban")
+    health = _get_or_create(rt)
+    if health.state == PROBING:
+        # 探测请求自己命中封号文案，结果由 finish_probe 处理
+        health.reason = reason
+        return
+    if health.state == BANNED:
+        return
+    health.set_state(BANNED, reason)
+    health.probe_interval = ACCOUNT_PROBE_INTERVAL
+    health.next_probe_at = time.time() + health.probe_interval
+    metrics.inc("account.banned")
+    logger.warning(f"账号 {mask_rt(rt)} 标记为封禁（{reason}），{health.probe_interval:.0f}s 后探测")
+    save_account_health()
+
+
+def mark_suspected(rt: str, reason: str = "ban delay pattern"):
+    get_chat_lock(rt).record_failure("suspected ban")
+    if not probing_enabled():
+        # 疑似封号只能靠探测确认或排除，未开启探测时不标记，避免账号被永久排除
+        return
+    health = _get_or_create(rt)
+    if health.state != HEALTHY:
+        return
+    health.set_state(SUSPECTED, reason)
+    health.next_probe_at = time.time()
+    metrics.inc("account.suspected")
+    logger.warning(f"账号 {mask_rt(rt)} 疑似封号（{reason}），暂停路由并探测")
+    save_account_health()
+
+
+def due_probes(now: Optional[float] = None) -> List[AccountHealth]:
+    """到了探测时间的疑似/封禁账号"""
+    now = now or time.time()
+    return [
+        health for health in account_health.values()
+        if health.state in (SUSPECTED, BANNED) and health.next_probe_at is not None and health.next_probe_at <= now
+    ]
+
+
+def start_probe(rt: str):
+    health = _get_or_create(rt)
+    health.previous_state = health.state
+    health.state = PROBING
+    health.last_probe_at = time.time()
+    health.probes += 1
+
+
+def finish_probe(rt: str, alive: Optional[bool], reason: Optional[str] = None):
+    """
+    记录探测结果：alive 为 True 表示账号恢复，False 表示仍被封禁，None 表示探测本身失败（网络错误等）
+    仍被封禁或探测失败时探测间隔翻倍，最多 ACCOUNT_PROBE_MAX_INTERVAL 秒
+    """
+    health = _get_or_create(rt)
+    previous = health.previous_state
+    if alive:
+        health.set_state(HEALTHY)
+        health.probe_interval = ACCOUNT_PROBE_INTERVAL
+        health.next_probe_at = None
+        metrics.inc("account.recovered")
+        logger.info(f"账号 {mask_rt(rt)} 探测正常，恢复路由")
+    else:
+        if alive is False:
+            health.set_state(BANNED, reason or health.reason)
+            metrics.inc("account.probe_banned")
+        else:
+            health.set_state(previous, health.reason)
+            metrics.inc("account.probe_errors")
+        if previous == BANNED:
+            health.probe_interval = min(health.probe_interval * 2, ACCOUNT_PROBE_MAX_INTERVAL)
+        health.next_probe_at = time.time() + health.probe_interval
+        logger.info(f"账号 {mask_rt(rt)} 探测结果: {health.state}（{reason}），{health.probe_interval:.0f}s 后再次探测")
+    health.previous_state = health.state
+    save_account_health()
@@ -0,0 +1,180 @@
+import asyncio
+import json
+from dataclasses import replace
+from pathlib import Path
+from typing import List, Optional, Dict, Any, Tuple
+
+from loguru import logger
+
+from identifier import Th, get_identifier
+from .account_health import is_live, due_probes, start_probe, finish_probe, mask_rt, account_health, health_key, \
+    HEALTHY
+from .auth import Account, build_account, parse_api_key, resolve_account, account_cache, get_access_token
+from .chat_service import non_stream_completion
+from .config import ACCOUNT_PROBE_INTERVAL, ACCOUNT_PROBE_MODEL
+from .errors import HighlightError
+from .limiter import chat_lock
+from .model_service import get_models
+from .proxy_service import resolve_proxy, get_account_proxy
+
+ACCOUNTS_PATH = Path('./config/accounts.json')
+
+# 已知账号列表
+known_accounts: List[Account] = []
+
+
+async def load_accounts() -> List[Account]:
+    """
+    从 ./config/accounts.json 加载账号，并发派生各账号的 identifier 密钥
+    文件内容为列表，元素可以是 API Key 字符串，也可以是解析后的用户信息对象
+    """
+    if not ACCOUNTS_PATH.is_file():
+        return []
+    with open(ACCOUNTS_PATH, 'r', encoding='utf-8') as f:
+        items = json.load(f)
+
+    async def load_item(item) -> Optional[Account]:
+        if isinstance(item, str):
+            return await resolve_account(item)
+        account = build_account(item)
+        if account is None:
+            return None
+        return replace(account, identifier_key=await asyncio.to_thread(Th, account.user_id))
+
+    accounts = []
+    for item, account in zip(items, await asyncio.gather(*(load_item(item) for item in items))):
+        if account is None:
+            logger.warning(f"忽略无效账号配置: {str(item)[:32]}")
+            continue
+        accounts.append(account)
+
+    known_accounts.clear()
+    known_accounts.extend(accounts)
+    return known_accounts
+
+
+def save_accounts(accounts: List[Tuple[str, Account]]):
+    """
+    新登录的账号写入 ./config/accounts.json 并加入已知账号，同一用户已有的配置被替换
+    accounts 为 [(API Key, 已派生 identifier 密钥的账号)]
+    """
+    items = []
+    if ACCOUNTS_PATH.is_file():
+        with open(ACCOUNTS_PATH, 'r', encoding='utf-8') as f:
+            items = json.load(f)
+    user_ids = {account.user_id for _, account in accounts}
+
+    def item_user_id(item) -> Optional[str]:
+        user_info = parse_api_key(item) if isinstance(item, str) else item
+        return user_info.get("user_id") if isinstance(user_info, dict) else None
+
+    items = [item for item in items if item_user_id(item) not in user_ids] + [api_key for api_key, _ in accounts]
+    ACCOUNTS_PATH.parent.mkdir(parents=True, exist_ok=True)
+    with open(ACCOUNTS_PATH, 'w', encoding='utf-8') as f:
+        json.dump(items, f, ensure_ascii=False, indent=4)
+
+    known_accounts[:] = [a for a in known_accounts if a.user_id not in user_ids] + [a for _, a in accounts]
+    logger.info(f"写入 {len(accounts)} 个账号，当前已知账号 {len(known_accounts)} 个")
+
+
+def get_account_pool(account: Account) -> List[Account]:
+    """
+    调用方账号在已知账号中时返回所有健康的已知账号（调用方账号排在首位），
+    否则只能使用调用方自己的账号
+    """
+    if not any(a.rt == account.rt for a in known_accounts):
+        return [account]
+    others = [a for a in known_accounts if a.rt != account.rt and is_live(a.rt)]
+    return [account] + others
+
+
+def find_account_by_key(key: str) -> Optional[Account]:
+    """在已知账号和 API Key 缓存中按健康表键查找账号（健康表不保存 rt 明文）"""
+    for account in known_accounts + list(account_cache.values()):
+        if health_key(account.rt) == key:
+            return account
+    return None
+
+
+async def probe_account(account: Account) -> Optional[bool]:
+    """
+    发送一次最小的聊天请求探测账号是否可用
+    返回 True 表示正常，False 表示仍被封禁，None 表示探测本身失败
+    """
+    try:
+        proxy = resolve_proxy(get_account_proxy(account))
+        # 强制刷新 token，跳过封禁检查
+        access_token = await get_access_token(account.rt, True, proxy)
+        models = await get_models(access_token, proxy)
+        model = models.get(ACCOUNT_PROBE_MODEL) or next(
+            (m for m in models.values() if m.get("isFree")), next(iter(models.values()), None))
+        if model is None:
+            return None
+        identifier = get_identifier(account.user_id, account.client_uuid, key=account.identifier_key)
+        highlight_data = {
+            "prompt": "hi",
+            "attachedContext": [],
+            "modelId": model["id"],
+            "additionalTools": [],
+            "backendPlugins": [],
+            "useMemory": False,
+            "useKnowledge": False,
+            "ephemeral": True,
+            "timezone": "Asia/Hong_Kong",
+            "generationConfig": {"maxOutputTokens": 16},
+        }
+        await non_stream_completion(highlight_data, access_token, identifier, model["name"], account.rt, proxy)
+        return True
+    except HighlightError as e:
+        # 命中封号文案时为 200 + 403，其余上游错误无法判断账号状态
+        if e.status_code == 200 and e.response_status_code == 403:
+            return False
+        return None
+    except Exception as e:
+        logger.warning(f"账号 {account.email or account.user_id} 探测失败: {e}")
+        return None
+
+
+async def run_probe(key: str):
+    account = find_account_by_key(key)
+    if account is None:
+        # 账号信息未加载（API Key 尚未再次出现），等下一轮
+        return
+    rt = account.rt
+    start_probe(rt)
+    alive = None
+    try:
+        alive = await probe_account(account)
+    finally:
+        finish_probe(rt, alive, None if alive is not False else "probe hit ban content")
+
+
+async def probe_accounts_forever(interval: float = 10):
+    """后台定时检查到期的疑似/封禁账号并发送探测请求"""
+    if ACCOUNT_PROBE_INTERVAL <= 0:
+        return
+    while True:
+        due = [health.key for health in due_probes()]
+        if due:
+            logger.debug(f"探测账号: {len(due)} 个")
+            await asyncio.gather(*(run_probe(key) for key in due), return_exceptions=True)
+        await asyncio.sleep(interval)
+
+
+def list_account_health() -> List[Dict[str, Any]]:
+    """已知账号及健康表中所有账号的状态，不在健康表中的账号视为健康"""
+    keys = [health_key(account.rt) for account in known_accounts]
+    keys += [key for key in account_health if key not in keys]
+    result = []
+    for key in keys:
+        account = find_account_by_key(key)
+        health = account_health.get(key)
+        entry = health.to_dict() if health else {"key": key, "state": HEALTHY}
+        entry["rt"] = mask_rt(account.rt) if account else None
+        entry["user_id"] = account.user_id if account else None
+        entry["email"] = account.email if account else None
+        entry["known"] = key in keys[:len(known_accounts)]
+        if account and account.rt in chat_lock:
+            entry.update(chat_lock[account.rt].to_dict())
+        result.append(entry)
+    return result
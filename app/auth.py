@@ -1,44 +1,117 @@
+import asyncio
 import base64
 import json
+import secrets
 import time
 import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field, replace
 from typing import Dict, Any, Optional
 
-from curl_cffi import AsyncSession
 from curl_cffi.requests.exceptions import RequestException
 from fastapi import HTTPException
 from fastapi.security import HTTPAuthorizationCredentials
 from loguru import logger
 
-from .config import HIGHLIGHT_BASE_URL, USER_AGENT, TLS_VERIFY
+from identifier import Th
+from .account_health import is_blocked, mark_banned
+from .config import HIGHLIGHT_BASE_URL, USER_AGENT, ADMIN_KEY, API_KEY_CACHE_SIZE
+from .deadline import stage_timeout, deadline_exceeded
 from .errors import HighlightError
+from .http_client import get_session
+from .proxy_service import record_proxy_success, record_proxy_failure
 
-# 存储格式：{rt: {"access_token": str, "expires_at": int,"is_ban":bool}}
+# 存储格式：{rt: {"access_token": str, "expires_at": int}}，封禁状态见 account_health
 access_tokens: Dict[str, Dict[str, Any]] = {}
 
 
+@dataclass(frozen=True, slots=True)
+class Account:
+    """API Key 解析并校验后的账号信息"""
+    rt: str
+    user_id: str
+    client_uuid: str
+    email: Optional[str] = None
+    proxy: Optional[str] = None
+    # 该 API Key 请求的默认排队优先级（interactive / batch）
+    priority: Optional[str] = None
+    # 该 API Key 请求的默认超时（秒），请求头未指定时使用
+    timeout: Optional[float] = None
+    # 预先派生的 identifier AES 密钥（PBKDF2 十万轮）
+    identifier_key: bytes = field(default=b'', repr=False)
+
+
+# API Key 解析缓存（LRU），格式：{api_key: Account}
+account_cache: "OrderedDict[str, Account]" = OrderedDict()
+
+
 def parse_api_key(api_key_base64: str) -> Optional[Dict[str, Any]]:
-    """解析base64编码的JSON API Key"""
+    """解析base64编码的JSON API Key，同时兼容标准和 urlsafe 编码"""
     try:
-        decoded_bytes = base64.b64decode(api_key_base64)
+        data = api_key_base64.replace('-', '+').replace('_', '/')
+        data += '=' * (-len(data) % 4)
+        decoded_bytes = base64.b64decode(data)
         data = json.loads(decoded_bytes)
+        if not isinstance(data, dict):
+            return None
         return data
     except Exception:
         return None
 
 
-async def get_user_info_from_token(credentials: HTTPAuthorizationCredentials) -> Dict[str, Any]:
-    """从认证令牌中获取用户信息"""
-    token = credentials.credentials
+def build_account(user_info: Optional[Dict[str, Any]], identifier_key: bytes = b'') -> Optional[Account]:
+    """校验用户信息字段，缺少必要字段时返回 None"""
+    if not user_info:
+        return None
+    if not all(isinstance(user_info.get(name), str) and user_info[name] for name in ("rt", "user_id", "client_uuid")):
+        return None
+    return Account(
+        rt=user_info["rt"],
+        user_id=user_info["user_id"],
+        client_uuid=user_info["client_uuid"],
+        email=user_info.get("email"),
+        proxy=user_info.get("proxy") or None,
+        priority=user_info.get("priority") or None,
+        timeout=float(user_info["timeout"]) if isinstance(user_info.get("timeout"), (int, float)) else None,
+        identifier_key=identifier_key,
+    )
+
+
+async def resolve_account(api_key: str) -> Optional[Account]:
+    """解析 API Key（带缓存），首次解析时在线程池中派生 identifier 密钥"""
+    account = account_cache.get(api_key)
+    if account is not None:
+        account_cache.move_to_end(api_key)
+        return account
+
+    account = build_account(parse_api_key(api_key))
+    if account is None:
+        return None
+    account = replace(account, identifier_key=await asyncio.to_thread(Th, account.user_id))
+
+    account_cache[api_key] = account
+    if len(account_cache) > API_KEY_CACHE_SIZE:
+        account_cache.popitem(last=False)
+    return account
+
 
-    # 尝试解析为base64编码的JSON
-    user_info = parse_api_key(token)
-    if user_info:
-        return user_info
+async def get_user_info_from_token(credentials: HTTPAuthorizationCredentials) -> Account:
+    """从认证令牌中获取账号信息"""
+    account = await resolve_account(credentials.credentials)
+    if account:
+        return account
 
     raise HTTPException(status_code=401, detail="Invalid authorization token format")
 
 
+async def verify_admin_key(credentials: HTTPAuthorizationCredentials):
+    """校验管理接口密钥"""
+    if not ADMIN_KEY:
+        raise HTTPException(status_code=403, detail="Admin API is disabled, set ADMIN_KEY to enable it")
+    if not secrets.compare_digest(credentials.credentials, ADMIN_KEY):
+        raise HTTPException(status_code=401, detail="Invalid admin key")
+
+
 async def refresh_access_token(rt: str, proxy: str | None = None) -> str:
     """使用refresh token获取新的access token"""
     logger.debug(f"{rt} 刷新")
@@ -46,64 +119,69 @@ async def refresh_access_token(rt: str, proxy: str | None = None) -> str:
     headers = {"Content-Type": "application/json", "User-Agent": USER_AGENT, "Idempotency-Key": str(uuid.uuid4())}
     json_data = {"refreshToken": rt}
 
-    async with AsyncSession(verify=TLS_VERIFY, timeout=30.0, impersonate='chrome') as client:
-        try:
-            response = await client.post(url, headers=headers, json=json_data, proxy=proxy)
+    client = get_session(proxy)
+    start = time.monotonic()
+    try:
+        response = await client.post(url, headers=headers, json=json_data, timeout=stage_timeout(30.0))
+        record_proxy_success(proxy, time.monotonic() - start)
 
-            if response.status_code != 200:
-                raise HTTPException(
-                    status_code=500,
-                    detail=f"Failed to refresh access token, response: {response.status_code} {response.text}"
-                )
+        if response.status_code != 200:
+            raise HTTPException(
+                status_code=500,
+                detail=f"Failed to refresh access token, response: {response.status_code} {response.text}"
+            )
 
-            resp_json = response.json()
-            if not resp_json.get("success"):
-                raise HTTPException(
-                    status_code=500,
-                    detail=f"Failed to refresh access token, response: {response.status_code} {response.text}"
-                )
+        resp_json = response.json()
+        if not resp_json.get("success"):
+            raise HTTPException(
+                status_code=500,
+                detail=f"Failed to refresh access token, response: {response.status_code} {response.text}"
+            )
 
-            access_token = resp_json["data"]["accessToken"]
-            expires_in = resp_json["data"].get("expiresIn", 3600)  # 默认1小时
-            expires_at = int(time.time()) + expires_in - 60  # 提前1分钟过期
+        access_token = resp_json["data"]["accessToken"]
+        expires_in = resp_json["data"].get("expiresIn", 3600)  # 默认1小时
+        expires_at = int(time.time()) + expires_in - 60  # 提前1分钟过期
 
-            # 更新缓存
-            access_tokens[rt] = {"access_token": access_token, "expires_at": expires_at, "is_ban": False}
+        # 更新缓存
+        access_tokens[rt] = {"access_token": access_token, "expires_at": expires_at}
 
-            return access_token
+        return access_token
 
-        except RequestException as e:
-            raise HTTPException(
-                status_code=500, detail=f"HTTP error during token refresh: {str(e)}"
-            )
+    except RequestException as e:
+        if deadline_exceeded():
+            # 客户端给的时间用完了，不算代理故障
+            raise HighlightError(504, 'Request deadline exceeded', 504)
+        record_proxy_failure(proxy)
+        raise HTTPException(
+            status_code=500, detail=f"HTTP error during token refresh: {str(e)}"
+        )
 
 
 async def get_access_token(rt: str, refresh=False, proxy: str = None) -> str:
-    """获取access token（带缓存）"""
+    """获取access token（带缓存），已封禁的账号直接失败，强制刷新时不检查（供健康探测使用）"""
     if refresh:
         return await refresh_access_token(rt, proxy)
+    if is_ban_rt(rt):
+        raise HighlightError(200, 'HighlightAI account suspended', 403)
 
     current_time = int(time.time())
 
     # 检查缓存
     if rt in access_tokens:
         token_info = access_tokens[rt]
-        is_ban = token_info.get("is_ban", False)
-        if is_ban:
-            raise HighlightError(200, 'HighlightAI account suspended', 403)
         if current_time < token_info["expires_at"]:
             return token_info["access_token"]
 
     # 缓存过期或不存在，刷新token
-    return await refresh_access_token(rt)
+    return await refresh_access_token(rt, proxy)
 
 
 def set_ban_rt(rt: str):
-    access_tokens[rt]['is_ban'] = True
+    mark_banned(rt)
 
 
 def is_ban_rt(rt: str):
-    return access_tokens[rt]['is_ban']
+    return is_blocked(rt)
 
 
 def get_highlight_headers(access_token: str, identifier: str) -> Dict[str, str]:
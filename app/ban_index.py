@@ -0,0 +1,154 @@
+import hashlib
+import re
+from typing import Dict, List, Set, Tuple, Optional
+
+# 字符 shingle 长度，流式分片常在单词中间截断，按字符切分比按单词稳定
+SHINGLE_SIZE = 5
+# MinHash 签名长度，分成 BANDS 段做 LSH，同一段完全相同的文案才进一步比较
+NUM_PERM = 64
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+# 回复积累到该数量的 shingle 仍不像任何封号文案时，后续分片不再匹配
+MIN_DECISIVE_SHINGLES = 40
+
+_MERSENNE_PRIME = (1 << 61) - 1
+
+
+def _stable_hash(data: str, seed: int = 0) -> int:
+    """跨进程稳定的 64 位哈希（内置 hash 受 PYTHONHASHSEED 影响，每次启动都不同）"""
+    digest = hashlib.blake2b(data.encode('utf-8'), digest_size=8, salt=seed.to_bytes(8, 'little')).digest()
+    return int.from_bytes(digest, 'little')
+
+
+# 每个排列 (a, b) 由排列序号派生，签名在不同进程、不同机器上保持一致
+_PERMUTATIONS = [(_stable_hash('a', i) % (_MERSENNE_PRIME - 1) + 1, _stable_hash('b', i) % _MERSENNE_PRIME)
+                 for i in range(NUM_PERM)]
+
+_WHITESPACE = re.compile(r'\s+')
+_QUOTES = str.maketrans({'’': "'", '‘': "'", '“': '"', '”': '"'})
+
+
+def normalize_text(text: str) -> str:
+    """统一大小写、弯引号和空白，同一文案的不同写法得到相同的 shingle"""
+    return _WHITESPACE.sub(' ', text.translate(_QUOTES).lower())
+
+
+def shingles(text: str) -> Set[str]:
+    text = normalize_text(text).strip()
+    return {text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+
+
+def minhash(shingle_set: Set[str]) -> Tuple[int, ...]:
+    hashes = [_stable_hash(s) for s in shingle_set]
+    return tuple(min((a * h + b) % _MERSENNE_PRIME for h in hashes) for a, b in _PERMUTATIONS)
+
+
+def estimate_jaccard(sig1: Tuple[int, ...], sig2: Tuple[int, ...]) -> float:
+    return sum(1 for x, y in zip(sig1, sig2) if x == y) / NUM_PERM
+
+
+class BanTextIndex:
+    """
+    封号文案相似度索引
+    匹配：shingle 倒排表，回复每增加一段只查新增的 shingle，耗时与文案总数基本无关；
+    去重：MinHash + LSH 分段，新增文案与已有文案估算的 Jaccard 相似度达到阈值时不再保存
+    """
+
+    def __init__(self, dedupe_threshold: float = 0.8):
+        self.dedupe_threshold = dedupe_threshold
+        self.texts: List[str] = []
+        self.sizes: List[int] = []
+        self.signatures: List[Tuple[int, ...]] = []
+        # 倒排表，格式：{shingle: [文案下标]}
+        self.postings: Dict[str, List[int]] = {}
+        # LSH 分桶，格式：{(段号, 段内签名): [文案下标]}
+        self.buckets: Dict[Tuple[int, Tuple[int, ...]], List[int]] = {}
+        # 各文案开头不足一个 shingle 的前缀，回复刚开始时用来判断是否需要等待
+        self.short_prefixes: Set[str] = {''}
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def find_duplicate(self, text: str) -> Optional[str]:
+        """返回与 text 近似重复的已有文案，没有时返回 None"""
+        shingle_set = shingles(text)
+        if not shingle_set:
+            return text if text in self.texts else None
+        return self._find_duplicate(minhash(shingle_set))
+
+    def _find_duplicate(self, signature: Tuple[int, ...]) -> Optional[str]:
+        candidates = set()
+        for band in range(BANDS):
+            candidates.update(self.buckets.get((band, signature[band * ROWS:(band + 1) * ROWS]), ()))
+        for doc_id in candidates:
+            if estimate_jaccard(signature, self.signatures[doc_id]) >= self.dedupe_threshold:
+                return self.texts[doc_id]
+        return None
+
+    def add(self, text: str) -> bool:
+        """加入文案，与已有文案近似重复时忽略并返回 False"""
+        shingle_set = shingles(text)
+        if not shingle_set:
+            return False
+        signature = minhash(shingle_set)
+        if self._find_duplicate(signature) is not None:
+            return False
+
+        doc_id = len(self.texts)
+        self.texts.append(text)
+        self.sizes.append(len(shingle_set))
+        self.signatures.append(signature)
+        for shingle in shingle_set:
+            self.postings.setdefault(shingle, []).append(doc_id)
+        for band in range(BANDS):
+            self.buckets.setdefault((band, signature[band * ROWS:(band + 1) * ROWS]), []).append(doc_id)
+        normalized = normalize_text(text).strip()
+        for i in range(1, SHINGLE_SIZE):
+            self.short_prefixes.add(normalized[:i])
+        return True
+
+    def matcher(self) -> "BanTextMatcher":
+        return BanTextMatcher(self)
+
+
+class BanTextMatcher:
+    """
+    单个回复的增量匹配状态
+    containment：回复的 shingle 落在某条文案中的比例，衡量回复像不像封号文案；
+    coverage：该文案的 shingle 被回复覆盖的比例，衡量已经收到了文案的多少
+    """
+    __slots__ = ('index', 'text', 'seen', 'hits')
+
+    def __init__(self, index: BanTextIndex):
+        self.index = index
+        self.text = ''
+        self.seen: Set[str] = set()
+        # 格式：{文案下标: 命中的 shingle 数}
+        self.hits: Dict[int, int] = {}
+
+    def feed(self, content: str):
+        content = normalize_text(content)
+        if not self.text:
+            content = content.lstrip()
+        elif self.text.endswith(' ') and content.startswith(' '):
+            content = content[1:]
+        start = max(len(self.text) - SHINGLE_SIZE + 1, 0)
+        self.text += content
+        for i in range(start, len(self.text) - SHINGLE_SIZE + 1):
+            shingle = self.text[i:i + SHINGLE_SIZE]
+            if shingle in self.seen:
+                continue
+            self.seen.add(shingle)
+            for doc_id in self.index.postings.get(shingle, ()):
+                self.hits[doc_id] = self.hits.get(doc_id, 0) + 1
+
+    @property
+    def shingle_count(self) -> int:
+        return len(self.seen)
+
+    def best(self) -> Tuple[float, float]:
+        """返回最相似文案的 (containment, coverage)"""
+        if not self.hits or not self.seen:
+            return 0.0, 0.0
+        doc_id, hits = max(self.hits.items(), key=lambda item: (item[1], -self.index.sizes[item[0]]))
+        return hits / len(self.seen), hits / self.index.sizes[doc_id]
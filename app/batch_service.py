@@ -0,0 +1,158 @@
+import asyncio
+import json
+from typing import Dict, Any, List, Union, Optional, AsyncGenerator, Tuple
+
+from curl_cffi.requests.exceptions import RequestException
+from fastapi import HTTPException
+from loguru import logger
+
+from identifier import get_identifier
+from . import metrics
+from .account_health import is_live
+from .auth import Account, get_access_token
+from .chat_service import non_stream_completion
+from .completion_service import build_highlight_data, record_outcome
+from .config import MAX_RETRIES
+from .errors import HighlightError
+from .file_service import upload_images
+from .limiter import get_chat_lock
+from .model_service import fetch_model_candidates, get_model_stats
+from .proxy_service import resolve_proxy, get_account_proxy
+from .request_parser import ParsedChatRequest
+from .retry_policy import classify_error, should_retry, retry_budget, FATAL, FAILOVER
+from .usage_service import get_account_total_tokens
+
+
+def _error_body(e: Exception) -> Tuple[int, Dict[str, Any]]:
+    """异常转换为 (状态码, OpenAI 格式错误)"""
+    if isinstance(e, HighlightError):
+        return e.response_status_code, e.to_openai_error()
+    if isinstance(e, HTTPException):
+        return e.status_code, {"error": {"message": str(e.detail), "type": "invalid_request_error",
+                                         "code": "invalid_request_error"}}
+    return 500, {"error": {"message": str(e), "type": "http_error", "code": "http_error"}}
+
+
+class BatchRunner:
+    """
+    批量请求调度：在账号池内分摊请求
+    每个账号在本批次内只获取一次 token 和 identifier，并按账号已分配但未完成的请求数选择负载最低的账号
+    """
+
+    def __init__(self, accounts: List[Account]):
+        self.accounts = accounts
+        # 本批次内各账号已分配但未完成的请求数
+        self.pending: Dict[str, int] = {account.rt: 0 for account in accounts}
+        self.prepared: Dict[str, asyncio.Task] = {}
+
+    def pick_account(self, exclude: set) -> Optional[Account]:
+        candidates = [a for a in self.accounts if a.rt not in exclude and is_live(a.rt)]
+        if not candidates:
+            return None
+        # 先看排队深度，再看历史用量，让消耗少的账号多承担一些
+        return min(candidates, key=lambda a: (self.pending[a.rt] // get_chat_lock(a.rt).capacity,
+                                              get_account_total_tokens(a.user_id)))
+
+    async def _prepare_account(self, account: Account) -> Tuple[Optional[str], str, str]:
+        proxy = resolve_proxy(get_account_proxy(account))
+        access_token = await get_access_token(account.rt, False, proxy)
+        # 密钥已预先派生，这里只剩一次 AES 加密
+        identifier = get_identifier(account.user_id, account.client_uuid, key=account.identifier_key)
+        return proxy, access_token, identifier
+
+    async def prepare_account(self, account: Account) -> Tuple[Optional[str], str, str]:
+        task = self.prepared.get(account.rt)
+        if task is None or (task.done() and task.exception() is not None):
+            task = self.prepared[account.rt] = asyncio.ensure_future(self._prepare_account(account))
+        return await asyncio.shield(task)
+
+    async def run_on_account(self, request: ParsedChatRequest, account: Account) -> Dict[str, Any]:
+        lock = get_chat_lock(account.rt)
+        async with lock:
+            proxy, access_token, identifier = await self.prepare_account(account)
+            candidates, images = await asyncio.gather(
+                fetch_model_candidates(request.model, access_token, proxy),
+                upload_images(request.image_urls, access_token, proxy),
+            )
+            # 批量请求失败时由 run_item 换账号重试，这里只用排在最前的候选模型
+            model, model_id = candidates[0]
+            highlight_data = build_highlight_data(request, model_id, images)
+            try:
+                result = await non_stream_completion(highlight_data, access_token, identifier, model,
+                                                     account.rt, proxy, account.user_id)
+            except HighlightError as e:
+                record_outcome(lock, e.response_status_code)
+                if e.response_status_code >= 500:
+                    get_model_stats(model).record_failure()
+                raise
+            except RequestException:
+                lock.record_failure("network")
+                get_model_stats(model).record_failure()
+                raise
+            lock.record_success()
+            get_model_stats(model).record_success()
+            return result
+
+    async def run_item(self, index: int, request: Union[ParsedChatRequest, HTTPException]) -> Dict[str, Any]:
+        """
+        执行单个请求，按重试策略重试：封禁/限流及账号的 token、模型列表获取失败立即换账号，
+        可重试的错误（上游 5xx、网络错误等）退避后在同一账号上重试，其余错误不重试
+        """
+        if isinstance(request, HTTPException):
+            status, error = _error_body(request)
+            return {"index": index, "status": status, "error": error}
+
+        retry_budget.deposit()
+        tried = set()
+        account: Optional[Account] = None
+        last_error: Exception = HighlightError(200, 'No available account', 503)
+        for attempt in range(MAX_RETRIES + 1):
+            if account is None or not is_live(account.rt):
+                account = self.pick_account(tried)
+                if account is None:
+                    break
+            self.pending[account.rt] += 1
+            try:
+                response = await self.run_on_account(request, account)
+                metrics.inc("batch.items_ok")
+                return {"index": index, "status": 200, "response": response}
+            except (HTTPException, HighlightError, RequestException) as e:
+                # 请求校验失败（4xx HTTPException）不重试，token 刷新、模型列表等账号故障（5xx）换账号
+                last_error = e
+            finally:
+                self.pending[account.rt] -= 1
+
+            error_class = classify_error(last_error)
+            if error_class == FATAL:
+                break
+            if error_class == FAILOVER:
+                # 只有换账号的错误才排除该账号，没有其他账号时直接结束，不消耗重试预算
+                tried.add(account.rt)
+                logger.warning(f"批量请求 #{index} 在账号 {account.user_id} 上失败，尝试其他账号: {last_error}")
+                account = None
+                continue
+            delay = should_retry(last_error, attempt)
+            if delay is None:
+                break
+            metrics.inc("retry.attempts")
+            logger.warning(f"批量请求 #{index} 在账号 {account.user_id} 上失败，{delay:.2f}s 后重试: {last_error}")
+            await asyncio.sleep(delay)
+
+        metrics.inc("batch.items_failed")
+        status, error = _error_body(last_error)
+        return {"index": index, "status": status, "error": error}
+
+    async def run(self, requests: List[Union[ParsedChatRequest, HTTPException]]) -> AsyncGenerator[str, None]:
+        """并发执行全部请求，按完成顺序逐行输出 NDJSON"""
+        metrics.inc("batch.requests")
+        metrics.observe("batch.size", len(requests))
+        tasks = [asyncio.ensure_future(self.run_item(i, request)) for i, request in enumerate(requests)]
+        try:
+            for future in asyncio.as_completed(tasks):
+                yield json.dumps(await future, ensure_ascii=False) + "\n"
+        finally:
+            # 客户端断开时取消剩余请求
+            for task in tasks:
+                task.cancel()
+            for task in self.prepared.values():
+                task.cancel()
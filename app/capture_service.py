@@ -0,0 +1,239 @@
+"""
+上游 SSE 流的录制与回放，用于离线复现性能问题和做基准测试
+
+录制文件为 gzip 压缩的二进制格式：
+    b"HLCAP1" | uint32 元数据长度 | 元数据 JSON | 若干条记录
+每条记录为 uint32 距上一行的间隔（微秒）| uint32 行长度 | 原始行字节（不含换行符）
+"""
+import argparse
+import asyncio
+import contextvars
+import gzip
+import json
+import shutil
+import struct
+import tempfile
+import time
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Any, List, Tuple, Optional, Set, AsyncGenerator
+
+from loguru import logger
+
+from . import metrics
+from .config import CAPTURE_DIR
+
+MAGIC = b"HLCAP1"
+_HEADER = struct.Struct("<I")
+_RECORD = struct.Struct("<II")
+
+# 当前上下文使用的回放数据，设置后 open_chat_stream 不再请求上游
+# 格式：(录制内容, 回放倍速)
+_replay: contextvars.ContextVar[Optional[Tuple["Capture", float]]] = contextvars.ContextVar("capture_replay",
+                                                                                         default=None)
+
+# 持有写文件任务的引用，避免被垃圾回收
+_pending_writes: Set[asyncio.Task] = set()
+
+
+@dataclass(slots=True)
+class Capture:
+    meta: Dict[str, Any]
+    # [(距上一行的间隔秒数, 行字节)]
+    records: List[Tuple[float, bytes]] = field(default_factory=list)
+
+
+def dump_capture(capture: Capture) -> bytes:
+    meta = json.dumps(capture.meta, ensure_ascii=False).encode("utf-8")
+    parts = [MAGIC, _HEADER.pack(len(meta)), meta]
+    for delay, line in capture.records:
+        parts.append(_RECORD.pack(min(int(delay * 1_000_000), 0xFFFFFFFF), len(line)))
+        parts.append(line)
+    return gzip.compress(b"".join(parts))
+
+
+def load_capture(path: str | Path) -> Capture:
+    data = gzip.decompress(Path(path).read_bytes())
+    if not data.startswith(MAGIC):
+        raise ValueError(f"不是有效的录制文件: {path}")
+    offset = len(MAGIC)
+    (meta_len,) = _HEADER.unpack_from(data, offset)
+    offset += _HEADER.size
+    capture = Capture(meta=json.loads(data[offset:offset + meta_len]))
+    offset += meta_len
+    while offset < len(data):
+        delay_us, length = _RECORD.unpack_from(data, offset)
+        offset += _RECORD.size
+        capture.records.append((delay_us / 1_000_000, data[offset:offset + length]))
+        offset += length
+    return capture
+
+
+def _write_capture(path: Path, capture: Capture):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(dump_capture(capture))
+
+
+class RecordingResponse:
+    """包装上游响应，在读取行的同时记录内容和间隔"""
+
+    def __init__(self, response, meta: Dict[str, Any]):
+        self._response = response
+        self._capture = Capture(meta=meta)
+        self._last = time.monotonic()
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    async def aiter_lines(self) -> AsyncGenerator[bytes, None]:
+        async for line in self._response.aiter_lines():
+            now = time.monotonic()
+            self._capture.records.append((now - self._last, bytes(line)))
+            self._last = now
+            yield line
+
+    def save(self):
+        """后台写入录制文件，不阻塞事件循环"""
+        if not self._capture.records:
+            return
+        path = Path(CAPTURE_DIR) / f"{int(time.time() * 1000)}-{uuid.uuid4().hex[:8]}.hlcap"
+        task = asyncio.create_task(asyncio.to_thread(_write_capture, path, self._capture))
+        _pending_writes.add(task)
+        task.add_done_callback(_pending_writes.discard)
+        metrics.inc("capture.saved")
+
+
+def start_recording(response, highlight_data: Dict[str, Any]) -> RecordingResponse:
+    # 不记录提示词原文，只保留长度
+    meta = {
+        "version": 1,
+        "captured_at": int(time.time()),
+        "status_code": response.status_code,
+        "model_id": highlight_data.get("modelId"),
+        "prompt_chars": len(highlight_data.get("prompt", "")),
+    }
+    return RecordingResponse(response, meta)
+
+
+class ReplayResponse:
+    """按录制时的节奏（或按倍速、最快速度）回放上游响应"""
+
+    def __init__(self, capture: Capture, speed: float):
+        self.status_code = capture.meta.get("status_code", 200)
+        self._capture = capture
+        self._speed = speed
+
+    async def aiter_lines(self) -> AsyncGenerator[bytes, None]:
+        for delay, line in self._capture.records:
+            if self._speed > 0 and delay > 0:
+                await asyncio.sleep(delay / self._speed)
+            yield line
+
+    async def atext(self) -> str:
+        return "\n".join(line.decode("utf-8") for _, line in self._capture.records)
+
+    def close(self):
+        pass
+
+
+def current_replay() -> Optional[ReplayResponse]:
+    """当前上下文处于回放模式时返回新的回放响应"""
+    replay = _replay.get()
+    if replay is None:
+        return None
+    return ReplayResponse(*replay)
+
+
+@contextmanager
+def replay_capture(capture: Capture | str | Path, speed: float = 1.0):
+    """
+    在该上下文内，stream_generator / non_stream_response 读取录制内容而不是请求上游
+    speed 为回放倍速，0 表示不等待、以最快速度回放
+    """
+    if not isinstance(capture, Capture):
+        capture = load_capture(capture)
+    token = _replay.set((capture, speed))
+    try:
+        yield capture
+    finally:
+        _replay.reset(token)
+
+
+@contextmanager
+def isolated_state():
+    """
+    回放的录制内容可能命中封号文案或疑似封号特征，在该上下文内账号健康表和封号文案写入临时目录，
+    退出时恢复，不影响 ./config 下的运行数据；封号文案从现有文件复制一份，匹配结果与线上一致
+    """
+    from . import account_health
+    from .utils import CheckBanContent
+
+    ban_path = CheckBanContent.path
+    health_path = account_health.ACCOUNT_HEALTH_PATH
+    health = dict(account_health.account_health)
+    with tempfile.TemporaryDirectory() as tmp:
+        if ban_path.is_file():
+            shutil.copy(ban_path, tmp)
+        CheckBanContent.path = Path(tmp) / ban_path.name
+        CheckBanContent._initialized = False
+        account_health.ACCOUNT_HEALTH_PATH = Path(tmp) / health_path.name
+        # 提前加载文案索引，加载耗时不计入回放
+        CheckBanContent.get_instance()
+        try:
+            yield
+        finally:
+            CheckBanContent.path = ban_path
+            CheckBanContent._initialized = False
+            account_health.ACCOUNT_HEALTH_PATH = health_path
+            account_health.account_health.clear()
+            account_health.account_health.update(health)
+
+
+async def _bench(path: str, speed: float, stream: bool, repeat: int):
+    from .auth import access_tokens
+    from .chat_service import stream_generator, non_stream_completion
+    # 以 python -m 运行时本模块是 __main__，需要使用 chat_service 引用的那份模块状态
+    from .capture_service import replay_capture, load_capture, isolated_state
+
+    rt = "replay"
+    access_tokens.setdefault(rt, {"access_token": "replay", "expires_at": 0})
+    highlight_data = {"prompt": "", "additionalTools": []}
+    capture = load_capture(path)
+    elapsed = []
+    chunks = 0
+    for _ in range(repeat):
+        # 每轮使用独立的健康表和封号文案，前一轮的封号标记不影响后一轮
+        with isolated_state(), replay_capture(capture, speed):
+            start = time.perf_counter()
+            if stream:
+                async for _chunk in stream_generator(highlight_data, "replay", "replay", "replay", rt):
+                    chunks += 1
+            else:
+                await non_stream_completion(highlight_data, "replay", "replay", "replay", rt)
+            elapsed.append(time.perf_counter() - start)
+    elapsed.sort()
+    print(json.dumps({
+        "lines": len(capture.records),
+        "chunks": chunks // repeat if stream else None,
+        "repeat": repeat,
+        "min_ms": round(elapsed[0] * 1000, 3),
+        "median_ms": round(elapsed[len(elapsed) // 2] * 1000, 3),
+        "max_ms": round(elapsed[-1] * 1000, 3),
+    }, ensure_ascii=False))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="回放上游 SSE 录制文件并统计处理耗时")
+    parser.add_argument("path", help="录制文件路径（.hlcap）")
+    parser.add_argument("--speed", type=float, default=0, help="回放倍速，0 表示最快速度（默认）")
+    parser.add_argument("--non-stream", action="store_true", help="使用非流式处理路径")
+    parser.add_argument("--repeat", type=int, default=1, help="重复次数")
+    args = parser.parse_args()
+    logger.remove()
+    asyncio.run(_bench(args.path, args.speed, not args.non_stream, max(args.repeat, 1)))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,30 @@
+import asyncio
 import json
+from contextlib import asynccontextmanager
 from html import unescape
 import time
 import uuid
-from typing import Dict, Any, AsyncGenerator, Optional
+from typing import Dict, Any, AsyncGenerator, Optional, Callable, List
 
-from curl_cffi import AsyncSession, Response
+from curl_cffi import Response
+from curl_cffi.requests.exceptions import RequestException
 from fastapi.responses import JSONResponse
 from loguru import logger
 
+from . import metrics
+from .account_health import mark_suspected
 from .auth import get_access_token, get_highlight_headers, set_ban_rt
-from .config import HIGHLIGHT_BASE_URL, TLS_VERIFY
+from .capture_service import current_replay, start_recording
+from .config import HIGHLIGHT_BASE_URL, CAPTURE_DIR, STREAM_COALESCE, STREAM_COALESCE_INTERVAL, \
+    STREAM_COALESCE_BYTES
+from .deadline import stage_timeout, deadline_exceeded, deadline_error, current_deadline
 from .errors import HighlightError
+from .http_client import get_session
 from .models import ChatCompletionResponse, Choice, Usage
-from .utils import check_ban_delay, CheckBanContent, MatchResult
+from .proxy_service import record_proxy_success, record_proxy_failure
+from .usage_service import TokenCounter, build_usage, estimate_prompt_tokens, record_usage
+from .tool_calls import ToolCallAccumulator
+from .utils import BanDetector, MatchResult
 
 
 async def parse_sse_line(line: str) -> Optional[str]:
@@ -23,233 +35,457 @@ async def parse_sse_line(line: str) -> Optional[str]:
     return None
 
 
+@asynccontextmanager
+async def open_chat_stream(highlight_data: Dict[str, Any], headers: Dict[str, str], proxy=None):
+    """发起上游聊天流式请求，并记录代理健康状况；CAPTURE_DIR 非空时录制上游响应，回放模式下读取录制内容"""
+    replay = current_replay()
+    if replay is not None:
+        yield replay
+        return
+
+    s = get_session(proxy)
+    start = time.monotonic()
+    try:
+        async with s.stream('POST',
+                            HIGHLIGHT_BASE_URL + "/api/v1/chat",
+                            headers=headers,
+                            json=highlight_data,
+                            timeout=stage_timeout(60)) as response:
+            if response.status_code != 200:
+                yield response
+                return
+            record_proxy_success(proxy, time.monotonic() - start)
+            try:
+                if not CAPTURE_DIR:
+                    yield response
+                    return
+                recorder = start_recording(response, highlight_data)
+                try:
+                    yield recorder
+                finally:
+                    recorder.save()
+            except BaseException:
+                # 调用方未读完就退出（客户端断开、检测到封号等），立即中止上游传输
+                abort_upstream(response)
+                raise
+    except RequestException:
+        if deadline_exceeded():
+            # 请求截止时间到了，不算代理故障
+            raise deadline_error()
+        record_proxy_failure(proxy)
+        raise
+
+
+def abort_upstream(response: Response):
+    """
+    中止上游流式传输：curl_cffi 退出 stream 上下文时会等待传输结束，
+    这里先阻止后续写入并取消传输任务，使连接立即关闭、句柄归还连接池
+    """
+    quit_now = getattr(response, "quit_now", None)
+    if quit_now is not None:
+        quit_now.set()
+    task = getattr(response, "astream_task", None)
+    if task is not None and not task.done():
+        task.cancel()
+        # curl_cffi 退出时会 await 该任务，替换为不抛出 CancelledError 的等待对象，避免覆盖原始异常
+        response.astream_task = asyncio.gather(task, return_exceptions=True)
+
+
+async def raise_for_upstream_status(response: Response, proxy=None):
+    """上游返回非 200 时抛出错误，Cloudflare 拦截计入代理健康状况"""
+    text = await response.atext()
+    if 'Attention Required! | Cloudflare' in text:
+        record_proxy_failure(proxy, cloudflare=True)
+        text = 'Cloudflare 403'
+    raise HighlightError(response.status_code, text)
+
+
+async def iter_upstream_lines(
+        response: Response, flush_deadline: Optional[Callable[[], Optional[float]]] = None
+) -> AsyncGenerator[Optional[bytes], None]:
+    """
+    逐行读取上游响应，请求设置了截止时间时到点即中止（curl 的流式超时只检测停顿，不限制总时长）
+    传入 flush_deadline 时，若它返回的时间点（time.monotonic）到达前没有新行，先产出 None 通知调用方刷新合并中的内容
+    """
+    request_deadline = current_deadline()
+    if flush_deadline is None and request_deadline is None:
+        async for line in response.aiter_lines():
+            yield line
+        return
+
+    lines = response.aiter_lines()
+    next_line: Optional[asyncio.Future] = None
+    try:
+        while True:
+            if next_line is None:
+                next_line = asyncio.ensure_future(lines.__anext__())
+            deadline = flush_deadline() if flush_deadline else None
+            if request_deadline is not None:
+                deadline = request_deadline if deadline is None else min(deadline, request_deadline)
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            done, _ = await asyncio.wait((next_line,), timeout=timeout)
+            if not done:
+                if flush_deadline is None or (request_deadline is not None and time.monotonic() >= request_deadline):
+                    raise deadline_error()
+                yield None
+                continue
+            future, next_line = next_line, None
+            try:
+                line = future.result()
+            except StopAsyncIteration:
+                return
+            yield line
+    finally:
+        if next_line is not None:
+            next_line.cancel()
+
+
+class UsageChunk(dict):
+    """流式响应中携带用量的分片，合并多个回复的流时按类型识别，不依赖序列化后的文本"""
+
+    def __init__(self, data: str, usage: Usage):
+        super().__init__(data=data)
+        self.usage = usage
+
+
 async def stream_generator(
-        highlight_data: Dict[str, Any], access_token: str, identifier: str, model: str, rt: str, proxy=None
+        highlight_data: Dict[str, Any], access_token: str, identifier: str, model: str, rt: str, proxy=None,
+        user_id: str = None, include_usage: bool = False, choice_index: int = 0, response_id: str = None,
+        created: int = None
 ) -> AsyncGenerator[Dict[str, Any], None]:
-    """生成流式响应"""
-    response_id = f"chatcmpl-{str(uuid.uuid4())}"
-    created = int(time.time())
+    """生成流式响应，n > 1 时各回复共用 response_id/created，以 choice_index 区分"""
+    response_id = response_id or f"chatcmpl-{str(uuid.uuid4())}"
+    created = created or int(time.time())
 
     full_content = ""
+    prompt_tokens = estimate_prompt_tokens(highlight_data.get("prompt", ""), highlight_data.get("additionalTools"))
+    completion_counter = TokenCounter()
 
     for i in range(2):
         # 使用httpx的流式请求
         headers = get_highlight_headers(access_token, identifier)
-        tool_call_idx = 0
-        async with AsyncSession(verify=TLS_VERIFY, timeout=60, impersonate='chrome', proxy=proxy) as s:
-            async with s.stream('POST',
-                                HIGHLIGHT_BASE_URL + "/api/v1/chat",
-                                headers=headers,
-                                json=highlight_data) as response:
-                response: Response
-                req_id = uuid.uuid4()
-
-                if response.status_code == 401 and i == 0:
-                    access_token = await get_access_token(rt, True, proxy)
+        tool_calls = ToolCallAccumulator(highlight_data.get("additionalTools"))
+        async with open_chat_stream(highlight_data, headers, proxy) as response:
+            response: Response
+            req_id = uuid.uuid4()
+
+            if response.status_code == 401 and i == 0:
+                access_token = await get_access_token(rt, True, proxy)
+                continue
+            if response.status_code != 200:
+                await raise_for_upstream_status(response, proxy)
+
+            # 发送初始消息
+            is_send_initial_chunk = False
+            ban_detector = BanDetector()
+
+            content_tmp = ''
+            has_tool_use = False
+            # 合并模式下待发送的文本及其开始积攒的时间
+            pending_text = ''
+            pending_since = 0.0
+
+            def flush_deadline() -> Optional[float]:
+                return pending_since + STREAM_COALESCE_INTERVAL if pending_text else None
+
+            def text_chunks(text: str):
+                nonlocal is_send_initial_chunk
+                if not is_send_initial_chunk:
+                    is_send_initial_chunk = True
+                    initial_chunk = {
+                        "id": response_id,
+                        "object": "chat.completion.chunk",
+                        "created": created,
+                        "model": model,
+                        "choices": [
+                            {
+                                "index": choice_index,
+                                "delta": {"role": "assistant"},
+                                "finish_reason": None,
+                            }
+                        ],
+                    }
+                    yield {"data": json.dumps(initial_chunk)}
+                chunk_data = {
+                    "id": response_id,
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": model,
+                    "choices": [
+                        {
+                            "index": choice_index,
+                            "delta": {"content": text},
+                            "finish_reason": None,
+                        }
+                    ],
+                }
+                yield {"data": json.dumps(chunk_data)}
+
+            async for line in iter_upstream_lines(response, flush_deadline if STREAM_COALESCE else None):
+                if line is None:
+                    # 合并窗口到期，发送已积攒的文本
+                    for chunk in text_chunks(pending_text):
+                        yield chunk
+                    pending_text = ''
                     continue
-                if response.status_code != 200:
-                    text = await response.atext()
-                    if 'Attention Required! | Cloudflare' in text:
-                        text = 'Cloudflare 403'
-                    raise HighlightError(response.status_code, text)
-
-                # 发送初始消息
-                is_send_initial_chunk = False
-                last_timestamp_ms = None
-                sse_content_time = []
-                contents = []
-
-                content_tmp = ''
-                has_tool_use = False
-
-                async for line in response.aiter_lines():
-                    line = line.decode("utf-8")
-                    logger.debug(f"req_id: {str(req_id)}, {line}")
-
-                    # 解析SSE行
-                    data = await parse_sse_line(line)
-                    if data and data.strip():
-                        try:
-                            event_data = json.loads(data)
-                            if event_data.get("type") == "text":
-                                # 上游会把标签转成 HTML 实体，这里解码回原文
-                                content = unescape(event_data.get("content", ""))
-                                if content:
-                                    full_content += content
-
-                                    match_result = CheckBanContent.get_instance().match_string_with_set(full_content)
-                                    now_timestamp_ms = int(time.time() * 1000)
-                                    if last_timestamp_ms:
-                                        # logger.debug(now_timestamp_ms - last_timestamp_ms)
-                                        sse_content_time.append(now_timestamp_ms - last_timestamp_ms)
-
-                                    last_timestamp_ms = now_timestamp_ms
-                                    contents.append(content)
-
-                                    if match_result == MatchResult.MATCH_SUCCESS:
-                                        set_ban_rt(rt)
-                                        response.close()
-                                        raise HighlightError(200, 'HighlightAI account suspended', 403)
-                                    elif match_result == MatchResult.NEED_MORE_CONTENT:
-                                        content_tmp += content
+                line = line.decode("utf-8")
+                logger.debug(f"req_id: {str(req_id)}, {line}")
+
+                # 解析SSE行
+                data = await parse_sse_line(line)
+                if data and data.strip():
+                    try:
+                        event_data = json.loads(data)
+                        if event_data.get("type") == "text":
+                            # 上游会把标签转成 HTML 实体，这里解码回原文
+                            content = unescape(event_data.get("content", ""))
+                            if content:
+                                full_content += content
+                                completion_counter.add(content)
+
+                                match_result = ban_detector.feed(content)
+                                if match_result == MatchResult.MATCH_SUCCESS:
+                                    # 抛出异常后 open_chat_stream 会立即中止上游传输
+                                    metrics.inc("ban.early_abort")
+                                    set_ban_rt(rt)
+                                    raise HighlightError(200, 'HighlightAI account suspended', 403)
+                                elif match_result == MatchResult.NEED_MORE_CONTENT:
+                                    content_tmp += content
+                                    continue
+
+                                text = content_tmp + content
+                                content_tmp = ''
+                                if STREAM_COALESCE:
+                                    if not pending_text:
+                                        pending_since = time.monotonic()
+                                    pending_text += text
+                                    # 按 UTF-8 字节数计，中文等多字节文本不会积攒到配置值的数倍；积攒量很小，重复编码开销可以忽略
+                                    if len(pending_text.encode('utf-8')) < STREAM_COALESCE_BYTES \
+                                            and time.monotonic() - pending_since < STREAM_COALESCE_INTERVAL:
                                         continue
-
-                                    if not is_send_initial_chunk:
-                                        initial_chunk = {
-                                            "id": response_id,
-                                            "object": "chat.completion.chunk",
-                                            "created": created,
-                                            "model": model,
-                                            "choices": [
-                                                {
-                                                    "index": 0,
-                                                    "delta": {"role": "assistant"},
-                                                    "finish_reason": None,
-                                                }
-                                            ],
-                                        }
-                                        yield {"data": json.dumps(initial_chunk)}
-
-                                    chunk_data = {
-                                        "id": response_id,
-                                        "object": "chat.completion.chunk",
-                                        "created": created,
-                                        "model": model,
-                                        "choices": [
-                                            {
-                                                "index": 0,
-                                                "delta": {"content": content_tmp + content},
-                                                "finish_reason": None,
-                                            }
-                                        ],
-                                    }
-                                    content_tmp = ''
-                                    yield {"data": json.dumps(chunk_data)}
-                            elif event_data.get("type") == "toolUse":
-                                has_tool_use = True
-                                tool_name = event_data.get("name", "")
-                                tool_id = event_data.get("toolId", "")
-                                tool_input = event_data.get("input", "")
-                                if tool_name:
-                                    chunk_data = {
-                                        "id": response_id,
-                                        "object": "chat.completion.chunk",
-                                        "created": created,
-                                        "model": model,
-                                        "choices": [
-                                            {
-                                                "index": 0,
-                                                "delta": {
-                                                    "tool_calls": [
-                                                        {
-                                                            "index": tool_call_idx,
-                                                            "id": tool_id,
-                                                            "type": "function",
-                                                            "function": {
-                                                                "name": tool_name,
-                                                                "arguments": tool_input,
-                                                            },
-                                                        }
-                                                    ]
-                                                },
-                                                "finish_reason": None,
-                                            }
-                                        ],
+                                    text, pending_text = pending_text, ''
+                                for chunk in text_chunks(text):
+                                    yield chunk
+                        elif event_data.get("type") == "toolUse":
+                            has_tool_use = True
+                            if pending_text:
+                                for chunk in text_chunks(pending_text):
+                                    yield chunk
+                                pending_text = ''
+                            added = tool_calls.add(event_data.get("toolId", ""), event_data.get("name", ""),
+                                                   event_data.get("input", ""))
+                            if added:
+                                call, is_new, fragment = added
+                                # 新调用带上 id 和函数名，同一调用的后续片段只发送参数增量
+                                if is_new:
+                                    completion_counter.add(call["name"])
+                                    tool_call = {
+                                        "index": call["index"],
+                                        "id": call["id"],
+                                        "type": "function",
+                                        "function": {
+                                            "name": call["name"],
+                                            "arguments": fragment,
+                                        },
                                     }
-                                    tool_call_idx += 1
-                                    # logger.debug(
-                                    #     json.dumps({"data": json.dumps(chunk_data)}, ensure_ascii=False))
-                                    yield {"data": json.dumps(chunk_data)}
-                            elif event_data.get("type") == "error":
-                                raise HighlightError(response.status_code, event_data.get('error'))
-                        except json.JSONDecodeError:
-                            # 忽略无效的JSON数据
-                            continue
-
-                if not full_content and not has_tool_use:
-                    raise HighlightError(200, 'HighlightAI 空回复', 500)
-
-                # 发送完成消息
-                final_chunk = {
+                                else:
+                                    tool_call = {"index": call["index"], "function": {"arguments": fragment}}
+                                completion_counter.add(fragment)
+                                chunk_data = {
+                                    "id": response_id,
+                                    "object": "chat.completion.chunk",
+                                    "created": created,
+                                    "model": model,
+                                    "choices": [
+                                        {
+                                            "index": choice_index,
+                                            "delta": {"tool_calls": [tool_call]},
+                                            "finish_reason": None,
+                                        }
+                                    ],
+                                }
+                                # logger.debug(
+                                #     json.dumps({"data": json.dumps(chunk_data)}, ensure_ascii=False))
+                                yield {"data": json.dumps(chunk_data)}
+                        elif event_data.get("type") == "error":
+                            raise HighlightError(response.status_code, event_data.get('error'))
+                    except json.JSONDecodeError:
+                        # 忽略无效的JSON数据
+                        continue
+
+            if not full_content and not has_tool_use:
+                raise HighlightError(200, 'HighlightAI 空回复', 500)
+            tool_calls.finish()
+            if pending_text:
+                for chunk in text_chunks(pending_text):
+                    yield chunk
+
+            # 发送完成消息
+            final_chunk = {
+                "id": response_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": choice_index, "delta": {}, "finish_reason": "stop"}],
+            }
+            # if check_ban_content(full_content):
+            #     set_ban_rt(rt)
+            usage = build_usage(prompt_tokens, completion_counter.total)
+            record_usage(user_id, model, usage)
+            yield {"data": json.dumps(final_chunk)}
+            if include_usage:
+                usage_chunk = {
                     "id": response_id,
                     "object": "chat.completion.chunk",
                     "created": created,
                     "model": model,
-                    "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                    "choices": [],
+                    "usage": usage.model_dump(),
                 }
-                # if check_ban_content(full_content):
-                #     set_ban_rt(rt)
-                yield {"data": json.dumps(final_chunk)}
-                yield {"data": "[DONE]"}
-                # logger.debug(sse_content_time)
-                if check_ban_delay(sse_content_time, contents):
-                    set_ban_rt(rt)
-                return
+                yield UsageChunk(json.dumps(usage_chunk), usage)
+            yield {"data": "[DONE]"}
+            # logger.debug(sse_content_time)
+            if ban_detector.check_delay():
+                mark_suspected(rt)
+            return
+
+
+async def merge_choice_streams(
+        make_streams: Callable[[], List[AsyncGenerator[Dict[str, Any], None]]], response_id: str, created: int,
+        model: str, include_usage: bool = False
+) -> AsyncGenerator[Dict[str, Any], None]:
+    """
+    n > 1 时合并多个回复的流，按到达顺序转发分片
+    各流自身的 [DONE] 和用量分片被拦截，全部结束后统一发送一次
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+    finished = object()
+
+    async def pump(stream: AsyncGenerator[Dict[str, Any], None]):
+        try:
+            async for item in stream:
+                await queue.put(item)
+            await queue.put(finished)
+        except Exception as e:
+            await queue.put(e)
+        finally:
+            # 被取消时关闭上游连接、释放账号并发名额
+            await stream.aclose()
+
+    tasks = [asyncio.create_task(pump(stream)) for stream in make_streams()]
+    prompt_tokens = 0
+    completion_tokens = 0
+    try:
+        remaining = len(tasks)
+        while remaining:
+            item = await queue.get()
+            if item is finished:
+                remaining -= 1
+                continue
+            if isinstance(item, Exception):
+                raise item
+            if item["data"] == "[DONE]":
+                continue
+            if isinstance(item, UsageChunk):
+                # 提示词只计一次，与 OpenAI 的 n 计费方式一致
+                prompt_tokens = item.usage.prompt_tokens
+                completion_tokens += item.usage.completion_tokens
+                continue
+            yield item
+
+        if include_usage:
+            usage_chunk = {
+                "id": response_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [],
+                "usage": build_usage(prompt_tokens, completion_tokens).model_dump(),
+            }
+            yield {"data": json.dumps(usage_chunk)}
+        yield {"data": "[DONE]"}
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def merge_choice_responses(responses: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """n > 1 时合并多个非流式响应，重新编号 choices 并汇总用量"""
+    merged = responses[0]
+    choices = []
+    completion_tokens = 0
+    for index, response in enumerate(responses):
+        for choice in response["choices"]:
+            choices.append({**choice, "index": index})
+        completion_tokens += response["usage"]["completion_tokens"]
+    merged["choices"] = choices
+    merged["usage"] = build_usage(merged["usage"]["prompt_tokens"], completion_tokens).model_dump()
+    return merged
 
 
 async def non_stream_response(
-        highlight_data: Dict[str, Any], access_token: str, identifier: str, model: str, rt: str, proxy=None
-) -> JSONResponse:  # type: ignore
+        highlight_data: Dict[str, Any], access_token: str, identifier: str, model: str, rt: str, proxy=None,
+        user_id: str = None
+) -> JSONResponse:
     """处理非流式响应"""
+    return JSONResponse(content=await non_stream_completion(
+        highlight_data, access_token, identifier, model, rt, proxy, user_id
+    ))
+
+
+async def non_stream_completion(
+        highlight_data: Dict[str, Any], access_token: str, identifier: str, model: str, rt: str, proxy=None,
+        user_id: str = None
+) -> Dict[str, Any]:  # type: ignore
+    """请求上游并汇总为 OpenAI 格式的完整响应"""
+    prompt_tokens = estimate_prompt_tokens(highlight_data.get("prompt", ""), highlight_data.get("additionalTools"))
     for i in range(2):
         headers = get_highlight_headers(access_token, identifier)
-        async with AsyncSession(verify=TLS_VERIFY, timeout=60, impersonate='chrome', proxy=proxy) as s:
-            async with s.stream('POST',
-                                HIGHLIGHT_BASE_URL + "/api/v1/chat",
-                                headers=headers,
-                                json=highlight_data) as response:
-                response: Response
-                if response.status_code == 401 and i == 0:
-                    access_token = await get_access_token(rt, True, proxy)
-                    continue
-
-                if response.status_code != 200:
-                    text = await response.atext()
-                    if 'Attention Required! | Cloudflare' in text:
-                        text = 'Cloudflare 403'
-                    raise HighlightError(response.status_code, text)
-
-                # 收集完整响应
-                full_response = ""
-                tool_calls = []
-                last_timestamp_ms = None
-                sse_content_time = []
-                contents = []
-
-                async for line in response.aiter_lines():
-                    line = line.decode("utf-8")
-                    logger.debug(line)
-                    data = await parse_sse_line(line)
-                    if data and data.strip():
-                        try:
-                            event_data = json.loads(data)
-                            if event_data.get("type") == "text":
-                                content = unescape(event_data.get("content", ""))
-                                now_timestamp_ms = int(time.time() * 1000)
-                                if last_timestamp_ms:
-                                    # logger.debug(now_timestamp_ms - last_timestamp_ms)
-                                    sse_content_time.append(now_timestamp_ms - last_timestamp_ms)
-
-                                last_timestamp_ms = now_timestamp_ms
-                                contents.append(content)
-                                full_response += content
-                            elif event_data.get("type") == "toolUse":
-                                tool_name = event_data.get("name", "")
-                                tool_id = event_data.get("toolId", "")
-                                tool_input = event_data.get("input", "")
-                                if tool_name:
-                                    tool_calls.append({
-                                        "id": tool_id,
-                                        "type": "function",
-                                        "function": {
-                                            "name": tool_name,
-                                            "arguments": tool_input,
-                                        }
-                                    })
-                            elif event_data.get("type") == "error":
-                                raise HighlightError(response.status_code, event_data.get('error'))
-                        except json.JSONDecodeError:
-                            continue
+        async with open_chat_stream(highlight_data, headers, proxy) as response:
+            response: Response
+            if response.status_code == 401 and i == 0:
+                access_token = await get_access_token(rt, True, proxy)
+                continue
+
+            if response.status_code != 200:
+                await raise_for_upstream_status(response, proxy)
+
+            # 收集完整响应
+            full_response = ""
+            tool_calls = ToolCallAccumulator(highlight_data.get("additionalTools"))
+            completion_counter = TokenCounter()
+            ban_detector = BanDetector()
+
+            async for line in iter_upstream_lines(response):
+                line = line.decode("utf-8")
+                logger.debug(line)
+                data = await parse_sse_line(line)
+                if data and data.strip():
+                    try:
+                        event_data = json.loads(data)
+                        if event_data.get("type") == "text":
+                            content = unescape(event_data.get("content", ""))
+                            if not content:
+                                continue
+                            full_response += content
+                            completion_counter.add(content)
+                            # 边读边检测，命中封号文案立即中止，不必等待整段回复
+                            if ban_detector.feed(content) == MatchResult.MATCH_SUCCESS:
+                                metrics.inc("ban.early_abort")
+                                set_ban_rt(rt)
+                                raise HighlightError(200, 'HighlightAI account suspended', 403)
+                        elif event_data.get("type") == "toolUse":
+                            added = tool_calls.add(event_data.get("toolId", ""), event_data.get("name", ""),
+                                                   event_data.get("input", ""))
+                            if added:
+                                call, is_new, fragment = added
+                                if is_new:
+                                    completion_counter.add(call["name"])
+                                completion_counter.add(fragment)
+                        elif event_data.get("type") == "error":
+                            raise HighlightError(response.status_code, event_data.get('error'))
+                    except json.JSONDecodeError:
+                        continue
 
         # 创建 OpenAI 格式的响应
         response_id = f"chatcmpl-{str(uuid.uuid4())}"
@@ -258,22 +494,21 @@ async def non_stream_response(
         # 构建消息内容
         message_content: Dict[str, any] = {"role": "assistant"}
 
-        if not tool_calls and not full_response:
+        if not tool_calls.calls and not full_response:
             raise HighlightError(200, 'HighlightAI 空回复', 500)
+        tool_calls.finish()
 
         if full_response:
             message_content["content"] = full_response
-        if tool_calls:
-            message_content["tool_calls"] = tool_calls
+        if tool_calls.calls:
+            message_content["tool_calls"] = tool_calls.to_openai()
 
-        if check_ban_delay(sse_content_time, contents):
-            set_ban_rt(rt)
+        if ban_detector.check_delay():
+            mark_suspected(rt)
             raise HighlightError(200, 'HighlightAI account suspended', 403)
 
-        match_result = CheckBanContent.get_instance().match_string_with_set(full_response)
-        if match_result == MatchResult.MATCH_SUCCESS:
-            set_ban_rt(rt)
-            raise HighlightError(200, 'HighlightAI account suspended', 403)
+        usage = build_usage(prompt_tokens, completion_counter.total)
+        record_usage(user_id, model, usage)
 
         response_data = ChatCompletionResponse(
             id=response_id,
@@ -287,6 +522,6 @@ async def non_stream_response(
                     finish_reason="stop",
                 )
             ],
-            usage=Usage(prompt_tokens=0, completion_tokens=0, total_tokens=0),
+            usage=usage,
         )
-        return JSONResponse(content=response_data.model_dump())
+        return response_data.model_dump()
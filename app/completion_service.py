@@ -0,0 +1,346 @@
+import asyncio
+import time
+import uuid
+from typing import Dict, Any, List, AsyncGenerator, Awaitable, Optional, Callable, Tuple
+
+from curl_cffi.requests.exceptions import RequestException
+from fastapi import HTTPException, Request
+from loguru import logger
+from sse_starlette import EventSourceResponse
+from starlette.responses import JSONResponse
+
+from identifier import get_identifier
+from . import metrics
+from .account_health import is_live
+from .account_service import get_account_pool
+from .auth import Account, get_access_token
+from .chat_service import stream_generator, non_stream_response, non_stream_completion, merge_choice_streams, \
+    merge_choice_responses
+from .config import DEFAULT_MAX_OUTPUT_TOKENS
+from .deadline import deadline_exceeded
+from .errors import HighlightError
+from .file_service import upload_images
+from .limiter import AdaptiveLimiter, get_chat_lock
+from .model_service import fetch_model_candidates, get_model_stats
+from .prepare_service import Stage, run_stages, format_server_timing
+from .proxy_service import resolve_proxy, get_account_proxy
+from .request_parser import ParsedChatRequest
+from .retry_policy import ErrorResponse, FAILOVER, RETRY, error_response, classify_error, call_with_retry
+from .utils import safe_stream_wrapper, error_wrapper
+
+def build_highlight_data(request: ParsedChatRequest, model_id: str, images: List[Dict[str, str]]) -> Dict[str, Any]:
+    """构造 Highlight 聊天请求体"""
+    attached_context = [
+        {
+            'type': 'image',
+            'fileId': image['fileId'],
+            'fileName': image['fileName']
+        } for image in images
+    ]
+
+    # 计算最大输出token，若用户未指定则使用默认值
+    max_output_tokens = request.max_tokens or DEFAULT_MAX_OUTPUT_TOKENS
+
+    return {
+        "prompt": request.prompt,
+        "attachedContext": attached_context,
+        "modelId": model_id,
+        "additionalTools": request.tools,
+        "backendPlugins": [],
+        "useMemory": False,
+        "useKnowledge": False,
+        "ephemeral": True,
+        "timezone": "Asia/Hong_Kong",
+        "generationConfig": {
+            "maxOutputTokens": max_output_tokens
+        }
+    }
+
+
+def build_stages(request: ParsedChatRequest, account: Account, proxy=None) -> List[Stage]:
+    """
+    请求准备阶段：图片上传和模型查询依赖 token，identifier 不依赖 token，可以并发执行
+    提示词和工具已在解析请求体时生成
+    """
+    return [
+        Stage("token", lambda: get_access_token(account.rt, False, proxy)),
+        Stage("model", lambda access_token: fetch_model_candidates(request.model, access_token, proxy), ("token",)),
+        Stage("images", lambda access_token: upload_images(request.image_urls, access_token, proxy), ("token",)),
+        # 密钥已在解析 API Key 时派生，这里只剩一次 AES 加密
+        Stage("identifier", lambda: get_identifier(account.user_id, account.client_uuid, key=account.identifier_key)),
+    ]
+
+
+def record_outcome(lock: AdaptiveLimiter, status_code: int, latency: Optional[float] = None):
+    """按响应状态反馈给账号的自适应并发：上游错误、限流和封号降低并发，请求本身的错误和客户端超时不计"""
+    if deadline_exceeded():
+        return
+    if status_code < 400:
+        lock.record_success(latency)
+    elif status_code >= 500 or status_code in (403, 429):
+        lock.record_failure(f"status {status_code}")
+
+
+async def cancel_on_disconnect(raw_request: Request, awaitable: Awaitable[Any]) -> Any:
+    """
+    等待请求处理完成，期间客户端断开则立即取消处理（关闭上游连接、释放账号并发名额）
+    请求体须已读完，之后 ASGI receive 只会收到 http.disconnect
+    """
+    task = asyncio.ensure_future(awaitable)
+
+    async def wait_disconnect():
+        while (await raw_request.receive())["type"] != "http.disconnect":
+            pass
+
+    watcher = asyncio.ensure_future(wait_disconnect())
+    try:
+        await asyncio.wait((task, watcher), return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        watcher.cancel()
+    if not task.done():
+        metrics.inc("request.client_disconnects")
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        logger.info("客户端在响应返回前断开，已取消上游请求")
+        return None
+    return task.result()
+
+
+async def complete_chat(request: ParsedChatRequest, account: Account):
+    """完成一次聊天请求，返回流式或非流式响应"""
+    if request.n > 1:
+        return await complete_chat_choices(request, account)
+
+    response = None
+    pool = get_account_pool(account)
+    for i, candidate in enumerate(pool):
+        response = await complete_chat_on(request, candidate)
+        # 开始输出前发现账号被封（或疑似被封）、被限流或被 Cloudflare 拦截时，换账号池中的下一个账号重试
+        if response is None or response.status_code < 400:
+            return response
+        if is_live(candidate.rt) and not (isinstance(response, ErrorResponse) and response.error_class == FAILOVER):
+            return response
+        if i + 1 == len(pool):
+            break
+        metrics.inc("chat.failover")
+        logger.warning(f"账号 {candidate.email or candidate.user_id} 不可用（{response.status_code}），切换账号重试")
+    return response
+
+
+async def complete_chat_on(request: ParsedChatRequest, account: Account):
+    """使用指定账号完成一次聊天请求"""
+    rt = account.rt
+    user_id = account.user_id
+    # 代理熔断时切换到备用代理
+    try:
+        proxy = resolve_proxy(get_account_proxy(account))
+    except HighlightError as e:
+        return error_response(e)
+
+    # 流式响应的并发名额在上游读完后才释放（由流缓冲回调），其余情况在返回前释放
+    lock = get_chat_lock(rt)
+    try:
+        await lock.acquire()
+    except HighlightError as e:
+        return error_response(e)
+    streaming = False
+    try:
+        try:
+            prepared, timings = await run_stages(build_stages(request, account, proxy))
+        except HighlightError as e:
+            return error_response(e)
+        except HTTPException as e:
+            # 该账号的 token 刷新或模型列表获取失败（5xx）时换账号，请求本身的错误照常返回
+            if e.status_code < 500:
+                raise
+            return error_response(e)
+
+        access_token = prepared["token"]
+        identifier = prepared["identifier"]
+        candidates = prepared["model"]
+        response = None
+        # 别名对应多个候选模型时，当前模型出错（开始输出前）换下一个候选模型
+        for i, (model, model_id) in enumerate(candidates):
+            highlight_data = build_highlight_data(request, model_id, prepared["images"])
+            # logger.debug(json.dumps(highlight_data,ensure_ascii=False))
+
+            start = time.monotonic()
+            if request.stream:
+                response = await error_wrapper(safe_stream_wrapper, stream_generator, highlight_data, access_token,
+                                               identifier, model, rt, proxy, user_id, request.include_usage,
+                                               on_upstream_done=lock.release)
+                streaming = isinstance(response, EventSourceResponse)
+            else:
+                response = await error_wrapper(non_stream_response, highlight_data, access_token, identifier,
+                                               model, rt, proxy, user_id)
+            if response is None:
+                return None
+            # 流式响应在收到第一个分片后返回，耗时即首字延迟
+            ttft = time.monotonic() - start if streaming else None
+            record_outcome(lock, response.status_code, ttft)
+            if response.status_code < 400:
+                get_model_stats(model).record_success(ttft)
+                break
+            if not (isinstance(response, ErrorResponse) and response.error_class == RETRY):
+                break
+            get_model_stats(model).record_failure()
+            if i + 1 == len(candidates):
+                break
+            get_model_stats(model).fallbacks += 1
+            metrics.inc("model.fallback")
+            logger.warning(f"模型 {model} 请求失败，改用 {candidates[i + 1][0]}")
+
+        response.headers["Server-Timing"] = format_server_timing(timings)
+        response.headers["X-Model"] = model
+        return response
+    finally:
+        if not streaming:
+            lock.release()
+
+
+async def _locked_stream(lock: AdaptiveLimiter, stream: AsyncGenerator[Dict[str, Any], None]):
+    async with lock:
+        try:
+            async for item in stream:
+                yield item
+        except HighlightError as e:
+            record_outcome(lock, e.response_status_code)
+            raise
+        lock.record_success()
+
+
+async def complete_chat_choices(request: ParsedChatRequest, account: Account):
+    """
+    n > 1：各回复轮流分配到账号池中的账号并行请求上游，总耗时取决于最慢的一个回复
+    每个回复与 n = 1 时相同：开始输出前按候选模型回退、按账号池换账号，流式响应在所有回复都开始输出后才返回
+    同一账号上的回复仍受该账号的并发上限限制
+    """
+    pool = get_account_pool(account)
+    # 各账号的请求准备只做一次，格式：{rt: Task[(proxy, prepared, timings)]}
+    prepared: Dict[str, asyncio.Task] = {}
+
+    async def _prepare(a: Account) -> Tuple[Optional[str], Dict[str, Any], Dict[str, float]]:
+        proxy = resolve_proxy(get_account_proxy(a))
+        result, timings = await run_stages(build_stages(request, a, proxy))
+        return proxy, result, timings
+
+    async def prepare(a: Account):
+        task = prepared.get(a.rt)
+        if task is None:
+            task = prepared[a.rt] = asyncio.ensure_future(_prepare(a))
+        return await asyncio.shield(task)
+
+    async def run_choice(index: int, attempt: Callable[[Account, tuple], Awaitable[Any]]) -> Tuple[Any, str, Account]:
+        """从第 index 个账号开始依次尝试账号池和候选模型，返回 (attempt 的结果, 实际使用的模型, 实际使用的账号)"""
+        first = index % len(pool)
+        accounts = [a for i, a in enumerate(pool[first:] + pool[:first]) if i == 0 or is_live(a.rt)]
+        last_error: Exception = HighlightError(200, 'No available account', 503)
+        for i, a in enumerate(accounts):
+            try:
+                proxy, p, _ = await prepare(a)
+            except (HighlightError, HTTPException) as e:
+                if classify_error(e) != FAILOVER:
+                    raise
+                last_error = e
+            else:
+                candidates = p["model"]
+                for j, (model, model_id) in enumerate(candidates):
+                    args = (build_highlight_data(request, model_id, p["images"]), p["token"], p["identifier"],
+                            model, a.rt, proxy, a.user_id)
+                    try:
+                        return await attempt(a, args), model, a
+                    except (HighlightError, RequestException) as e:
+                        last_error = e
+                    if classify_error(last_error) != RETRY:
+                        break
+                    get_model_stats(model).record_failure()
+                    if j + 1 == len(candidates):
+                        break
+                    get_model_stats(model).fallbacks += 1
+                    metrics.inc("model.fallback")
+                    logger.warning(f"模型 {model} 请求失败，改用 {candidates[j + 1][0]}")
+                if is_live(a.rt) and classify_error(last_error) != FAILOVER:
+                    raise last_error
+            if i + 1 < len(accounts):
+                metrics.inc("chat.failover")
+                logger.warning(f"账号 {a.email or a.user_id} 不可用（{last_error}），切换账号重试")
+        raise last_error
+
+    async def run_all(attempt_for: Callable[[int], Callable[[Account, tuple], Awaitable[Any]]]):
+        results = await asyncio.gather(*(run_choice(i, attempt_for(i)) for i in range(request.n)),
+                                       return_exceptions=True)
+        errors = [r for r in results if isinstance(r, BaseException)]
+        return [r for r in results if not isinstance(r, BaseException)], (errors[0] if errors else None)
+
+    def fail(error: BaseException):
+        # 请求本身的错误与 n = 1 时一样直接抛出
+        if isinstance(error, HTTPException) and error.status_code < 500:
+            raise error
+        if not isinstance(error, (HighlightError, RequestException, HTTPException)):
+            raise error
+        return error_response(error)
+
+    if request.stream:
+        response_id = f"chatcmpl-{str(uuid.uuid4())}"
+        created = int(time.time())
+
+        def open_stream(index: int):
+            async def attempt(a: Account, args: tuple):
+                async def open_once():
+                    stream = _locked_stream(get_chat_lock(a.rt), stream_generator(
+                        *args, include_usage=True, choice_index=index, response_id=response_id, created=created
+                    ))
+                    start = time.monotonic()
+                    first_item = await stream.__anext__()
+                    get_model_stats(args[3]).record_success(time.monotonic() - start)
+                    return first_item, stream
+
+                return await call_with_retry(open_once)
+            return attempt
+
+        choices, error = await run_all(open_stream)
+        if error is not None:
+            for (_, stream), _, _ in choices:
+                await stream.aclose()
+            return fail(error)
+
+        async def resume(first_item: Dict[str, Any], stream: AsyncGenerator[Dict[str, Any], None]):
+            try:
+                yield first_item
+                async for item in stream:
+                    yield item
+            finally:
+                await stream.aclose()
+
+        streams = [resume(first_item, stream) for (first_item, stream), _, _ in choices]
+        response = await safe_stream_wrapper(merge_choice_streams, lambda: streams, response_id, created,
+                                             request.model, request.include_usage)
+    else:
+        def complete_one(index: int):
+            async def attempt(a: Account, args: tuple):
+                async def complete_once() -> Dict[str, Any]:
+                    lock = get_chat_lock(a.rt)
+                    async with lock:
+                        try:
+                            result = await non_stream_completion(*args)
+                        except HighlightError as e:
+                            record_outcome(lock, e.response_status_code)
+                            raise
+                        lock.record_success()
+                    get_model_stats(args[3]).record_success()
+                    return result
+
+                return await call_with_retry(complete_once)
+            return attempt
+
+        choices, error = await run_all(complete_one)
+        if error is not None:
+            return fail(error)
+        response = JSONResponse(content=merge_choice_responses([result for result, _, _ in choices]))
+
+    # 各回复都成功时才会走到这里，耗时取第一个回复所用账号的请求准备
+    _, _, first_account = choices[0]
+    _, _, timings = prepared[first_account.rt].result()
+    response.headers["Server-Timing"] = format_server_timing(timings)
+    response.headers["X-Model"] = ",".join(dict.fromkeys(model for _, model, _ in choices))
+    return response
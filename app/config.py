@@ -28,5 +28,73 @@ BAN_STRS = json.loads(decode_base64url_safe(os.environ.get('BAN_STRS',
 
 PROXY = os.environ.get('PROXY', '')
 MATCH_SUCCESS_LEN = float(os.environ.get('MATCH_SUCCESS_LEN', '0.5'))
+# 回复的 shingle 有该比例落在某条封号文案中时视为相似
+BAN_MATCH_THRESHOLD = float(os.environ.get('BAN_MATCH_THRESHOLD', '0.7'))
+# 新封号文案与已有文案的相似度（MinHash 估算的 Jaccard）达到该值时视为重复，不再保存
+BAN_DEDUPE_THRESHOLD = float(os.environ.get('BAN_DEDUPE_THRESHOLD', '0.8'))
 CHAT_SEMAPHORE = int(os.environ.get("CHAT_SEMAPHORE", '1'))
 DEFAULT_MAX_OUTPUT_TOKENS = int(os.environ.get("DEFAULT_MAX_OUTPUT_TOKENS", '12000'))
+ADMIN_KEY = os.environ.get("ADMIN_KEY", '')
+HTTP_MAX_CLIENTS = int(os.environ.get("HTTP_MAX_CLIENTS", '64'))
+WARMUP_TIMEOUT = float(os.environ.get("WARMUP_TIMEOUT", '60'))
+DRAIN_TIMEOUT = float(os.environ.get("DRAIN_TIMEOUT", '30'))
+
+# 图片上传前规范化（需安装 pillow）
+IMAGE_NORMALIZE = os.environ.get("IMAGE_NORMALIZE", 'False').lower() == "true"
+IMAGE_MAX_EDGE = int(os.environ.get("IMAGE_MAX_EDGE", '2048'))
+IMAGE_RECOMPRESS_THRESHOLD = int(os.environ.get("IMAGE_RECOMPRESS_THRESHOLD", str(1024 * 1024)))
+IMAGE_FORMAT = os.environ.get("IMAGE_FORMAT", 'jpeg').lower()
+IMAGE_QUALITY = int(os.environ.get("IMAGE_QUALITY", '85'))
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", '2'))
+
+# 代理熔断配置
+# 备用代理，逗号分隔，direct 表示直连
+FALLBACK_PROXIES = ['' if p.strip() == 'direct' else p.strip() for p in os.environ.get("FALLBACK_PROXIES", '').split(',') if p.strip()]
+PROXY_FAILURE_THRESHOLD = int(os.environ.get("PROXY_FAILURE_THRESHOLD", '3'))
+PROXY_OPEN_SECONDS = float(os.environ.get("PROXY_OPEN_SECONDS", '30'))
+PROXY_MAX_OPEN_SECONDS = float(os.environ.get("PROXY_MAX_OPEN_SECONDS", '600'))
+PROXY_PROBE_INTERVAL = float(os.environ.get("PROXY_PROBE_INTERVAL", '60'))
+API_KEY_CACHE_SIZE = int(os.environ.get("API_KEY_CACHE_SIZE", '1024'))
+CHAT_STRICT_VALIDATION = os.environ.get("CHAT_STRICT_VALIDATION", 'False').lower() == "true"
+BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", '1000'))
+CHAT_MAX_N = int(os.environ.get("CHAT_MAX_N", '8'))
+# 上游 SSE 录制目录，为空时不录制
+CAPTURE_DIR = os.environ.get("CAPTURE_DIR", '')
+# 流式响应缓冲：上游读入缓冲后即释放账号并发名额
+STREAM_BUFFER_BYTES = int(os.environ.get("STREAM_BUFFER_BYTES", str(1024 * 1024)))
+# disconnect：缓冲超限时断开慢客户端；block：暂停读取上游等待客户端
+STREAM_BUFFER_POLICY = os.environ.get("STREAM_BUFFER_POLICY", 'disconnect').lower()
+STREAM_SLOW_CLIENT_TIMEOUT = float(os.environ.get("STREAM_SLOW_CLIENT_TIMEOUT", '60'))
+# 流式文本增量合并：积攒到一定字节数或超过刷新间隔后再发送
+STREAM_COALESCE = os.environ.get("STREAM_COALESCE", 'False').lower() == "true"
+STREAM_COALESCE_INTERVAL = float(os.environ.get("STREAM_COALESCE_INTERVAL_MS", '50')) / 1000
+STREAM_COALESCE_BYTES = int(os.environ.get("STREAM_COALESCE_BYTES", '256'))
+# 账号健康探测：封禁后按该间隔（秒）发送探测请求，仍被封禁时间隔翻倍，为 0 时不探测
+ACCOUNT_PROBE_INTERVAL = float(os.environ.get("ACCOUNT_PROBE_INTERVAL", '600'))
+ACCOUNT_PROBE_MAX_INTERVAL = float(os.environ.get("ACCOUNT_PROBE_MAX_INTERVAL", '21600'))
+# 探测使用的模型，为空时优先使用免费模型
+ACCOUNT_PROBE_MODEL = os.environ.get("ACCOUNT_PROBE_MODEL", '')
+# 账号自适应并发（AIMD）：以 CHAT_SEMAPHORE 为初始值，在上下限之间调整；上限默认等于 CHAT_SEMAPHORE，需显式调高才会增加并发
+CHAT_CONCURRENCY_MIN = int(os.environ.get("CHAT_CONCURRENCY_MIN", '1'))
+CHAT_CONCURRENCY_MAX = int(os.environ.get("CHAT_CONCURRENCY_MAX", str(CHAT_SEMAPHORE)))
+CHAT_CONCURRENCY_BACKOFF = float(os.environ.get("CHAT_CONCURRENCY_BACKOFF", '0.5'))
+# 首字延迟超过基线的倍数时视为劣化
+CHAT_LATENCY_TOLERANCE = float(os.environ.get("CHAT_LATENCY_TOLERANCE", '2.0'))
+# 排队优先级及权重，格式：优先级:权重，逗号分隔；都有积压时按权重分配账号并发名额
+PRIORITY_WEIGHTS = {name.strip().lower(): float(weight) for name, _, weight in
+                    (item.partition(':') for item in os.environ.get("PRIORITY_WEIGHTS", 'interactive:4,batch:1').split(','))
+                    if name.strip() and weight}
+# 重试策略：指数退避（带抖动）的初始与最大间隔（秒），全局重试预算为正常请求量的比例及令牌上限
+RETRY_BASE_DELAY = float(os.environ.get("RETRY_BASE_DELAY", '0.2'))
+RETRY_MAX_DELAY = float(os.environ.get("RETRY_MAX_DELAY", '2'))
+RETRY_BUDGET_RATIO = float(os.environ.get("RETRY_BUDGET_RATIO", '0.2'))
+RETRY_BUDGET_CAPACITY = float(os.environ.get("RETRY_BUDGET_CAPACITY", '10'))
+# 请求截止时间（秒），重试不会超过该时间，为 0 时不限
+REQUEST_TIMEOUT = float(os.environ.get("REQUEST_TIMEOUT", '0'))
+# 模型路由：错误率（EWMA）或首字延迟（EWMA，秒）超过阈值的模型排到备选模型之后，为 0 时不按延迟判断
+MODEL_ERROR_THRESHOLD = float(os.environ.get("MODEL_ERROR_THRESHOLD", '0.5'))
+MODEL_SLOW_TTFT = float(os.environ.get("MODEL_SLOW_TTFT", '15'))
+# 异常模型超过该时间（秒）没有新数据时重新放行
+MODEL_RECOVERY_SECONDS = float(os.environ.get("MODEL_RECOVERY_SECONDS", '60'))
+# 批量导入账号时同时进行的登录流程数
+LOGIN_CONCURRENCY = int(os.environ.get("LOGIN_CONCURRENCY", '8'))
@@ -0,0 +1,74 @@
+import contextvars
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+from .config import REQUEST_TIMEOUT
+from .errors import HighlightError
+
+# 当前请求的截止时间（time.monotonic），None 表示不限
+_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("request_deadline", default=None)
+
+# 读取客户端超时的请求头（秒），X-Stainless-Timeout 由 OpenAI 官方 SDK 自动发送
+TIMEOUT_HEADERS = ("X-Request-Timeout", "X-Stainless-Timeout")
+
+
+def resolve_timeout(headers, key_timeout: Optional[float] = None) -> Optional[float]:
+    """请求超时：请求头 > API Key 中的默认值 > REQUEST_TIMEOUT，都没有时不限"""
+    for name in TIMEOUT_HEADERS:
+        value = headers.get(name)
+        if value:
+            try:
+                timeout = float(value)
+            except ValueError:
+                continue
+            if timeout > 0:
+                return timeout
+    if key_timeout and key_timeout > 0:
+        return key_timeout
+    return REQUEST_TIMEOUT if REQUEST_TIMEOUT > 0 else None
+
+
+@contextmanager
+def deadline_scope(timeout: Optional[float]):
+    """在该上下文内设置请求截止时间，已有更早的截止时间时保留更早的；timeout 为空或不大于 0 时不限"""
+    deadline = _deadline.get()
+    if timeout and timeout > 0:
+        candidate = time.monotonic() + timeout
+        deadline = candidate if deadline is None else min(deadline, candidate)
+    token = _deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def current_deadline() -> Optional[float]:
+    return _deadline.get()
+
+
+def time_remaining() -> Optional[float]:
+    """距截止时间的剩余秒数（可能为负），没有截止时间时返回 None"""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def deadline_exceeded() -> bool:
+    remaining = time_remaining()
+    return remaining is not None and remaining <= 0
+
+
+def deadline_error() -> HighlightError:
+    return HighlightError(504, 'Request deadline exceeded', 504)
+
+
+def stage_timeout(default: float) -> float:
+    """单个上游调用的超时：取固定超时与剩余时间中较小的一个，已超时时直接失败"""
+    remaining = time_remaining()
+    if remaining is None:
+        return default
+    if remaining <= 0:
+        raise deadline_error()
+    return min(default, remaining)
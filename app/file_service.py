@@ -9,6 +9,9 @@ from filetype import filetype
 from loguru import logger
 
 from .config import HIGHLIGHT_BASE_URL, USER_AGENT, TLS_VERIFY
+from .deadline import stage_timeout
+from .http_client import get_session
+from .image_service import normalize_image_bytes
 from .models import Message
 
 # 缓存文件上传信息，结构: { sha256: {"fileName": str, "fileId": str} }
@@ -17,7 +20,7 @@ file_upload_cache: Dict[str, Dict[str, str]] = {}
 
 async def download_image(url: str) -> bytes:
     """下载图片数据（bytes）"""
-    async with AsyncSession(verify=TLS_VERIFY, timeout=30.0) as client:
+    async with AsyncSession(verify=TLS_VERIFY, timeout=stage_timeout(30.0)) as client:
         resp = await client.get(url)
         resp.raise_for_status()
         return resp.content
@@ -53,15 +56,15 @@ async def prepare_file_upload(
         "User-Agent": USER_AGENT,
     }
     json_data = {"name": file_name, "type": mime_type, "size": file_size}
-    async with AsyncSession(verify=TLS_VERIFY, timeout=30.0, impersonate='chrome', proxy=proxy) as client:
-        resp = await client.post(url, headers=headers, json=json_data)
-        resp.raise_for_status()
-        data = resp.json()
-        if not data.get("success") or "data" not in data:
-            raise ValueError("文件准备接口返回失败")
+    client = get_session(proxy)
+    resp = await client.post(url, headers=headers, json=json_data, timeout=stage_timeout(30.0))
+    resp.raise_for_status()
+    data = resp.json()
+    if not data.get("success") or "data" not in data:
+        raise ValueError("文件准备接口返回失败")
 
-        logger.debug(f'{file_size}{data}')
-        return data["data"]
+    logger.debug(f'{file_size}{data}')
+    return data["data"]
 
 
 async def upload_file_to_url(upload_url: str, file_bytes: bytes, access_token: str) -> None:
@@ -71,12 +74,12 @@ async def upload_file_to_url(upload_url: str, file_bytes: bytes, access_token: s
         "Content-Type": "application/octet-stream",
         "User-Agent": USER_AGENT,
     }
-    async with AsyncSession(verify=TLS_VERIFY, timeout=60.0, impersonate='chrome') as client:
-        resp = await client.put(upload_url, data=file_bytes, headers=headers)
-        resp.raise_for_status()
-        data = resp.json()
-        if not data.get("success"):
-            raise ValueError(f"上传文件失败 {resp.text}")
+    client = get_session()
+    resp = await client.put(upload_url, data=file_bytes, headers=headers, timeout=stage_timeout(60.0))
+    resp.raise_for_status()
+    data = resp.json()
+    if not data.get("success"):
+        raise ValueError(f"上传文件失败 {resp.text}")
 
 
 async def upload_single_image(
@@ -100,6 +103,8 @@ async def upload_single_image(
     if sha256 in file_upload_cache:
         # 缓存命中，直接返回
         return file_upload_cache[sha256]
+    # 去除元数据（需安装 pillow），开启 IMAGE_NORMALIZE 时按需缩放/重新编码，减少上传耗时
+    image_bytes = await normalize_image_bytes(image_bytes)
     # 探测图片类型及扩展名
     try:
         mime_type, ext = detect_image_type_and_extension(image_bytes)
@@ -118,13 +123,8 @@ async def upload_single_image(
     return result
 
 
-async def messages_image_upload(messages: List[Message], access_token: str, proxy: str = None) -> List[Dict[str, str]]:
-    """
-    遍历消息，上传所有图片，返回文件名和文件ID列表
-    每个元素示例：{"fileName": "...", "fileId": "..."}
-    """
-    results = []
-    # 收集所有图片url/base64
+def extract_image_urls(messages: List[Message]) -> List[str]:
+    """收集消息中所有图片url/base64"""
     images: List[str] = []
     for message in messages:
         if message.content and isinstance(message.content, list):
@@ -133,7 +133,15 @@ async def messages_image_upload(messages: List[Message], access_token: str, prox
                     url = content_item.image_url.get("url")
                     if url:
                         images.append(url)
+    return images
 
+
+async def upload_images(images: List[str], access_token: str, proxy: str = None) -> List[Dict[str, str]]:
+    """
+    上传所有图片，返回文件名和文件ID列表
+    每个元素示例：{"fileName": "...", "fileId": "..."}
+    """
+    results = []
     if not images:
         return results
 
@@ -0,0 +1,33 @@
+from typing import Dict, Optional
+
+from curl_cffi import AsyncSession
+
+from .config import TLS_VERIFY, HTTP_MAX_CLIENTS
+
+# 按代理复用的上游会话（连接池），格式：{proxy: AsyncSession}，无代理时 key 为空字符串
+# 同一会话被所有账号共用，不保存上游下发的 cookie，避免在账号之间串用
+upstream_sessions: Dict[str, AsyncSession] = {}
+
+
+def get_session(proxy: Optional[str] = None) -> AsyncSession:
+    """获取指定代理对应的复用会话，不存在时创建"""
+    key = proxy or ''
+    session = upstream_sessions.get(key)
+    if session is None:
+        session = AsyncSession(
+            verify=TLS_VERIFY,
+            impersonate='chrome',
+            proxy=proxy or None,
+            max_clients=HTTP_MAX_CLIENTS,
+            discard_cookies=True,
+        )
+        upstream_sessions[key] = session
+    return session
+
+
+async def close_sessions():
+    """关闭所有复用会话"""
+    sessions = list(upstream_sessions.values())
+    upstream_sessions.clear()
+    for session in sessions:
+        await session.close()
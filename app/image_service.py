@@ -0,0 +1,125 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from typing import Optional
+
+from loguru import logger
+
+from .config import IMAGE_NORMALIZE, IMAGE_MAX_EDGE, IMAGE_RECOMPRESS_THRESHOLD, IMAGE_FORMAT, IMAGE_QUALITY, \
+    IMAGE_WORKERS
+
+try:
+    from PIL import Image, ImageOps, ImageSequence
+except ImportError:  # pillow 为可选依赖
+    Image = None
+    ImageOps = None
+    ImageSequence = None
+
+_executor: Optional[ProcessPoolExecutor] = None
+
+# 保存时会从 img.info 沿用的元数据（JPEG/GIF 注释、XMP 等），色彩配置、透明色、帧时长等保留
+_METADATA_KEYS = ("exif", "xmp", "XML:com.adobe.xmp", "comment")
+
+
+def _drop_metadata(img):
+    for key in _METADATA_KEYS:
+        img.info.pop(key, None)
+
+
+def _encode(img, fmt: str, **params) -> bytes:
+    # 不传 exif 等参数并清掉 img.info 中的元数据，保存时不带原图的元数据
+    _drop_metadata(img)
+    for frame in params.get("append_images", ()):
+        _drop_metadata(frame)
+    output = BytesIO()
+    img.save(output, format=fmt, **params)
+    return output.getvalue()
+
+
+def _resize_animated(img, max_edge: int, fmt: str) -> bytes:
+    """逐帧缩放动图，保留每帧时长和循环次数"""
+    frames, durations = [], []
+    for frame in ImageSequence.Iterator(img):
+        durations.append(frame.info.get("duration", img.info.get("duration", 100)))
+        frame = frame.copy()
+        frame.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+        frames.append(frame)
+    params = {"loop": img.info["loop"]} if "loop" in img.info else {}
+    return _encode(frames[0], fmt, save_all=True, append_images=frames[1:], duration=durations, **params)
+
+
+def normalize_image(image_bytes: bytes, max_edge: Optional[int], threshold: Optional[int], fmt: str,
+                    quality: int) -> bytes:
+    """
+    去除图片元数据（EXIF、GPS 等）后重新保存
+    最长边超过 max_edge 时缩放（动图逐帧缩放），超过 threshold 字节时尝试按 fmt 重新编码，其余图片按原格式保存；
+    max_edge、threshold 为 None 时不缩放、不重新编码，只去除元数据
+    """
+    with Image.open(BytesIO(image_bytes)) as img:
+        # 手机拍摄的 MPO 按 JPEG 处理，只保留主图
+        src_format = "JPEG" if img.format == "MPO" else img.format
+        need_resize = max_edge is not None and max(img.size) > max_edge
+        if getattr(img, "is_animated", False) and src_format != "JPEG":
+            if need_resize:
+                return _resize_animated(img, max_edge, src_format)
+            # 动图逐帧原样保存
+            return _encode(img, src_format, save_all=True)
+
+        # 先按 EXIF 方向旋转，避免去除元数据后方向错误
+        ImageOps.exif_transpose(img, in_place=True)
+        stripped = None
+        if need_resize:
+            img.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+        else:
+            # JPEG 沿用原图的量化表，不额外损失画质
+            stripped = _encode(img, src_format, quality="keep" if img.format == "JPEG" else quality)
+            if threshold is None or len(stripped) <= threshold:
+                return stripped
+
+        if fmt == "jpeg" and img.mode not in ("RGB", "L"):
+            # JPEG 不支持透明通道，铺白底
+            img = img.convert("RGBA")
+            background = Image.new("RGB", img.size, (255, 255, 255))
+            background.paste(img, mask=img.getchannel("A"))
+            img = background
+        data = _encode(img, fmt.upper(), quality=quality, optimize=True)
+
+    if stripped is not None and len(data) >= len(stripped):
+        return stripped
+    return data
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+    return _executor
+
+
+def shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+async def normalize_image_bytes(image_bytes: bytes) -> bytes:
+    """
+    在进程池中去除图片元数据，IMAGE_NORMALIZE 开启时同时缩放/重新编码；未安装 pillow 时原样返回
+    结果不单独缓存，同一张图片上传后由 file_service 按原图哈希缓存上传结果
+    """
+    if Image is None:
+        return image_bytes
+    max_edge, threshold = (IMAGE_MAX_EDGE, IMAGE_RECOMPRESS_THRESHOLD) if IMAGE_NORMALIZE else (None, None)
+
+    loop = asyncio.get_running_loop()
+    try:
+        data = await loop.run_in_executor(
+            _get_executor(), normalize_image, image_bytes, max_edge, threshold, IMAGE_FORMAT, IMAGE_QUALITY
+        )
+    except Exception as e:
+        logger.warning(f"图片规范化失败，使用原图上传：{e}")
+        return image_bytes
+
+    logger.debug(f"图片规范化 {len(image_bytes)} -> {len(data)} bytes")
+    return data
@@ -0,0 +1,151 @@
+import asyncio
+import contextvars
+import signal
+import time
+from contextlib import contextmanager
+from typing import Dict, Any, Callable, Set, Optional
+
+from loguru import logger
+
+from .account_service import load_accounts
+from .auth import Account, get_access_token
+from .config import WARMUP_TIMEOUT, DRAIN_TIMEOUT
+from .http_client import get_session
+from .model_service import get_models
+from .proxy_service import get_account_proxy
+
+# 实例状态：ready 表示预热完成，可以接收流量；draining 表示正在排空，拒绝新的聊天请求
+app_state: Dict[str, Any] = {
+    "ready": False,
+    "draining": False,
+    "inflight": 0,
+    "warmup_started_at": None,
+    "warmup_finished_at": None,
+}
+
+# 持有后台任务的引用，避免被垃圾回收
+background_tasks: Set[asyncio.Task] = set()
+
+
+async def warm_account(account: Account) -> str:
+    """预热单个账号：打开连接池、刷新 token"""
+    proxy = get_account_proxy(account)
+    get_session(proxy)
+    return await get_access_token(account.rt, False, proxy)
+
+
+async def warmup():
+    """启动预热，完成（或超时）后将实例标记为 ready"""
+    app_state["warmup_started_at"] = int(time.time())
+    try:
+        # 加载账号时会派生 identifier 密钥并写入 API Key 缓存
+        accounts = await load_accounts()
+        logger.info(f"开始预热 {len(accounts)} 个账号")
+        results = await asyncio.wait_for(
+            asyncio.gather(*(warm_account(account) for account in accounts), return_exceptions=True),
+            WARMUP_TIMEOUT,
+        )
+        for account, result in zip(accounts, results):
+            if isinstance(result, BaseException):
+                logger.warning(f"账号 {account.email or account.user_id} 预热失败: {result}")
+                continue
+            # 模型列表全局共享，用第一个可用 token 预热一次即可
+            await get_models(result, get_account_proxy(account))
+            break
+    except asyncio.TimeoutError:
+        logger.warning(f"预热超过 {WARMUP_TIMEOUT}s，跳过剩余预热")
+    except Exception as e:
+        logger.exception(f"预热失败: {e}")
+    app_state["ready"] = True
+    app_state["warmup_finished_at"] = int(time.time())
+    logger.info("预热完成")
+
+
+def begin_inflight():
+    app_state["inflight"] += 1
+
+
+def end_inflight():
+    app_state["inflight"] -= 1
+
+
+class InflightGuard:
+    """一个进行中请求的计数，可以从处理函数转交给流式响应，release 可重复调用"""
+
+    def __init__(self):
+        self.taken = False
+        self.released = False
+        begin_inflight()
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            end_inflight()
+
+
+# 当前请求的计数，流式响应通过 take_inflight 接管
+_inflight: contextvars.ContextVar[Optional[InflightGuard]] = contextvars.ContextVar("inflight", default=None)
+
+
+@contextmanager
+def inflight_scope():
+    """在该上下文内计入进行中的请求；计数被流式响应接管时退出上下文不释放，由流结束时释放"""
+    guard = InflightGuard()
+    token = _inflight.set(guard)
+    try:
+        yield guard
+    finally:
+        _inflight.reset(token)
+        if not guard.taken:
+            guard.release()
+
+
+def take_inflight() -> InflightGuard:
+    """接管当前请求的计数（中间不会降到 0），不在 inflight_scope 内时新建一个"""
+    guard = _inflight.get()
+    if guard is None or guard.taken:
+        guard = InflightGuard()
+    guard.taken = True
+    return guard
+
+
+async def drain(on_drained: Callable[[], None]):
+    """标记为未就绪并等待进行中的请求结束（最多 DRAIN_TIMEOUT 秒），然后执行 on_drained"""
+    app_state["ready"] = False
+    app_state["draining"] = True
+    logger.info(f"开始排空，进行中的请求: {app_state['inflight']}")
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    while app_state["inflight"] > 0 and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+    if app_state["inflight"] > 0:
+        logger.warning(f"排空超时，仍有 {app_state['inflight']} 个请求未结束")
+    else:
+        logger.info("排空完成")
+    on_drained()
+
+
+def start_drain(on_drained: Callable[[], None]):
+    task = asyncio.create_task(drain(on_drained))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+
+def install_drain_handler():
+    """
+    接管 SIGTERM：先排空再交给原处理器（uvicorn 的退出逻辑）
+    需在 lifespan 启动阶段调用，此时 uvicorn 已安装好自己的信号处理器，退出时会自动恢复
+    """
+    previous_handler = signal.getsignal(signal.SIGTERM)
+    if not callable(previous_handler):
+        return
+    loop = asyncio.get_running_loop()
+
+    def handle_sigterm(signum, frame):
+        if app_state["draining"]:
+            # 再次收到 SIGTERM 时立即退出
+            previous_handler(signum, frame)
+            return
+        app_state["draining"] = True
+        loop.call_soon_threadsafe(start_drain, lambda: previous_handler(signum, frame))
+
+    signal.signal(signal.SIGTERM, handle_sigterm)
@@ -0,0 +1,241 @@
+import asyncio
+import contextvars
+import time
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Any, Optional, Deque, Tuple
+
+from loguru import logger
+
+from . import metrics
+from .deadline import time_remaining, deadline_error
+from .config import CHAT_SEMAPHORE, CHAT_CONCURRENCY_MIN, CHAT_CONCURRENCY_MAX, CHAT_CONCURRENCY_BACKOFF, \
+    CHAT_LATENCY_TOLERANCE, PRIORITY_WEIGHTS
+
+# 首字延迟的快/慢 EWMA 平滑系数，快的反映当前负载，慢的作为基线
+FAST_ALPHA = 0.3
+SLOW_ALPHA = 0.05
+# 两次降低并发之间的最短间隔（秒），避免同一批失败连续减半
+DECREASE_COOLDOWN = 1.0
+
+INTERACTIVE = "interactive"
+BATCH = "batch"
+
+# 当前请求的 (优先级, 调用方标识)，排队时按优先级加权、同一优先级内按调用方轮转
+_priority: contextvars.ContextVar[Tuple[str, str]] = contextvars.ContextVar("request_priority",
+                                                                           default=(INTERACTIVE, ''))
+# 各优先级排队中的请求数（所有账号合计）
+_waiting: Dict[str, int] = {}
+
+
+def resolve_priority(*candidates: Optional[str]) -> str:
+    """取第一个已配置的优先级（请求头 > API Key > 接口默认值）"""
+    for candidate in candidates:
+        if candidate and candidate.lower() in PRIORITY_WEIGHTS:
+            return candidate.lower()
+    return INTERACTIVE
+
+
+@contextmanager
+def request_priority(priority: str, flow: str):
+    """在该上下文内获取账号并发名额时使用指定的优先级，flow 为调用方标识（用于同优先级内公平轮转）"""
+    token = _priority.set((priority, flow))
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def _count_waiting(priority: str, delta: int):
+    _waiting[priority] = _waiting.get(priority, 0) + delta
+    metrics.set_gauge(f"queue.waiting.{priority}", _waiting[priority])
+
+
+class FairQueue:
+    """
+    加权公平排队：各优先级按 PRIORITY_WEIGHTS 的权重分配放行次数（都有积压时高权重的优先级保底获得对应份额），
+    同一优先级内按调用方轮转，单个调用方的大批量请求不会饿死其他调用方
+    """
+
+    def __init__(self):
+        # 格式：{priority: OrderedDict{flow: deque[(future, 入队时间)]}}
+        self.queues: Dict[str, "OrderedDict[str, Deque[Tuple[asyncio.Future, float]]]"] = {}
+        # 各优先级的虚拟时间，每放行一次增加 1/权重，虚拟时间最小的优先放行
+        self.vtime: Dict[str, float] = {}
+        self.clock = 0.0
+        self.size = 0
+
+    def push(self, priority: str, flow: str, waiter: asyncio.Future):
+        flows = self.queues.get(priority)
+        if not flows:
+            flows = self.queues[priority] = OrderedDict()
+            # 刚开始排队的优先级不能用空闲期间攒下的虚拟时间插队
+            self.vtime[priority] = max(self.vtime.get(priority, 0.0), self.clock)
+        flows.setdefault(flow, deque()).append((waiter, time.monotonic()))
+        self.size += 1
+        _count_waiting(priority, 1)
+
+    def pop(self) -> Optional[Tuple[asyncio.Future, str, float]]:
+        """取出下一个等待者，返回 (future, 优先级, 入队时间)"""
+        if not self.size:
+            return None
+        priority = min((p for p in self.queues if self.queues[p]),
+                       key=lambda p: (self.vtime[p], -PRIORITY_WEIGHTS.get(p, 1)))
+        self.clock = self.vtime[priority]
+        self.vtime[priority] += 1 / PRIORITY_WEIGHTS.get(priority, 1)
+        flows = self.queues[priority]
+        flow, waiters = next(iter(flows.items()))
+        waiter, enqueued_at = waiters.popleft()
+        if waiters:
+            flows.move_to_end(flow)
+        else:
+            del flows[flow]
+        self.size -= 1
+        _count_waiting(priority, -1)
+        return waiter, priority, enqueued_at
+
+    def remove(self, priority: str, flow: str, waiter: asyncio.Future):
+        waiters = self.queues.get(priority, {}).get(flow)
+        if not waiters:
+            return
+        for item in waiters:
+            if item[0] is waiter:
+                waiters.remove(item)
+                self.size -= 1
+                _count_waiting(priority, -1)
+                break
+        if not waiters:
+            del self.queues[priority][flow]
+
+    def __len__(self) -> int:
+        return self.size
+
+
+class AdaptiveLimiter:
+    """
+    单个账号的自适应并发上限（AIMD），用法与 asyncio.Semaphore 相同，名额不足时按 FairQueue 排队
+    满载时每个干净的请求让上限增加 1/上限（约每轮增加 1），
+    出现错误、疑似封号或首字延迟明显高于基线时上限乘以 CHAT_CONCURRENCY_BACKOFF，
+    上限始终在 CHAT_CONCURRENCY_MIN 与 CHAT_CONCURRENCY_MAX 之间
+    """
+
+    def __init__(self, rt: str):
+        self.rt = rt
+        self.min_limit = max(CHAT_CONCURRENCY_MIN, 1)
+        self.max_limit = max(CHAT_CONCURRENCY_MAX, self.min_limit)
+        self.limit = float(min(max(CHAT_SEMAPHORE, self.min_limit), self.max_limit))
+        self.inflight = 0
+        self.latency_fast: Optional[float] = None
+        self.latency_slow: Optional[float] = None
+        self.last_decrease_at = 0.0
+        # 最近一次放行时是否满载，只有满载时的成功才说明可以再提高上限
+        self.saturated = False
+        self._waiters = FairQueue()
+
+    @property
+    def capacity(self) -> int:
+        return int(self.limit)
+
+    async def acquire(self):
+        """获取名额，请求设置了截止时间时最多排队到截止时间，超时即移出队列，不再发起上游请求"""
+        priority, flow = _priority.get()
+        remaining = time_remaining()
+        if remaining is not None and remaining <= 0:
+            metrics.inc(f"queue.expired.{priority}")
+            raise deadline_error()
+        if self.inflight < self.capacity and not self._waiters:
+            self._grant()
+            metrics.observe(f"queue.wait_seconds.{priority}", 0.0)
+            return True
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.push(priority, flow, waiter)
+        try:
+            await asyncio.wait((waiter,), timeout=remaining)
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # 已分配名额但调用方被取消，归还名额
+                self.release()
+            else:
+                self._waiters.remove(priority, flow, waiter)
+            raise
+        if not waiter.done():
+            self._waiters.remove(priority, flow, waiter)
+            waiter.cancel()
+            metrics.inc(f"queue.expired.{priority}")
+            raise deadline_error()
+        return True
+
+    def _grant(self):
+        self.inflight += 1
+        self.saturated = self.inflight >= self.capacity
+
+    def release(self):
+        self.inflight -= 1
+        self._wake()
+
+    def _wake(self):
+        while self._waiters and self.inflight < self.capacity:
+            waiter, priority, enqueued_at = self._waiters.pop()
+            if not waiter.done():
+                self._grant()
+                metrics.observe(f"queue.wait_seconds.{priority}", time.monotonic() - enqueued_at)
+                waiter.set_result(True)
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+    def record_success(self, latency: Optional[float] = None):
+        """请求成功，latency 为首字延迟（秒），没有时只按成功计"""
+        if latency is not None:
+            if self.latency_fast is None:
+                self.latency_fast = self.latency_slow = latency
+            else:
+                self.latency_fast = (1 - FAST_ALPHA) * self.latency_fast + FAST_ALPHA * latency
+                self.latency_slow = (1 - SLOW_ALPHA) * self.latency_slow + SLOW_ALPHA * latency
+            if self.latency_fast > self.latency_slow * CHAT_LATENCY_TOLERANCE:
+                self.decrease("latency")
+                # 从基线重新观察，同一次劣化只降一次
+                self.latency_fast = self.latency_slow
+                return
+        if self.saturated and self.limit < self.max_limit:
+            capacity = self.capacity
+            self.limit = min(self.limit + 1 / self.limit, self.max_limit)
+            if self.capacity > capacity:
+                metrics.inc("limiter.increase")
+                logger.debug(f"账号 {self.rt[:8]}... 并发上限提高到 {self.capacity}")
+                self._wake()
+
+    def record_failure(self, reason: str = "error"):
+        self.decrease(reason)
+
+    def decrease(self, reason: str):
+        now = time.monotonic()
+        if now - self.last_decrease_at < DECREASE_COOLDOWN or self.limit <= self.min_limit:
+            return
+        self.last_decrease_at = now
+        self.limit = max(self.limit * CHAT_CONCURRENCY_BACKOFF, self.min_limit)
+        self.saturated = False
+        metrics.inc("limiter.decrease")
+        logger.info(f"账号 {self.rt[:8]}... 并发上限降低到 {self.capacity}（{reason}）")
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "concurrency_limit": round(self.limit, 3),
+            "inflight": self.inflight,
+            "waiting": len(self._waiters),
+            "latency_fast": self.latency_fast,
+            "latency_slow": self.latency_slow,
+        }
+
+
+# 每个账号的并发上限，格式：{rt: AdaptiveLimiter}
+chat_lock: Dict[str, AdaptiveLimiter] = {}
+
+
+def get_chat_lock(rt: str) -> AdaptiveLimiter:
+    if rt not in chat_lock:
+        chat_lock[rt] = AdaptiveLimiter(rt)
+    return chat_lock[rt]
@@ -1,26 +1,47 @@
+import asyncio
 import base64
 import json
 import re
 import uuid
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional, Tuple
 
-from curl_cffi import AsyncSession
 from loguru import logger
 
-from .config import HIGHLIGHT_BASE_URL, TLS_VERIFY
+from identifier import Th
+from .account_service import save_accounts
+from .auth import build_account, parse_api_key
+from .config import HIGHLIGHT_BASE_URL, PROXY, LOGIN_CONCURRENCY
+from .http_client import get_session
+from .proxy_service import proxy_pool, proxy_assignments, rank_pool_proxies, save_proxy_assignments
 
+LOGIN_TIMEOUT = 30.0
 
-async def process_highlight_login(login_link: str, proxy=None) -> Dict[str, Any]:
-    """处理 Highlight 登录流程"""
+
+def pick_login_proxies(proxy: Optional[str], count: int) -> List[Tuple[Optional[str], bool]]:
+    """
+    为 count 个待登录账号选择代理，返回 [(代理, 是否来自代理池)]
+    未指定代理时从代理池按延迟排序轮流分配（来自代理池的代理不写入 API Key），没有代理池时使用全局 PROXY
+    """
+    if proxy:
+        return [(proxy, False)] * count
+    if proxy_pool:
+        ranked = rank_pool_proxies()
+        return [(ranked[i % len(ranked)], True) for i in range(count)]
+    return [(PROXY or None, False)] * count
+
+
+async def process_highlight_login(login_link: str, proxy=None, embed_proxy: bool = True) -> Dict[str, Any]:
+    """处理 Highlight 登录流程，同一代理的登录请求复用上游连接池"""
     try:
         # 提取 code
-        code_match = re.search(r'code=(.+)', login_link)
+        code_match = re.search(r'code=(.+)', login_link.strip())
         if not code_match:
             raise ValueError("无法从链接中提取 code")
 
         code = code_match.group(1)
         chrome_device_id = str(uuid.uuid4())
         device_id = str(uuid.uuid4())
+        client = get_session(proxy)
 
         # 第一步：交换 token
         headers = {'Content-Type': 'application/json'}
@@ -29,69 +50,71 @@ async def process_highlight_login(login_link: str, proxy=None) -> Dict[str, Any]
             'amplitudeDeviceId': chrome_device_id,
         }
 
-        async with AsyncSession(verify=TLS_VERIFY, timeout=30.0, impersonate='chrome', proxy=proxy) as client:
-            response = await client.post(
-                f'{HIGHLIGHT_BASE_URL}/api/v1/auth/exchange',
-                headers=headers,
-                json=json_data
-            )
-
-            if response.status_code != 200:
-                raise ValueError(f'登录失败 {response.status_code} {response.text}')
+        response = await client.post(
+            f'{HIGHLIGHT_BASE_URL}/api/v1/auth/exchange',
+            headers=headers,
+            json=json_data,
+            timeout=LOGIN_TIMEOUT,
+        )
 
-            result = response.json()
-            if not result.get('success'):
-                raise ValueError(f'登录失败 {result}')
-
-            at = result['data']['accessToken']
-            rt = result['data']['refreshToken']
-
-            # 第二步：注册客户端
-            headers = {
-                'Content-Type': 'application/json',
-                'authorization': f'Bearer {at}'
-            }
+        if response.status_code != 200:
+            raise ValueError(f'登录失败 {response.status_code} {response.text}')
 
-            json_data = {"client_uuid": device_id}
+        result = response.json()
+        if not result.get('success'):
+            raise ValueError(f'登录失败 {result}')
 
-            await client.post(
-                f'{HIGHLIGHT_BASE_URL}/api/v1/users/me/client',
-                headers=headers,
-                json=json_data
-            )
+        at = result['data']['accessToken']
+        rt = result['data']['refreshToken']
 
-            # 第三步：获取用户信息
-            response = await client.get(
-                f'{HIGHLIGHT_BASE_URL}/api/v1/auth/profile',
-                headers=headers
-            )
-
-            if response.status_code != 200:
-                raise ValueError(f'获取用户信息失败 {response.status_code}')
+        # 第二步：注册客户端
+        headers = {
+            'Content-Type': 'application/json',
+            'authorization': f'Bearer {at}'
+        }
 
-            profile = response.json()
-            user_id = profile['id']
-            email = profile['email']
+        json_data = {"client_uuid": device_id}
+
+        await client.post(
+            f'{HIGHLIGHT_BASE_URL}/api/v1/users/me/client',
+            headers=headers,
+            json=json_data,
+            timeout=LOGIN_TIMEOUT,
+        )
+
+        # 第三步：获取用户信息
+        response = await client.get(
+            f'{HIGHLIGHT_BASE_URL}/api/v1/auth/profile',
+            headers=headers,
+            timeout=LOGIN_TIMEOUT,
+        )
+
+        if response.status_code != 200:
+            raise ValueError(f'获取用户信息失败 {response.status_code}')
+
+        profile = response.json()
+        user_id = profile['id']
+        email = profile['email']
+
+        # 生成 API Key
+        data = json.dumps({
+            'rt': rt,
+            'user_id': user_id,
+            'email': email,
+            'client_uuid': device_id,
+            'proxy': proxy if embed_proxy else None
+        })
+        api_key = base64.urlsafe_b64encode(data.encode('utf-8')).decode('utf-8')
 
-            # 生成 API Key
-            data = json.dumps({
-                'rt': rt,
+        return {
+            'success': True,
+            'api_key': api_key,
+            'user_info': {
                 'user_id': user_id,
                 'email': email,
-                'client_uuid': device_id,
-                'proxy': proxy
-            })
-            api_key = base64.urlsafe_b64encode(data.encode('utf-8')).decode('utf-8')
-
-            return {
-                'success': True,
-                'api_key': api_key,
-                'user_info': {
-                    'user_id': user_id,
-                    'email': email,
-                    'client_uuid': device_id
-                }
+                'client_uuid': device_id
             }
+        }
 
     except Exception as e:
         logger.error(f"登录处理失败: {str(e)}")
@@ -99,3 +122,42 @@ async def process_highlight_login(login_link: str, proxy=None) -> Dict[str, Any]
             'success': False,
             'error': str(e)
         }
+
+
+async def bulk_login(login_links: List[str], proxy: Optional[str] = None, concurrency: int = LOGIN_CONCURRENCY,
+                     save: bool = True) -> List[Dict[str, Any]]:
+    """
+    批量登录：最多 concurrency 个登录流程并发执行，返回与 login_links 顺序一致的结果
+    成功的账号预先派生 identifier 密钥，save 为 True 时写入 ./config/accounts.json 并立即加入账号池
+    """
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+    proxies = pick_login_proxies(proxy, len(login_links))
+
+    async def login_one(login_link: str, link_proxy: Optional[str], pooled: bool) -> Dict[str, Any]:
+        async with semaphore:
+            result = await process_highlight_login(login_link, link_proxy, embed_proxy=not pooled)
+            if result['success']:
+                # 与加载 accounts.json 时相同，PBKDF2 派生放到线程池中
+                identifier_key = await asyncio.to_thread(Th, result['user_info']['user_id'])
+                result['account'] = build_account(parse_api_key(result['api_key']), identifier_key)
+            return result
+
+    results = await asyncio.gather(*(
+        login_one(login_link, link_proxy, pooled)
+        for login_link, (link_proxy, pooled) in zip(login_links, proxies)
+    ))
+
+    succeeded = []
+    for (link_proxy, pooled), result in zip(proxies, results):
+        account = result.pop('account', None)
+        if account is None:
+            continue
+        succeeded.append((result['api_key'], account))
+        if pooled:
+            proxy_assignments[account.user_id] = link_proxy
+    if any(pooled for _, pooled in proxies) and succeeded:
+        save_proxy_assignments()
+    if save and succeeded:
+        save_accounts(succeeded)
+    logger.info(f"批量登录完成: 成功 {len(succeeded)} 个，失败 {len(results) - len(succeeded)} 个")
+    return [dict(result, index=i) for i, result in enumerate(results)]
@@ -0,0 +1,38 @@
+from typing import Dict, Any
+
+# 计数器，格式：{name: value}
+counters: Dict[str, float] = {}
+# 瞬时值，格式：{name: value}
+gauges: Dict[str, float] = {}
+# 耗时/数值分布，格式：{name: {"count": int, "sum": float, "max": float, "last": float}}
+observations: Dict[str, Dict[str, float]] = {}
+
+
+def inc(name: str, value: float = 1):
+    counters[name] = counters.get(name, 0) + value
+
+
+def set_gauge(name: str, value: float):
+    gauges[name] = value
+
+
+def observe(name: str, value: float):
+    entry = observations.get(name)
+    if entry is None:
+        entry = observations[name] = {"count": 0, "sum": 0.0, "max": 0.0, "last": 0.0}
+    entry["count"] += 1
+    entry["sum"] += value
+    entry["last"] = value
+    if value > entry["max"]:
+        entry["max"] = value
+
+
+def snapshot() -> Dict[str, Any]:
+    return {
+        "counters": dict(counters),
+        "gauges": dict(gauges),
+        "observations": {
+            name: {**entry, "avg": entry["sum"] / entry["count"] if entry["count"] else 0.0}
+            for name, entry in observations.items()
+        },
+    }
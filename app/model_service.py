@@ -1,10 +1,16 @@
-from typing import Dict, Any
+import json
+import time
+from pathlib import Path
+from typing import Dict, Any, List, Optional, Tuple
 
-from curl_cffi import AsyncSession
 from curl_cffi.requests.exceptions import RequestException
 from fastapi import HTTPException
+from loguru import logger
 
-from .config import HIGHLIGHT_BASE_URL, USER_AGENT, TLS_VERIFY
+from .config import HIGHLIGHT_BASE_URL, USER_AGENT, MODEL_ERROR_THRESHOLD, MODEL_SLOW_TTFT, MODEL_RECOVERY_SECONDS
+from .deadline import stage_timeout
+from .http_client import get_session
+from .proxy_service import record_proxy_success, record_proxy_failure
 
 # 模型缓存，格式：{model_name: {"id": str, "name": str, "provider": str, "isFree": bool}}
 model_cache: Dict[str, Dict[str, Any]] = {}
@@ -12,41 +18,45 @@ model_cache: Dict[str, Dict[str, Any]] = {}
 
 async def fetch_models_from_upstream(access_token: str, proxy: str | None) -> Dict[str, Dict[str, Any]]:
     """从上游获取模型列表"""
-    async with AsyncSession(verify=TLS_VERIFY, timeout=30.0, impersonate='chrome', proxy=proxy) as client:
-        try:
-            response = await client.get(
-                f"{HIGHLIGHT_BASE_URL}/api/v1/models",
-                headers={
-                    "Authorization": f"Bearer {access_token}",
-                    "User-Agent": USER_AGENT,
-                    'api-version': '2025-07-22'
-                },
-            )
-
-            if response.status_code != 200:
-                raise HTTPException(status_code=500, detail="获取模型列表失败")
-
-            resp_json = response.json()
-            if not resp_json.get("success"):
-                raise HTTPException(status_code=500, detail="获取模型数据失败")
-
-            # 清空并重新填充缓存
-            model_cache.clear()
-            for model in resp_json["data"]:
-                model_name = model["name"]
-                model_cache[model_name] = {
-                    "id": model["id"],
-                    "name": model["name"],
-                    "provider": model["provider"],
-                    "isFree": model.get("pricing", {}).get("isFree", False),
-                }
-
-            return model_cache
-
-        except RequestException as e:
-            raise HTTPException(status_code=500, detail=f"获取模型列表失败: {str(e)}")
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"获取模型列表失败: {str(e)}")
+    client = get_session(proxy)
+    start = time.monotonic()
+    try:
+        response = await client.get(
+            f"{HIGHLIGHT_BASE_URL}/api/v1/models",
+            headers={
+                "Authorization": f"Bearer {access_token}",
+                "User-Agent": USER_AGENT,
+                'api-version': '2025-07-22'
+            },
+            timeout=stage_timeout(30.0),
+        )
+        record_proxy_success(proxy, time.monotonic() - start)
+
+        if response.status_code != 200:
+            raise HTTPException(status_code=500, detail="获取模型列表失败")
+
+        resp_json = response.json()
+        if not resp_json.get("success"):
+            raise HTTPException(status_code=500, detail="获取模型数据失败")
+
+        # 清空并重新填充缓存
+        model_cache.clear()
+        for model in resp_json["data"]:
+            model_name = model["name"]
+            model_cache[model_name] = {
+                "id": model["id"],
+                "name": model["name"],
+                "provider": model["provider"],
+                "isFree": model.get("pricing", {}).get("isFree", False),
+            }
+
+        return model_cache
+
+    except RequestException as e:
+        record_proxy_failure(proxy)
+        raise HTTPException(status_code=500, detail=f"获取模型列表失败: {str(e)}")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"获取模型列表失败: {str(e)}")
 
 
 async def get_models(access_token: str, proxy: str = None) -> Dict[str, Dict[str, Any]]:
@@ -55,3 +65,103 @@ async def get_models(access_token: str, proxy: str = None) -> Dict[str, Dict[str
         # 缓存为空，从上游获取
         return await fetch_models_from_upstream(access_token, proxy)
     return model_cache
+
+
+MODEL_ALIASES_PATH = Path('./config/model_aliases.json')
+
+# EWMA 平滑系数
+EWMA_ALPHA = 0.2
+
+# 模型别名，格式：{alias: [model_name, ...]}，按优先顺序排列
+model_aliases: Dict[str, List[str]] = {}
+
+
+class ModelStats:
+    """单个上游模型的滚动统计：首字延迟与错误率（EWMA）"""
+
+    def __init__(self, model: str):
+        self.model = model
+        self.ttft_ewma: Optional[float] = None
+        self.error_rate = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.fallbacks = 0
+        self.updated_at = 0.0
+
+    def record_success(self, ttft: Optional[float] = None):
+        self.requests += 1
+        self.error_rate = (1 - EWMA_ALPHA) * self.error_rate
+        if ttft is not None:
+            self.ttft_ewma = ttft if self.ttft_ewma is None else (1 - EWMA_ALPHA) * self.ttft_ewma + EWMA_ALPHA * ttft
+        self.updated_at = time.monotonic()
+
+    def record_failure(self):
+        self.requests += 1
+        self.failures += 1
+        self.error_rate = (1 - EWMA_ALPHA) * self.error_rate + EWMA_ALPHA
+        self.updated_at = time.monotonic()
+
+    @property
+    def degraded(self) -> bool:
+        """
+        错误率或首字延迟超过阈值时视为异常，路由时排到备选模型之后
+        异常模型长时间没有新数据时重新放行，由真实请求验证是否恢复
+        """
+        if time.monotonic() - self.updated_at > MODEL_RECOVERY_SECONDS:
+            return False
+        if self.error_rate >= MODEL_ERROR_THRESHOLD:
+            return True
+        return bool(MODEL_SLOW_TTFT) and self.ttft_ewma is not None and self.ttft_ewma >= MODEL_SLOW_TTFT
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "model": self.model,
+            "degraded": self.degraded,
+            "ttft_ewma": self.ttft_ewma,
+            "error_rate": round(self.error_rate, 4),
+            "requests": self.requests,
+            "failures": self.failures,
+            "fallbacks": self.fallbacks,
+        }
+
+
+# 模型统计，格式：{model_name: ModelStats}
+model_stats: Dict[str, ModelStats] = {}
+
+
+def get_model_stats(model: str) -> ModelStats:
+    stats = model_stats.get(model)
+    if stats is None:
+        stats = model_stats[model] = ModelStats(model)
+    return stats
+
+
+def load_model_aliases():
+    model_aliases.clear()
+    if not MODEL_ALIASES_PATH.is_file():
+        return
+    with open(MODEL_ALIASES_PATH, 'r', encoding='utf-8') as f:
+        for alias, candidates in json.load(f).items():
+            if isinstance(candidates, str):
+                candidates = [candidates]
+            model_aliases[alias] = [c for c in candidates if isinstance(c, str) and c]
+    if model_aliases:
+        logger.info(f"加载模型别名 {len(model_aliases)} 个")
+
+
+def rank_model_candidates(model: str) -> List[str]:
+    """别名展开为候选模型，保持配置顺序，异常的模型排到最后；非别名直接返回自身"""
+    candidates = model_aliases.get(model) or [model]
+    healthy = [c for c in candidates if not get_model_stats(c).degraded]
+    return healthy + [c for c in candidates if c not in healthy]
+
+
+async def fetch_model_candidates(model: str, access_token: str, proxy=None) -> List[Tuple[str, str]]:
+    """模型名（或别名）转换为按路由顺序排列的 [(模型名, 上游模型 ID)]"""
+    models = await get_models(access_token, proxy)
+    candidates = [(name, models[name]["id"]) for name in rank_model_candidates(model) if name in models]
+    if not candidates:
+        raise HTTPException(
+            status_code=400, detail=f"Model '{model}' not found"
+        )
+    return candidates
@@ -53,15 +53,21 @@ class OpenAITool(BaseModel):
     function: OpenAIToolFunction = Field(description="函数定义")
 
 
+class StreamOptions(BaseModel):
+    include_usage: bool | None = Field(False, description="是否在流式响应的最后一个分片中返回用量")
+
+
 class ChatCompletionRequest(BaseModel):
     messages: List[Message]
     stream: Optional[bool] = False
+    stream_options: StreamOptions | None = Field(None, description="流式响应选项")
     model: Optional[str] = "gpt-4o"
     tools: list[OpenAITool] | None = Field(None, description="可用工具定义")
     max_tokens: Optional[int] = Field(
         None,
         description="最大输出token数，不传则使用服务端默认"
     )
+    n: Optional[int] = Field(1, ge=1, description="生成的回复数量，多个回复并行请求上游")
 
 
 class LoginRequest(BaseModel):
@@ -69,6 +75,13 @@ class LoginRequest(BaseModel):
     proxy: str | None = Field(description="使用的代理", default=None)
 
 
+class BulkLoginRequest(BaseModel):
+    login_links: List[str] = Field(description="登录链接列表，格式同 login_link")
+    proxy: str | None = Field(description="使用的代理，为空时从代理池轮流分配", default=None)
+    concurrency: int | None = Field(description="同时进行的登录数，为空时使用 LOGIN_CONCURRENCY", default=None)
+    save: bool = Field(description="是否写入 ./config/accounts.json 并加入账号池", default=True)
+
+
 class LoginResponse(BaseModel):
     success: bool
     message: str
@@ -0,0 +1,51 @@
+import asyncio
+import inspect
+import time
+from typing import Dict, Any, Callable, List, NamedTuple, Tuple
+
+from . import metrics
+
+
+class Stage(NamedTuple):
+    """请求准备阶段：依赖的阶段结果按顺序作为参数传入 func，func 可以是同步或异步函数"""
+    name: str
+    func: Callable
+    deps: Tuple[str, ...] = ()
+
+
+async def run_stages(stages: List[Stage]) -> Tuple[Dict[str, Any], Dict[str, float]]:
+    """
+    按依赖关系并发执行各阶段，stages 需按依赖顺序声明
+    返回 (各阶段结果, 各阶段耗时ms)，任一阶段失败时取消其余阶段并抛出异常
+    """
+    tasks: Dict[str, asyncio.Task] = {}
+    timings: Dict[str, float] = {}
+
+    async def run(stage: Stage):
+        args = [await tasks[dep] for dep in stage.deps]
+        start = time.perf_counter()
+        result = stage.func(*args)
+        if inspect.isawaitable(result):
+            result = await result
+        timings[stage.name] = (time.perf_counter() - start) * 1000
+        metrics.observe(f"prepare.{stage.name}_ms", timings[stage.name])
+        return result
+
+    start = time.perf_counter()
+    for stage in stages:
+        tasks[stage.name] = asyncio.create_task(run(stage))
+    try:
+        results = await asyncio.gather(*tasks.values())
+    except BaseException:
+        for task in tasks.values():
+            task.cancel()
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+        raise
+    timings["total"] = (time.perf_counter() - start) * 1000
+    metrics.observe("prepare.total_ms", timings["total"])
+    return dict(zip(tasks.keys(), results)), timings
+
+
+def format_server_timing(timings: Dict[str, float]) -> str:
+    """格式化为 Server-Timing 响应头"""
+    return ", ".join(f"{name};dur={duration:.1f}" for name, duration in timings.items())
@@ -0,0 +1,233 @@
+import asyncio
+import json
+import time
+from pathlib import Path
+from typing import Dict, Any, Optional, List
+from urllib.parse import urlsplit, urlunsplit
+
+from curl_cffi.requests.exceptions import RequestException
+from loguru import logger
+
+from .config import FALLBACK_PROXIES, PROXY_FAILURE_THRESHOLD, PROXY_OPEN_SECONDS, PROXY_MAX_OPEN_SECONDS, PROXY, \
+    HIGHLIGHT_BASE_URL, PROXY_PROBE_INTERVAL
+from .errors import HighlightError
+from .http_client import get_session
+
+PROXY_POOL_PATH = Path('./config/proxies.json')
+PROXY_ASSIGNMENTS_PATH = Path('./config/proxy_assignments.json')
+
+# EWMA 平滑系数
+EWMA_ALPHA = 0.2
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class ProxyHealth:
+    """单个代理的健康状态与熔断器"""
+
+    def __init__(self, proxy: str):
+        self.proxy = proxy
+        self.state = CLOSED
+        self.latency_ewma: Optional[float] = None
+        self.error_rate = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.cloudflare_hits = 0
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.open_seconds = PROXY_OPEN_SECONDS
+        self.probing = False
+        self.probe_started_at = 0.0
+
+    @property
+    def score(self) -> float:
+        """健康分，越高越好：综合错误率、延迟和 Cloudflare 命中"""
+        latency = self.latency_ewma or 0.0
+        score = (1 - self.error_rate) / (1 + latency)
+        if self.state != CLOSED:
+            score = 0.0
+        return round(score, 4)
+
+    def allow_request(self) -> bool:
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN and time.monotonic() - self.opened_at >= self.open_seconds:
+            # 冷却结束，放行一个探测请求
+            self.state = HALF_OPEN
+            self.probing = False
+        if self.state == HALF_OPEN and (not self.probing or time.monotonic() - self.probe_started_at > PROXY_OPEN_SECONDS):
+            # 同一时间只放行一个探测请求，探测结果丢失时超时后重新放行
+            self.probing = True
+            self.probe_started_at = time.monotonic()
+            return True
+        return False
+
+    def record_success(self, latency: float):
+        self.requests += 1
+        self.consecutive_failures = 0
+        self.error_rate = (1 - EWMA_ALPHA) * self.error_rate
+        self.latency_ewma = latency if self.latency_ewma is None else \
+            (1 - EWMA_ALPHA) * self.latency_ewma + EWMA_ALPHA * latency
+        if self.state != CLOSED:
+            logger.info(f"代理恢复: {mask_proxy(self.proxy)}")
+        self.state = CLOSED
+        self.probing = False
+        self.open_seconds = PROXY_OPEN_SECONDS
+
+    def record_failure(self, cloudflare: bool = False):
+        self.requests += 1
+        self.failures += 1
+        self.consecutive_failures += 1
+        self.error_rate = (1 - EWMA_ALPHA) * self.error_rate + EWMA_ALPHA
+        if cloudflare:
+            self.cloudflare_hits += 1
+
+        if self.state == HALF_OPEN:
+            # 探测失败，延长冷却时间
+            self.open_seconds = min(self.open_seconds * 2, PROXY_MAX_OPEN_SECONDS)
+            self.trip()
+        elif self.state == CLOSED and (cloudflare or self.consecutive_failures >= PROXY_FAILURE_THRESHOLD):
+            self.trip()
+
+    def trip(self):
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        self.probing = False
+        logger.warning(f"代理熔断 {self.open_seconds}s: {mask_proxy(self.proxy)}")
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "proxy": mask_proxy(self.proxy),
+            "state": self.state,
+            "score": self.score,
+            "latency_ewma": self.latency_ewma,
+            "error_rate": round(self.error_rate, 4),
+            "requests": self.requests,
+            "failures": self.failures,
+            "cloudflare_hits": self.cloudflare_hits,
+            "open_seconds": self.open_seconds if self.state != CLOSED else 0,
+        }
+
+
+# 代理健康状态，格式：{proxy: ProxyHealth}，直连时 key 为空字符串
+proxy_health: Dict[str, ProxyHealth] = {}
+
+
+def get_proxy_health(proxy: Optional[str]) -> ProxyHealth:
+    key = proxy or ''
+    health = proxy_health.get(key)
+    if health is None:
+        health = proxy_health[key] = ProxyHealth(key)
+    return health
+
+
+def record_proxy_success(proxy: Optional[str], latency: float):
+    get_proxy_health(proxy).record_success(latency)
+
+
+def record_proxy_failure(proxy: Optional[str], cloudflare: bool = False):
+    get_proxy_health(proxy).record_failure(cloudflare)
+
+
+def resolve_proxy(proxy: Optional[str]) -> Optional[str]:
+    """熔断器打开时切换到可用的备用代理（先备用代理，再代理池），全部不可用时快速失败"""
+    if get_proxy_health(proxy).allow_request():
+        return proxy
+    for fallback in FALLBACK_PROXIES + rank_pool_proxies():
+        if fallback != (proxy or '') and get_proxy_health(fallback).allow_request():
+            logger.debug(f"代理 {mask_proxy(proxy)} 已熔断，使用备用代理 {mask_proxy(fallback)}")
+            return fallback or None
+    raise HighlightError(503, f"Proxy unavailable: {mask_proxy(proxy)}", 503)
+
+
+# 代理池，来自 ./config/proxies.json
+proxy_pool: List[str] = []
+# 账号与代理的固定分配，格式：{user_id: proxy}，保持同一账号的上游指纹稳定
+proxy_assignments: Dict[str, str] = {}
+
+
+def load_proxy_pool():
+    """加载代理池及已有的账号分配"""
+    proxy_pool.clear()
+    proxy_assignments.clear()
+    if PROXY_POOL_PATH.is_file():
+        with open(PROXY_POOL_PATH, 'r', encoding='utf-8') as f:
+            proxy_pool.extend(p for p in json.load(f) if p)
+    if PROXY_ASSIGNMENTS_PATH.is_file():
+        with open(PROXY_ASSIGNMENTS_PATH, 'r', encoding='utf-8') as f:
+            proxy_assignments.update(json.load(f))
+    if proxy_pool:
+        logger.info(f"加载代理池 {len(proxy_pool)} 个代理，已分配账号 {len(proxy_assignments)} 个")
+
+
+def save_proxy_assignments():
+    with open(PROXY_ASSIGNMENTS_PATH, 'w', encoding='utf-8') as f:
+        json.dump(proxy_assignments, f, ensure_ascii=False, indent=4)
+
+
+def rank_pool_proxies() -> List[str]:
+    """按 EWMA 延迟排序代理池（未测过延迟的优先，以便尽快得到测量），同延迟时分配账号少的优先"""
+    assigned_counts: Dict[str, int] = {}
+    for proxy in proxy_assignments.values():
+        assigned_counts[proxy] = assigned_counts.get(proxy, 0) + 1
+
+    def sort_key(proxy: str):
+        health = get_proxy_health(proxy)
+        return health.state != CLOSED, health.latency_ewma or 0.0, assigned_counts.get(proxy, 0)
+
+    return sorted(proxy_pool, key=sort_key)
+
+
+def assign_proxy(user_id: str, proxy: str):
+    proxy_assignments[user_id] = proxy
+    save_proxy_assignments()
+
+
+def get_account_proxy(account) -> Optional[str]:
+    """
+    获取账号使用的代理
+    优先级：API Key 中的代理 > 代理池中的固定分配 > 全局 PROXY > 直连
+    """
+    if account.proxy:
+        return account.proxy
+    if proxy_pool:
+        user_id = account.user_id
+        proxy = proxy_assignments.get(user_id)
+        if proxy not in proxy_pool:
+            proxy = rank_pool_proxies()[0]
+            assign_proxy(user_id, proxy)
+            logger.info(f"账号 {user_id} 分配代理 {mask_proxy(proxy)}")
+        return proxy
+    return PROXY or None
+
+
+async def probe_proxy(proxy: str):
+    """探测代理到上游的延迟，任何 HTTP 响应都视为代理可用"""
+    start = time.monotonic()
+    try:
+        await get_session(proxy).get(HIGHLIGHT_BASE_URL, timeout=10)
+    except RequestException:
+        record_proxy_failure(proxy)
+        return
+    record_proxy_success(proxy, time.monotonic() - start)
+
+
+async def probe_proxies_forever():
+    """后台定时探测代理池"""
+    while True:
+        if proxy_pool:
+            await asyncio.gather(*(probe_proxy(proxy) for proxy in proxy_pool), return_exceptions=True)
+        await asyncio.sleep(PROXY_PROBE_INTERVAL)
+
+
+def mask_proxy(proxy: Optional[str]) -> str:
+    """隐藏代理地址中的密码"""
+    if not proxy:
+        return "direct"
+    parts = urlsplit(proxy)
+    if parts.password:
+        netloc = f"{parts.username}:***@{parts.hostname}" + (f":{parts.port}" if parts.port else "")
+        return urlunsplit((parts.scheme, netloc, parts.path, parts.query, parts.fragment))
+    return proxy
@@ -0,0 +1,221 @@
+import asyncio
+import json
+from dataclasses import dataclass, field
+from typing import Dict, Any, List, Optional, Union
+
+from fastapi import HTTPException
+from pydantic import ValidationError
+
+from .config import CHAT_STRICT_VALIDATION, BATCH_MAX_SIZE, CHAT_MAX_N
+from .file_service import extract_image_urls
+from .models import ChatCompletionRequest
+from .utils import format_messages_to_prompt, format_openai_tools
+
+try:
+    import orjson
+
+    json_loads = orjson.loads
+except ImportError:  # orjson 为可选依赖
+    json_loads = json.loads
+
+# 超过该大小的请求体在线程池中解析，避免阻塞事件循环
+PARSE_IN_THREAD_BYTES = 256 * 1024
+
+
+@dataclass(slots=True)
+class ParsedChatRequest:
+    """聊天请求中实际用到的字段，prompt/tools/image_urls 已转换为 Highlight 所需格式"""
+    model: str
+    prompt: str
+    stream: bool = False
+    include_usage: bool = False
+    max_tokens: Optional[int] = None
+    tools: List[Dict[str, Any]] = field(default_factory=list)
+    image_urls: List[str] = field(default_factory=list)
+    n: int = 1
+
+
+def _invalid(message: str):
+    raise HTTPException(status_code=422, detail=message)
+
+
+def _check_n(n: Any) -> int:
+    if n is None:
+        return 1
+    if not isinstance(n, int) or isinstance(n, bool) or n < 1:
+        _invalid("'n' must be a positive integer")
+    if n > CHAT_MAX_N:
+        _invalid(f"'n' must not exceed {CHAT_MAX_N}")
+    return n
+
+
+def parse_chat_request(body: bytes) -> ParsedChatRequest:
+    """快速解析聊天请求体"""
+    try:
+        data = json_loads(body)
+    except ValueError as e:
+        _invalid(f"Invalid JSON body: {e}")
+    return parse_chat_data(data)
+
+
+def parse_chat_data(data: Any) -> ParsedChatRequest:
+    """
+    快速解析聊天请求：只校验用到的字段，一次遍历消息同时生成提示词、收集图片
+    提示词格式与 format_messages_to_prompt 保持一致
+    """
+    if not isinstance(data, dict):
+        _invalid("Request body must be a JSON object")
+
+    messages = data.get("messages")
+    if not isinstance(messages, list):
+        _invalid("'messages' must be a list")
+
+    formatted_messages = []
+    image_urls = []
+    for message in messages:
+        if not isinstance(message, dict) or not isinstance(message.get("role"), str):
+            _invalid("Each message must be an object with a string 'role'")
+        role = message["role"]
+        if not role:
+            continue
+        content = message.get("content")
+        if content:
+            if isinstance(content, list):
+                for item in content:
+                    if not isinstance(item, dict):
+                        _invalid("Message content items must be objects")
+                    formatted_messages.append(f"{role}: {item.get('text')}")
+                    if item.get("type") == "image_url" and isinstance(item.get("image_url"), dict):
+                        url = item["image_url"].get("url")
+                        if url:
+                            image_urls.append(url)
+            elif isinstance(content, str):
+                formatted_messages.append(f"{role}: {content}")
+            else:
+                _invalid("Message 'content' must be a string or a list")
+        tool_calls = message.get("tool_calls")
+        if tool_calls:
+            formatted_messages.append(f"{role}: {json.dumps(tool_calls)}")
+        tool_call_id = message.get("tool_call_id")
+        if tool_call_id:
+            formatted_messages.append(f"{role}: tool_call_id: {tool_call_id} {content}")
+
+    tools = []
+    for tool in data.get("tools") or ():
+        if not isinstance(tool, dict) or not isinstance(tool.get("function"), dict) \
+                or not isinstance(tool["function"].get("name"), str):
+            _invalid("Each tool must have a function with a string 'name'")
+        if tool.get("type", "function") == "function":
+            function = tool["function"]
+            tools.append({
+                "name": function["name"],
+                "description": function.get("description") or "",
+                "parameters": function.get("parameters") or {},
+            })
+
+    model = data.get("model") or "gpt-4o"
+    max_tokens = data.get("max_tokens")
+    if not isinstance(model, str):
+        _invalid("'model' must be a string")
+    if max_tokens is not None and (not isinstance(max_tokens, int) or isinstance(max_tokens, bool)):
+        _invalid("'max_tokens' must be an integer")
+    stream_options = data.get("stream_options")
+
+    return ParsedChatRequest(
+        model=model,
+        prompt="\n\n".join(formatted_messages),
+        stream=bool(data.get("stream")),
+        include_usage=isinstance(stream_options, dict) and bool(stream_options.get("include_usage")),
+        max_tokens=max_tokens,
+        tools=tools,
+        image_urls=image_urls,
+        n=_check_n(data.get("n")),
+    )
+
+
+def parse_chat_request_strict(body: bytes) -> ParsedChatRequest:
+    """严格模式：完整的 Pydantic 校验"""
+    try:
+        request = ChatCompletionRequest.model_validate_json(body)
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors(include_url=False, include_context=False))
+    return _from_model(request)
+
+
+def parse_chat_data_strict(data: Any) -> ParsedChatRequest:
+    try:
+        request = ChatCompletionRequest.model_validate(data)
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors(include_url=False, include_context=False))
+    return _from_model(request)
+
+
+def _from_model(request: ChatCompletionRequest) -> ParsedChatRequest:
+    return ParsedChatRequest(
+        model=request.model,
+        prompt=format_messages_to_prompt(request.messages),
+        stream=bool(request.stream),
+        include_usage=bool(request.stream_options and request.stream_options.include_usage),
+        max_tokens=request.max_tokens,
+        tools=format_openai_tools(request.tools),
+        image_urls=extract_image_urls(request.messages),
+        n=_check_n(request.n),
+    )
+
+
+async def read_chat_request(body: bytes) -> ParsedChatRequest:
+    """解析聊天请求体，CHAT_STRICT_VALIDATION 开启时使用完整的 Pydantic 校验"""
+    parse = parse_chat_request_strict if CHAT_STRICT_VALIDATION else parse_chat_request
+    if len(body) > PARSE_IN_THREAD_BYTES:
+        return await asyncio.to_thread(parse, body)
+    return parse(body)
+
+
+def parse_batch_request(body: bytes) -> List[Union[ParsedChatRequest, HTTPException]]:
+    """
+    解析批量请求体，支持三种格式：
+    JSON 数组、{"requests": [...]} 对象、每行一个请求的 JSONL
+    单个请求解析失败时对应位置为 HTTPException
+    """
+    try:
+        data = json_loads(body)
+    except ValueError:
+        data = None
+    if isinstance(data, dict) and isinstance(data.get("requests"), list):
+        items = data["requests"]
+    elif isinstance(data, list):
+        items = data
+    else:
+        items = []
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json_loads(line))
+            except ValueError as e:
+                items.append(HTTPException(status_code=422, detail=f"Invalid JSON line: {e}"))
+
+    if not items:
+        _invalid("Batch must contain at least one request")
+    if len(items) > BATCH_MAX_SIZE:
+        _invalid(f"Batch size {len(items)} exceeds the limit of {BATCH_MAX_SIZE}")
+
+    parse = parse_chat_data_strict if CHAT_STRICT_VALIDATION else parse_chat_data
+    results = []
+    for item in items:
+        if isinstance(item, HTTPException):
+            results.append(item)
+            continue
+        try:
+            parsed = parse(item)
+        except HTTPException as e:
+            results.append(e)
+            continue
+        # 批量结果均为单个回复的非流式响应，不支持的参数直接报错而不是静默忽略
+        if parsed.stream:
+            results.append(HTTPException(status_code=400, detail="stream is not supported in batch requests"))
+        elif parsed.n > 1:
+            results.append(HTTPException(status_code=400, detail="n > 1 is not supported in batch requests"))
+        else:
+            results.append(parsed)
+    return results
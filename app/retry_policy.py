@@ -0,0 +1,130 @@
+import asyncio
+import random
+from typing import Callable, Any, Optional
+
+from curl_cffi.requests.exceptions import RequestException
+from fastapi import HTTPException
+from loguru import logger
+from starlette.responses import JSONResponse
+
+from . import metrics
+from .config import MAX_RETRIES, RETRY_BASE_DELAY, RETRY_MAX_DELAY, RETRY_BUDGET_RATIO, RETRY_BUDGET_CAPACITY
+from .deadline import time_remaining, deadline_exceeded
+from .errors import HighlightError
+from .tool_calls import MALFORMED_TOOL_CALL_STATUS
+
+# 错误分类：同一账号重试 / 换账号 / 不重试
+RETRY = "retry"
+FAILOVER = "failover"
+FATAL = "fatal"
+
+
+def classify_error(e: BaseException) -> str:
+    """
+    账号封禁、Cloudflare 拦截、限流和认证失败换账号；请求本身的错误（其他 4xx）不重试；
+    上游 5xx、空回复、网络错误等在同一账号上重试；模型输出的工具调用参数不合法时不重试；已超过请求截止时间的一律不重试
+    HTTPException 来自请求校验（4xx）或该账号的 token 刷新、模型列表获取（5xx），后者换账号
+    """
+    if deadline_exceeded():
+        return FATAL
+    if isinstance(e, RequestException):
+        return RETRY
+    if isinstance(e, HTTPException):
+        return FAILOVER if e.status_code >= 500 else FATAL
+    if not isinstance(e, HighlightError):
+        return FATAL
+    if 'HighlightAI account suspended' in e.message:
+        return FAILOVER
+    if e.response_status_code == MALFORMED_TOOL_CALL_STATUS:
+        return FATAL
+    if e.status_code in (401, 403, 429):
+        return FAILOVER
+    if 400 <= e.status_code < 500:
+        return FATAL
+    return RETRY
+
+
+class RetryBudget:
+    """
+    全局重试预算（令牌桶）：每个新请求存入 RETRY_BUDGET_RATIO 个令牌，每次重试消耗 1 个，
+    上游大面积故障时重试量最多为正常请求量的 RETRY_BUDGET_RATIO 倍，不会成倍放大上游压力
+    """
+
+    def __init__(self, ratio: float, capacity: float):
+        self.ratio = ratio
+        self.capacity = capacity
+        self.tokens = capacity
+
+    def deposit(self):
+        self.tokens = min(self.tokens + self.ratio, self.capacity)
+
+    def withdraw(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+retry_budget = RetryBudget(RETRY_BUDGET_RATIO, RETRY_BUDGET_CAPACITY)
+
+
+def backoff_delay(attempt: int) -> float:
+    """指数退避加全随机抖动，attempt 从 0 开始"""
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def should_retry(e: BaseException, attempt: int) -> Optional[float]:
+    """判断第 attempt 次（从 0 开始）失败后能否重试，可以时返回退避时间"""
+    error_class = classify_error(e)
+    if error_class != RETRY or attempt >= MAX_RETRIES:
+        return None
+    delay = backoff_delay(attempt)
+    remaining = time_remaining()
+    if remaining is not None and remaining <= delay:
+        metrics.inc("retry.deadline_skipped")
+        return None
+    if not retry_budget.withdraw():
+        metrics.inc("retry.budget_exhausted")
+        logger.warning(f"重试预算已用完，不再重试: {e}")
+        return None
+    return delay
+
+
+async def call_with_retry(func: Callable, *args, **kwargs) -> Any:
+    """调用 func，可重试的错误按退避时间重试，最终失败时抛出最后一次的异常"""
+    retry_budget.deposit()
+    attempt = 0
+    while True:
+        try:
+            return await func(*args, **kwargs)
+        except (HighlightError, RequestException) as e:
+            delay = should_retry(e, attempt)
+            if delay is None:
+                raise
+            metrics.inc("retry.attempts")
+            logger.info(f"第 {attempt + 1} 次重试，{delay:.2f}s 后: {e}")
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+class ErrorResponse(JSONResponse):
+    """错误响应，附带错误分类，调用方据此决定是否换账号"""
+
+    def __init__(self, content: Any, status_code: int, error_class: str):
+        super().__init__(content, status_code=status_code)
+        self.error_class = error_class
+
+
+def error_response(e: Exception) -> ErrorResponse:
+    if isinstance(e, HighlightError):
+        return ErrorResponse(e.to_openai_error(), e.response_status_code, classify_error(e))
+    return ErrorResponse(
+        {
+            'error': {
+                'message': str(e.detail) if isinstance(e, HTTPException) else str(e),
+                "type": "http_error",
+                "code": "http_error"
+            }
+        },
+        e.status_code if isinstance(e, HTTPException) else 500, classify_error(e)
+    )
@@ -0,0 +1,72 @@
+from fastapi import APIRouter, Depends
+from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+
+from .. import metrics
+from ..account_service import list_account_health
+from ..auth import verify_admin_key
+from ..config import LOGIN_CONCURRENCY
+from ..login_service import bulk_login
+from ..model_service import model_aliases, model_stats
+from ..models import BulkLoginRequest
+from ..proxy_service import proxy_health
+from ..stream_buffer import active_streams
+from ..usage_service import usage_ledger
+
+router = APIRouter(prefix="/admin")
+security = HTTPBearer()
+
+
+@router.get("/usage")
+async def get_usage(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """按账号/模型汇总的用量账本"""
+    await verify_admin_key(credentials)
+    return {"object": "list", "data": usage_ledger}
+
+
+@router.get("/metrics")
+async def get_metrics(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """运行指标"""
+    await verify_admin_key(credentials)
+    return metrics.snapshot()
+
+
+@router.get("/proxies")
+async def get_proxies(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """代理健康状况与熔断状态"""
+    await verify_admin_key(credentials)
+    return {"object": "list", "data": [health.to_dict() for health in proxy_health.values()]}
+
+
+@router.get("/streams")
+async def get_streams(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """进行中的流式响应及其缓冲积压"""
+    await verify_admin_key(credentials)
+    return {"object": "list", "data": [stream.to_dict() for stream in active_streams.values()]}
+
+
+@router.get("/accounts")
+async def get_accounts(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """账号池健康状态（healthy / suspected / banned / probing）及下次探测时间"""
+    await verify_admin_key(credentials)
+    return {"object": "list", "data": list_account_health()}
+
+
+@router.post("/accounts/import")
+async def import_accounts(request: BulkLoginRequest, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """批量登录并导入账号，结果顺序与 login_links 一致"""
+    await verify_admin_key(credentials)
+    results = await bulk_login(request.login_links, request.proxy, request.concurrency or LOGIN_CONCURRENCY,
+                               request.save)
+    imported = sum(1 for result in results if result['success'])
+    return {"object": "list", "imported": imported, "failed": len(results) - imported, "data": results}
+
+
+@router.get("/models")
+async def get_models_stats(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """模型别名及各模型的首字延迟、错误率（EWMA），degraded 为 true 的模型路由时排到备选模型之后"""
+    await verify_admin_key(credentials)
+    return {
+        "object": "list",
+        "aliases": model_aliases,
+        "data": [stats.to_dict() for stats in model_stats.values()],
+    }
@@ -1,19 +1,22 @@
-import asyncio
 import time
 
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Request
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
 
-from identifier import get_identifier
+from ..account_service import get_account_pool
 from ..auth import get_user_info_from_token, get_access_token
-from ..chat_service import stream_generator, non_stream_response
-from ..config import PROXY, CHAT_SEMAPHORE, DEFAULT_MAX_OUTPUT_TOKENS
+from ..batch_service import BatchRunner
+from ..completion_service import complete_chat, cancel_on_disconnect
+from ..deadline import deadline_scope, resolve_timeout
 from ..errors import HighlightError
-from ..file_service import messages_image_upload
-from ..model_service import get_models
-from ..models import ChatCompletionRequest, ModelsResponse, Model
-from ..utils import format_messages_to_prompt, format_openai_tools, safe_stream_wrapper, error_wrapper
+from ..lifecycle import app_state, inflight_scope, take_inflight
+from ..limiter import request_priority, resolve_priority, INTERACTIVE, BATCH
+from ..model_service import get_models, model_aliases
+from ..models import ModelsResponse, Model
+from ..proxy_service import resolve_proxy, get_account_proxy
+from ..request_parser import read_chat_request, parse_batch_request
 
 router = APIRouter()
 security = HTTPBearer()
@@ -22,12 +25,13 @@ security = HTTPBearer()
 @router.get("/v1/models", response_model=ModelsResponse)
 async def list_models(credentials: HTTPAuthorizationCredentials = Depends(security)):
     """返回可用模型列表"""
-    user_info = await get_user_info_from_token(credentials)
+    account = await get_user_info_from_token(credentials)
 
-    rt = user_info["rt"]
-    proxy = user_info.get("proxy")
-    if not proxy and PROXY:
-        proxy = PROXY
+    rt = account.rt
+    try:
+        proxy = resolve_proxy(get_account_proxy(account))
+    except HighlightError as e:
+        return JSONResponse(e.to_openai_error(), e.response_status_code)
     access_token = await get_access_token(rt, False, proxy)
     models = await get_models(access_token, proxy)
 
@@ -42,102 +46,86 @@ async def list_models(credentials: HTTPAuthorizationCredentials = Depends(securi
                 owned_by=model_info["provider"],
             )
         )
+    # 别名只要有一个候选模型可用就列出
+    for alias, candidates in model_aliases.items():
+        available = [models[name] for name in candidates if name in models]
+        if alias not in models and available:
+            model_list.append(
+                Model(
+                    id=alias,
+                    object="model",
+                    created=int(time.time()),
+                    owned_by=available[0]["provider"],
+                )
+            )
 
     return ModelsResponse(object="list", data=model_list)
 
 
-chat_lock: dict[str, asyncio.Semaphore] = {}
-
-
 @router.post("/v1/chat/completions")
 async def chat_completions(
-        request: ChatCompletionRequest,
+        raw_request: Request,
         credentials: HTTPAuthorizationCredentials = Depends(security),
 ):
-    """处理聊天完成请求"""
-    user_info = await get_user_info_from_token(credentials)
-
-    required_fields = ["rt", "user_id", "client_uuid"]
-    if not all(field in user_info for field in required_fields):
-        raise HTTPException(
-            status_code=401,
-            detail="Invalid authorization token - missing required fields",
-        )
-
-    rt = user_info["rt"]
-    user_id = user_info["user_id"]
-    client_uuid = user_info["client_uuid"]
-    proxy = user_info.get('proxy')
-    if not proxy and PROXY:
-        proxy = PROXY
-
-    if rt not in chat_lock:
-        chat_lock[rt] = asyncio.Semaphore(CHAT_SEMAPHORE)
-
-    async with chat_lock[rt]:
-        # 获取access token
+    """处理聊天完成请求，请求体格式见 ChatCompletionRequest"""
+    if app_state["draining"]:
+        raise HTTPException(status_code=503, detail="Server is shutting down, please retry on another instance")
+
+    # 流式响应会接管进行中计数，处理函数返回后直到流结束都计入
+    with inflight_scope():
+        account = await get_user_info_from_token(credentials)
+        request = await read_chat_request(await raw_request.body())
+        priority = resolve_priority(raw_request.headers.get("X-Priority"), account.priority, INTERACTIVE)
+        timeout = resolve_timeout(raw_request.headers, account.timeout)
+        with request_priority(priority, account.user_id), deadline_scope(timeout):
+            return await cancel_on_disconnect(raw_request, complete_chat(request, account))
+
+
+@router.post("/v1/chat/completions/batch")
+async def batch_chat_completions(
+        raw_request: Request,
+        credentials: HTTPAuthorizationCredentials = Depends(security),
+):
+    """
+    批量聊天请求，请求体为请求数组、{"requests": [...]} 或 JSONL
+    按完成顺序返回 NDJSON，每行格式：{"index": int, "status": int, "response" | "error": {...}}
+    调用方账号在 ./config/accounts.json 中时，请求在全部已知账号间分摊
+    """
+    if app_state["draining"]:
+        raise HTTPException(status_code=503, detail="Server is shutting down, please retry on another instance")
+
+    with inflight_scope():
+        account = await get_user_info_from_token(credentials)
+        requests = parse_batch_request(await raw_request.body())
+        runner = BatchRunner(get_account_pool(account))
+        priority = resolve_priority(raw_request.headers.get("X-Priority"), account.priority, BATCH)
+        timeout = resolve_timeout(raw_request.headers, account.timeout)
+        # 响应体由 generate 逐行输出，计数交给它，不在处理函数返回时释放
+        guard = take_inflight()
+
+    async def generate():
         try:
-            access_token = await get_access_token(rt, False, proxy)
-        except HighlightError as e:
-            return JSONResponse(e.to_openai_error(), e.response_status_code)
-
-        # 获取模型信息
-        models = await get_models(access_token, proxy)
-        model_info = models.get(request.model)
-        if not model_info:
-            raise HTTPException(
-                status_code=400, detail=f"Model '{request.model}' not found"
-            )
+            # 批量请求默认使用 batch 优先级，不影响交互请求的首字延迟
+            with request_priority(priority, account.user_id), deadline_scope(timeout):
+                async for line in runner.run(requests):
+                    yield line
+        finally:
+            guard.release()
 
-        model_id = model_info["id"]
-        # 将 OpenAI 格式的消息转换为单个提示
-        prompt = format_messages_to_prompt(request.messages)
-
-        # 处理tool
-        tools = format_openai_tools(request.tools)
-
-        # 处理图片
-        images = await messages_image_upload(request.messages, access_token, proxy)
-        attached_context = [
-            {
-                'type': 'image',
-                'fileId': image['fileId'],
-                'fileName': image['fileName']
-            } for image in images
-        ]
-
-        # 获取identifier
-        identifier = get_identifier(user_id, client_uuid)
-
-        # 计算最大输出token，若用户未指定则使用默认值
-        max_output_tokens = request.max_tokens or DEFAULT_MAX_OUTPUT_TOKENS
-
-        # 准备 Highlight 请求
-        highlight_data = {
-            "prompt": prompt,
-            "attachedContext": attached_context,
-            "modelId": model_id,
-            "additionalTools": tools,
-            "backendPlugins": [],
-            "useMemory": False,
-            "useKnowledge": False,
-            "ephemeral": True,
-            "timezone": "Asia/Hong_Kong",
-            "generationConfig": {
-                "maxOutputTokens": max_output_tokens
-            }
-        }
-        # logger.debug(json.dumps(highlight_data,ensure_ascii=False))
-
-        if request.stream:
-            return await error_wrapper(safe_stream_wrapper, stream_generator, highlight_data, access_token, identifier,
-                                       request.model, rt, proxy)
-        else:
-            return await error_wrapper(non_stream_response, highlight_data, access_token, identifier, request.model, rt,
-                                       proxy)
+    # 生成器没有开始就断开时 finally 不会执行，响应结束后再兜底释放一次
+    return StreamingResponse(generate(), media_type="application/x-ndjson", background=BackgroundTask(guard.release))
 
 
 @router.get("/health")
 async def health_check():
     """健康检查端点"""
     return {"status": "healthy", "timestamp": int(time.time())}
+
+
+@router.get("/ready")
+async def readiness_check():
+    """就绪检查端点，预热完成前或排空时返回 503"""
+    if not app_state["ready"]:
+        status = "draining" if app_state["draining"] else "warming_up"
+        return JSONResponse({"status": status, "timestamp": int(time.time())}, status_code=503)
+    return {"status": "ready", "timestamp": int(time.time())}
@@ -1,8 +1,8 @@
 from fastapi import APIRouter
 from fastapi.responses import HTMLResponse, FileResponse
 
-from ..config import PROXY
-from ..login_service import process_highlight_login
+from ..login_service import process_highlight_login, pick_login_proxies
+from ..proxy_service import assign_proxy
 from ..models import LoginRequest, LoginResponse
 
 router = APIRouter()
@@ -11,10 +11,11 @@ router = APIRouter()
 @router.post("/highlight_login_api", response_model=LoginResponse)
 async def highlight_login_api(request: LoginRequest):
     """Highlight 登录 API"""
-    proxy = request.proxy
-    if not proxy and PROXY:
-        proxy = PROXY
-    result = await process_highlight_login(request.login_link, proxy)
+    # 未指定代理时从代理池分配，代理不写入 API Key，由代理池固定分配给该账号
+    proxy, pooled = pick_login_proxies(request.proxy, 1)[0]
+    result = await process_highlight_login(request.login_link, proxy, embed_proxy=not pooled)
+    if result['success'] and pooled:
+        assign_proxy(result['user_info']['user_id'], proxy)
 
     if result['success']:
         return LoginResponse(
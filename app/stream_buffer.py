@@ -0,0 +1,141 @@
+import asyncio
+import itertools
+import time
+from collections import deque
+from typing import Dict, Any, AsyncGenerator, Callable, Optional, Deque, Tuple
+
+from loguru import logger
+
+from . import metrics
+from .config import STREAM_BUFFER_BYTES, STREAM_BUFFER_POLICY, STREAM_SLOW_CLIENT_TIMEOUT
+
+# 进行中的流，格式：{stream_id: StreamBuffer}
+active_streams: Dict[int, "StreamBuffer"] = {}
+
+_stream_ids = itertools.count(1)
+_total_buffered_bytes = 0
+
+
+def _add_buffered_bytes(delta: int):
+    global _total_buffered_bytes
+    _total_buffered_bytes += delta
+    metrics.set_gauge("stream.buffered_bytes", _total_buffered_bytes)
+
+
+class StreamBuffer:
+    """
+    上游读取与客户端写出之间的有界缓冲
+    上游按自身速度读入缓冲，读完即释放账号并发名额，客户端按自己的速度消费
+    超过 STREAM_BUFFER_BYTES 时按 STREAM_BUFFER_POLICY 处理：
+    disconnect 断开慢客户端，block 暂停读取上游直到客户端追上；
+    最早的未发送分片积压超过 STREAM_SLOW_CLIENT_TIMEOUT 秒时同样断开
+    """
+
+    def __init__(self, source: AsyncGenerator[Dict[str, Any], None],
+                 on_upstream_done: Optional[Callable[[], None]] = None):
+        self.id = next(_stream_ids)
+        self.started_at = time.monotonic()
+        self.buffered_bytes = 0
+        self.peak_bytes = 0
+        self.upstream_done = False
+        self.overflowed = False
+        self.error: Optional[Exception] = None
+        # [(入队时间, 分片, 字节数)]
+        self._items: Deque[Tuple[float, Dict[str, Any], int]] = deque()
+        self._source = source
+        self._on_upstream_done = on_upstream_done
+        self._readable = asyncio.Event()
+        self._writable = asyncio.Event()
+        self._task = asyncio.create_task(self._pump())
+        active_streams[self.id] = self
+
+    def _lag(self) -> float:
+        return time.monotonic() - self._items[0][0] if self._items else 0.0
+
+    async def _pump(self):
+        start = time.monotonic()
+        try:
+            async for item in self._source:
+                size = len(item.get("data", ""))
+                if STREAM_BUFFER_POLICY == "block":
+                    while self._items and self.buffered_bytes + size > STREAM_BUFFER_BYTES:
+                        self._writable.clear()
+                        await self._writable.wait()
+                self._items.append((time.monotonic(), item, size))
+                self.buffered_bytes += size
+                self.peak_bytes = max(self.peak_bytes, self.buffered_bytes)
+                _add_buffered_bytes(size)
+                self._readable.set()
+                if self.buffered_bytes > STREAM_BUFFER_BYTES or self._lag() > STREAM_SLOW_CLIENT_TIMEOUT:
+                    self.overflowed = True
+                    break
+            else:
+                # 完整读完的上游耗时，用于估算客户端断开时节省的上游时间
+                metrics.observe("stream.upstream_seconds", time.monotonic() - start)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.upstream_done = True
+            # 提前结束时关闭上游连接
+            await self._source.aclose()
+            if self._on_upstream_done:
+                self._on_upstream_done()
+            self._readable.set()
+
+    async def drain(self) -> AsyncGenerator[Dict[str, Any], None]:
+        """按客户端的速度取出缓冲中的分片"""
+        while True:
+            if self.overflowed:
+                metrics.inc("stream.slow_client_disconnects")
+                logger.warning(f"客户端消费过慢，断开流 #{self.id}（积压 {self.buffered_bytes} 字节）")
+                return
+            if self._items:
+                _, item, size = self._items.popleft()
+                self.buffered_bytes -= size
+                _add_buffered_bytes(-size)
+                self._writable.set()
+                yield item
+                continue
+            if self.upstream_done:
+                if self.error:
+                    raise self.error
+                return
+            self._readable.clear()
+            await self._readable.wait()
+
+    async def on_client_close(self, message):
+        """客户端断开时立即取消上游读取，关闭上游连接并释放账号并发名额"""
+        metrics.inc("stream.client_disconnects")
+        if self._task.done():
+            return
+        elapsed = time.monotonic() - self.started_at
+        completed = metrics.observations.get("stream.upstream_seconds")
+        if completed and completed["count"]:
+            metrics.inc("stream.upstream_seconds_saved", max(completed["sum"] / completed["count"] - elapsed, 0))
+        metrics.inc("stream.upstream_cancelled")
+        start = time.monotonic()
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        metrics.observe("stream.cancel_ms", (time.monotonic() - start) * 1000)
+        logger.info(f"客户端断开，已取消流 #{self.id} 的上游请求（已运行 {elapsed:.1f}s）")
+
+    def close(self):
+        """客户端结束或断开时调用，未读完的上游直接取消"""
+        if not self._task.done():
+            self._task.cancel()
+        if active_streams.pop(self.id, None) is not None:
+            _add_buffered_bytes(-self.buffered_bytes)
+            self.buffered_bytes = 0
+            self._items.clear()
+            metrics.observe("stream.buffer_peak_bytes", self.peak_bytes)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "age_seconds": round(time.monotonic() - self.started_at, 3),
+            "buffered_bytes": self.buffered_bytes,
+            "buffered_chunks": len(self._items),
+            "peak_bytes": self.peak_bytes,
+            "lag_seconds": round(self._lag(), 3),
+            "upstream_done": self.upstream_done,
+        }
@@ -0,0 +1,278 @@
+import json
+from typing import Dict, Any, List, Optional, Callable, Tuple
+
+from loguru import logger
+
+from .errors import HighlightError
+
+# 校验函数：返回错误描述，校验通过时返回 None
+Validator = Callable[[Any, str], Optional[str]]
+
+# 工具调用参数不合法时的响应状态码，retry_policy 按不重试处理（同一输入重新生成大概率仍不合法）
+MALFORMED_TOOL_CALL_STATUS = 422
+
+# toolUse 事件的参数格式：累计到当前的完整参数 / 增量片段
+CUMULATIVE = "cumulative"
+DELTA = "delta"
+
+_JSON_TYPES: Dict[str, Callable[[Any], bool]] = {
+    "object": lambda v: isinstance(v, dict),
+    "array": lambda v: isinstance(v, list),
+    "string": lambda v: isinstance(v, str),
+    "integer": lambda v: isinstance(v, int) and not isinstance(v, bool),
+    "number": lambda v: isinstance(v, (int, float)) and not isinstance(v, bool),
+    "boolean": lambda v: isinstance(v, bool),
+    "null": lambda v: v is None,
+}
+
+
+def could_be_json_prefix(text: str) -> bool:
+    """
+    粗略判断 text 能否是某个合法 JSON 的开头：括号配对，值与值之间必须有逗号或冒号分隔，
+    顶层值结束后不能再有内容；不校验字面量和数字的拼写
+    """
+    stack = []
+    expect_value = True
+    in_string = escaped = in_scalar = done = False
+    for ch in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == '\\':
+                escaped = True
+            elif ch == '"':
+                in_string = False
+                done = not stack
+            continue
+        if in_scalar:
+            if ch.isalnum() or ch in '+-.':
+                continue
+            in_scalar = False
+            done = not stack
+        if ch.isspace():
+            continue
+        if done:
+            return False
+        if ch in '{[':
+            if not expect_value:
+                return False
+            stack.append('}' if ch == '{' else ']')
+        elif ch in '}]':
+            if not stack or stack.pop() != ch:
+                return False
+            expect_value = False
+            done = not stack
+        elif ch in ',:':
+            if expect_value or not stack:
+                return False
+            expect_value = True
+        elif ch == '"' or ch.isalnum() or ch == '-':
+            if not expect_value:
+                return False
+            expect_value = False
+            if ch == '"':
+                in_string = True
+            else:
+                in_scalar = True
+        else:
+            return False
+    return True
+
+
+def compile_schema(schema: Any) -> Validator:
+    """
+    把 JSON Schema 编译成校验函数，只支持工具参数常用的关键字：
+    type / properties / required / additionalProperties / items / enum / const / anyOf / oneOf / allOf
+    以及数值、长度范围，其余关键字忽略
+    """
+    if not isinstance(schema, dict):
+        return lambda value, path: None
+
+    checks: List[Validator] = []
+
+    types = schema.get("type")
+    if types:
+        type_names = [types] if isinstance(types, str) else list(types)
+        type_checks = [_JSON_TYPES[t] for t in type_names if t in _JSON_TYPES]
+        if type_checks:
+            expected = "/".join(type_names)
+            checks.append(lambda v, p: None if any(c(v) for c in type_checks) else f"{p} should be {expected}")
+
+    if "enum" in schema:
+        enum = schema["enum"]
+        checks.append(lambda v, p: None if v in enum else f"{p} should be one of {enum}")
+    if "const" in schema:
+        const = schema["const"]
+        checks.append(lambda v, p: None if v == const else f"{p} should be {const!r}")
+
+    for key, op, message in (("minimum", lambda v, b: v >= b, ">="), ("maximum", lambda v, b: v <= b, "<=")):
+        if key in schema:
+            bound = schema[key]
+            checks.append(lambda v, p, b=bound, op=op, m=message:
+                          None if not _JSON_TYPES["number"](v) or op(v, b) else f"{p} should be {m} {b}")
+    for key, kind, op, message in (
+            ("minLength", str, lambda n, b: n >= b, "at least"), ("maxLength", str, lambda n, b: n <= b, "at most"),
+            ("minItems", list, lambda n, b: n >= b, "at least"), ("maxItems", list, lambda n, b: n <= b, "at most")):
+        if key in schema:
+            bound = schema[key]
+            checks.append(lambda v, p, b=bound, k=kind, op=op, m=message:
+                          None if not isinstance(v, k) or op(len(v), b) else f"{p} should have {m} {b} items")
+
+    properties = {name: compile_schema(sub) for name, sub in (schema.get("properties") or {}).items()}
+    required = [name for name in schema.get("required") or [] if isinstance(name, str)]
+    additional = schema.get("additionalProperties", True)
+    additional_check = compile_schema(additional) if isinstance(additional, dict) else None
+    if properties or required or additional is not True:
+        def check_object(v, p):
+            if not isinstance(v, dict):
+                return None
+            for name in required:
+                if name not in v:
+                    return f"{p}.{name} is required"
+            for name, item in v.items():
+                if name in properties:
+                    error = properties[name](item, f"{p}.{name}")
+                elif additional is False:
+                    error = f"{p}.{name} is not allowed"
+                elif additional_check:
+                    error = additional_check(item, f"{p}.{name}")
+                else:
+                    error = None
+                if error:
+                    return error
+            return None
+
+        checks.append(check_object)
+
+    if isinstance(schema.get("items"), dict):
+        item_check = compile_schema(schema["items"])
+
+        def check_items(v, p):
+            if not isinstance(v, list):
+                return None
+            for i, item in enumerate(v):
+                error = item_check(item, f"{p}[{i}]")
+                if error:
+                    return error
+            return None
+
+        checks.append(check_items)
+
+    for key in ("anyOf", "oneOf"):
+        if isinstance(schema.get(key), list):
+            options = [compile_schema(sub) for sub in schema[key]]
+            checks.append(lambda v, p, options=options, key=key:
+                          None if any(o(v, p) is None for o in options) else f"{p} does not match {key}")
+    if isinstance(schema.get("allOf"), list):
+        checks.extend(compile_schema(sub) for sub in schema["allOf"])
+
+    def validate(value, path):
+        for check in checks:
+            error = check(value, path)
+            if error:
+                return error
+        return None
+
+    return validate
+
+
+class ToolCallAccumulator:
+    """
+    按 toolId 累积工具调用的参数片段，每个请求创建一次，参数 schema 在创建时编译
+    一个调用结束（开始下一个调用或整个回复结束）时校验完整参数，不合法直接报错
+    """
+
+    def __init__(self, tools: Optional[List[Dict[str, Any]]]):
+        self.validators: Dict[str, Validator] = {
+            tool["name"]: compile_schema(tool.get("parameters") or {}) for tool in tools or []
+        }
+        # 格式：{key: {"index": int, "id": str, "name": str, "arguments": str}}
+        self.calls: Dict[str, Dict[str, Any]] = {}
+        self._open: Optional[str] = None
+        # 上游的参数格式，确定后本次回复的所有调用都按该格式处理，None 表示还无法判断
+        self.mode: Optional[str] = None
+
+    def add(self, tool_id: str, name: str, tool_input: Any) -> Optional[Tuple[Dict[str, Any], bool, str]]:
+        """
+        记录一个 toolUse 事件，返回 (调用, 是否新调用, 本次参数增量)，无法识别的事件返回 None
+        同一 toolId 的后续事件既可以是增量片段，也可以是累计到当前的完整参数，格式见 _fragment
+        """
+        if tool_input is None:
+            tool_input = ""
+        elif not isinstance(tool_input, str):
+            # 解析好的对象一定是完整参数
+            tool_input = json.dumps(tool_input, ensure_ascii=False)
+            self.mode = CUMULATIVE
+
+        key = tool_id or f"#{len(self.calls)}"
+        call = self.calls.get(key) if tool_id else None
+        if call is None:
+            if not name:
+                return None
+            if self._open is not None:
+                self.validate(self.calls[self._open])
+            call = self.calls[key] = {"index": len(self.calls), "id": tool_id, "name": name, "arguments": ""}
+            self._open = key
+            is_new = True
+        else:
+            is_new = False
+
+        arguments = call["arguments"]
+        fragment = self._fragment(arguments, tool_input)
+        call["arguments"] = arguments + fragment
+        return call, is_new, fragment
+
+    def _fragment(self, arguments: str, tool_input: str) -> str:
+        """
+        取出本次事件新增的参数片段
+        不以已有参数开头的一定是增量；以已有参数开头时也可能是恰好以相同内容开头的增量，
+        格式未确定前按两种解释能否构成合法 JSON 的开头来判断，两种都可能时按完整参数处理（不锁定格式）
+        """
+        if not arguments or not tool_input.startswith(arguments):
+            if arguments and self.mode is None:
+                self.mode = DELTA
+            return tool_input
+        if self.mode == DELTA:
+            return tool_input
+        if self.mode is None:
+            as_cumulative = could_be_json_prefix(tool_input)
+            as_delta = could_be_json_prefix(arguments + tool_input)
+            if as_delta and not as_cumulative:
+                self.mode = DELTA
+                return tool_input
+            if as_cumulative and not as_delta:
+                self.mode = CUMULATIVE
+        return tool_input[len(arguments):]
+
+    def validate(self, call: Dict[str, Any]):
+        arguments = call["arguments"]
+        try:
+            value = json.loads(arguments) if arguments.strip() else {}
+        except json.JSONDecodeError as e:
+            raise HighlightError(200, f"Malformed tool call '{call['name']}': invalid JSON arguments ({e})",
+                                 MALFORMED_TOOL_CALL_STATUS)
+        validator = self.validators.get(call["name"])
+        if validator is None:
+            logger.debug(f"工具 {call['name']} 不在请求的工具定义中，跳过参数校验")
+            return
+        error = validator(value, "arguments")
+        if error:
+            raise HighlightError(200, f"Malformed tool call '{call['name']}': {error}", MALFORMED_TOOL_CALL_STATUS)
+
+    def finish(self):
+        """回复结束时校验最后一个调用"""
+        if self._open is not None:
+            self.validate(self.calls[self._open])
+            self._open = None
+
+    def to_openai(self) -> List[Dict[str, Any]]:
+        return [
+            {
+                "id": call["id"],
+                "type": "function",
+                "function": {
+                    "name": call["name"],
+                    "arguments": call["arguments"],
+                },
+            } for call in self.calls.values()
+        ]
@@ -0,0 +1,94 @@
+import json
+import re
+import time
+from typing import Dict, Any, List, Optional
+
+from .models import Usage
+
+# 近似分词：CJK 字符按 1 token 计，英文单词按每 4 个字符 1 token 计，数字按每 3 位 1 token 计，其余符号各计 1 token
+_TOKEN_RE = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]|[A-Za-z]+|\d+|\S')
+_TRAILING_WORD_RE = re.compile(r'[A-Za-z\d]+$')
+
+# 用量账本，格式：{user_id: {model: {"requests": int, "prompt_tokens": int, "completion_tokens": int, "total_tokens": int, "last_used": int}}}
+usage_ledger: Dict[str, Dict[str, Dict[str, int]]] = {}
+
+
+def estimate_tokens(text: str) -> int:
+    """估算文本的 token 数"""
+    if not text:
+        return 0
+    tokens = 0
+    for piece in _TOKEN_RE.findall(text):
+        if len(piece) == 1:
+            tokens += 1
+        elif piece.isdigit():
+            tokens += (len(piece) + 2) // 3
+        else:
+            tokens += (len(piece) + 3) // 4
+    return tokens
+
+
+def estimate_prompt_tokens(prompt: str, tools: Optional[List[Dict[str, Any]]] = None) -> int:
+    """估算提示词（含工具定义）的 token 数"""
+    tokens = estimate_tokens(prompt)
+    if tools:
+        tokens += estimate_tokens(json.dumps(tools, ensure_ascii=False))
+    return tokens
+
+
+class TokenCounter:
+    """流式增量 token 计数器，跨分片的单词留到下一个分片再计，避免被拆开重复计数"""
+    __slots__ = ('tokens', '_tail')
+
+    def __init__(self):
+        self.tokens = 0
+        self._tail = ''
+
+    def add(self, text: str):
+        if not text:
+            return
+        if not isinstance(text, str):
+            text = json.dumps(text, ensure_ascii=False)
+        text = self._tail + text
+        match = _TRAILING_WORD_RE.search(text)
+        if match:
+            self._tail = match.group()
+            text = text[:match.start()]
+        else:
+            self._tail = ''
+        self.tokens += estimate_tokens(text)
+
+    @property
+    def total(self) -> int:
+        return self.tokens + estimate_tokens(self._tail)
+
+
+def build_usage(prompt_tokens: int, completion_tokens: int) -> Usage:
+    return Usage(
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        total_tokens=prompt_tokens + completion_tokens,
+    )
+
+
+def record_usage(user_id: Optional[str], model: str, usage: Usage):
+    """累计到账号/模型维度的用量账本"""
+    if not user_id:
+        return
+    entry = usage_ledger.setdefault(user_id, {}).setdefault(model, {
+        "requests": 0,
+        "prompt_tokens": 0,
+        "completion_tokens": 0,
+        "total_tokens": 0,
+        "last_used": 0,
+    })
+    entry["requests"] += 1
+    entry["prompt_tokens"] += usage.prompt_tokens
+    entry["completion_tokens"] += usage.completion_tokens
+    entry["total_tokens"] += usage.total_tokens
+    entry["last_used"] = int(time.time())
+
+
+def get_account_total_tokens(user_id: str) -> int:
+    """账号累计消耗的 token 数，可用作负载均衡权重"""
+    return sum(entry["total_tokens"] for entry in usage_ledger.get(user_id, {}).values())
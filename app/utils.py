@@ -1,14 +1,17 @@
 import base64
 import json
+import time
 from enum import Enum
 from pathlib import Path
-from typing import List, Dict, Any, Optional, Union, Callable, Set
+from typing import List, Dict, Any, Optional, Union, Callable
 
 from curl_cffi.requests.exceptions import RequestException
 from loguru import logger
 from sse_starlette import EventSourceResponse
+from starlette.background import BackgroundTask
 from starlette.responses import JSONResponse
 
+from .ban_index import BanTextIndex, BanTextMatcher, MIN_DECISIVE_SHINGLES
 from .errors import HighlightError
 from .models import Message, OpenAITool
 
@@ -54,30 +57,52 @@ def format_openai_tools(tools: Optional[List[OpenAITool]]) -> List[Dict[str, Any
 
 
 async def safe_stream_wrapper(
-        generator_func, *args, **kwargs
+        generator_func, *args, on_upstream_done: Callable[[], None] = None, **kwargs
 ) -> Union[EventSourceResponse, JSONResponse]:
     """
     安全的流响应包装器
     先执行生成器获取第一个值，如果成功才创建流响应
+    剩余的值经有界缓冲转发，上游读完后调用 on_upstream_done（用于提前释放账号并发名额）
+    流式响应接管处理函数的进行中计数，流结束（或客户端在开始前断开）时才释放，排空时等待流结束
     """
+    from .config import STREAM_SLOW_CLIENT_TIMEOUT
+    from .lifecycle import take_inflight
+    from .stream_buffer import StreamBuffer
     # 创建生成器实例
     generator = generator_func(*args, **kwargs)
 
     # 尝试获取第一个值
     first_item = await generator.__anext__()
 
-    # 如果成功获取第一个值，创建新的生成器包装原生成器
+    # 如果成功获取第一个值，后台开始读取剩余的值
+    buffer = StreamBuffer(generator, on_upstream_done)
+    guard = take_inflight()
+
+    def finish():
+        buffer.close()
+        guard.release()
+
     async def wrapped_generator():
-        # 先yield第一个值
-        yield first_item
-        # 然后yield剩余的值
-        async for item in generator:
-            yield item
+        try:
+            # 先yield第一个值
+            yield first_item
+            # 然后yield剩余的值
+            async for item in buffer.drain():
+                yield item
+        except HighlightError as e:
+            # 已经开始输出后出错，以错误事件告知客户端，而不是直接断开
+            yield {"data": json.dumps(e.to_openai_error())}
+        finally:
+            finish()
 
     # 创建流响应
     return EventSourceResponse(
         wrapped_generator(),
         media_type="text/event-stream",
+        send_timeout=STREAM_SLOW_CLIENT_TIMEOUT,
+        client_close_handler_callable=buffer.on_client_close,
+        # 生成器没有开始就断开时 finally 不会执行，响应结束后再兜底释放一次
+        background=BackgroundTask(finish),
         headers={
             "Cache-Control": "no-cache",
             "Connection": "keep-alive",
@@ -87,41 +112,12 @@ async def safe_stream_wrapper(
 
 
 async def error_wrapper(func: Callable, *args, **kwargs) -> Any:
-    from .config import MAX_RETRIES
-    for attempt in range(MAX_RETRIES + 1):  # 包含初始尝试，所以是 MAX_RETRIES + 1
-        try:
-            return await func(*args, **kwargs)
-        except (HighlightError, RequestException) as e:
-
-            if isinstance(e, HighlightError):
-                if 'HighlightAI account suspended' in e.message:
-                    return JSONResponse(
-                        e.to_openai_error(),
-                        status_code=e.response_status_code
-                    )
-
-            # 如果已经达到最大重试次数，返回错误响应
-            if attempt == MAX_RETRIES:
-                if isinstance(e, HighlightError):
-                    return JSONResponse(
-                        e.to_openai_error(),
-                        status_code=e.response_status_code
-                    )
-                elif isinstance(e, RequestException):
-                    return JSONResponse(
-                        {
-                            'error': {
-                                'message': str(e),
-                                "type": "http_error",
-                                "code": "http_error"
-                            }
-                        },
-                        status_code=500
-                    )
-
-            if attempt < MAX_RETRIES:
-                continue
-    return None
+    """按重试策略调用 func，最终失败时返回带错误分类的 JSON 错误响应"""
+    from .retry_policy import call_with_retry, error_response
+    try:
+        return await call_with_retry(func, *args, **kwargs)
+    except (HighlightError, RequestException) as e:
+        return error_response(e)
 
 
 def decode_base64url_safe(data):
@@ -190,6 +186,8 @@ class MatchResult(Enum):
 class CheckBanContent:
     _instance = None
     _initialized = False
+    # 封号文案持久化路径，基准测试时会临时指向别处
+    path = Path('./config/ban_contents.json')
     ban_contents = [
         "We've temporarily restricted access to your account due to suspicious activity. If you think this is a mistake, please reach out to us via support@highlightai.com or Discord.",
         "Our monitoring systems have detected behavior associated with policy violations, resulting in account restrictions being applied. For questions or to request a review, please contact us."
@@ -210,61 +208,113 @@ class CheckBanContent:
     def __init__(self):
         # 确保只初始化一次
         if not CheckBanContent._initialized:
-            self.ban_content_set = self.load_ban_content()
+            self.index = self.load_ban_content()
             CheckBanContent._initialized = True
 
-    def load_ban_content(self) -> Set[str]:
-        path = Path('./config/ban_contents.json')
+    def load_ban_content(self) -> BanTextIndex:
+        from .config import BAN_DEDUPE_THRESHOLD
+        path = self.path
         if not path.is_file():
             with open(path, 'w', encoding='utf-8') as f:
                 json.dump(self.ban_contents, f, ensure_ascii=False, indent=4)
         with open(path, 'r', encoding='utf-8') as f:
-            return set(json.load(f))  # 使用内置的 set() 而不是 Set()
+            contents = json.load(f)
+        index = BanTextIndex(BAN_DEDUPE_THRESHOLD)
+        for content in contents:
+            index.add(content)
+        if len(index) < len(contents):
+            # 历史上积累的近似重复文案合并后写回
+            logger.info(f"封号文案去重: {len(contents)} -> {len(index)}")
+            self.index = index
+            self.save_ban_content()
+        return index
 
     def save_ban_content(self):
-        path = Path('./config/ban_contents.json')
-        with open(path, 'w', encoding='utf-8') as f:
-            json.dump(list(self.ban_content_set), f, ensure_ascii=False, indent=4)
+        with open(self.path, 'w', encoding='utf-8') as f:
+            json.dump(self.index.texts, f, ensure_ascii=False, indent=4)
 
     def add_ban_content(self, content: str):
-        self.ban_content_set.add(content)
-        self.save_ban_content()
-
-    def match_string_with_set(self, content: str) -> MatchResult:
-        from .config import MATCH_SUCCESS_LEN
+        """加入新的封号文案，与已有文案近似重复时不保存"""
+        if self.index.add(content):
+            self.save_ban_content()
+        else:
+            logger.debug("封号文案与已有文案近似重复，不再保存")
+
+    def match(self, matcher: BanTextMatcher) -> MatchResult:
+        from .config import MATCH_SUCCESS_LEN, BAN_MATCH_THRESHOLD
         """
-        根据输入的字符串和字符串集合进行匹配
+        按相似度判断回复是否为封号文案
 
         Args:
-            content: 当前输入的字符串
+            matcher: 当前回复的增量匹配状态
 
         Returns:
             MatchResult: 匹配结果枚举
         """
-        # 1. 检查完全匹配（字符串完全相等）
-        for s in self.ban_content_set:
-            if content == s:
-                return MatchResult.MATCH_SUCCESS
-
-        # 2. 找出所有以content为开头的字符串
-        matching_prefixes = []
-        for s in self.ban_content_set:
-            if s.startswith(content):
-                matching_prefixes.append(s)
+        # 1. 回复还不足一个 shingle，只看是否为某条文案的开头
+        if not matcher.shingle_count:
+            if matcher.text in self.index.short_prefixes:
+                return MatchResult.NEED_MORE_CONTENT
+            return MatchResult.NO_MATCH
 
-        # 3. 如果没有任何字符串以content开头
-        if not matching_prefixes:
+        containment, coverage = matcher.best()
+        # 2. 与任何文案都没有重合
+        if not containment:
             return MatchResult.NO_MATCH
 
-        # 4. 检查是否有字符串满足长度条件（content长度 >= 目标字符串长度的50%）
-        for s in matching_prefixes:
-            if len(content) >= len(s) * MATCH_SUCCESS_LEN:
+        # 3. 回复与某条文案足够相似，且已收到该文案的 MATCH_SUCCESS_LEN 以上
+        if containment >= BAN_MATCH_THRESHOLD:
+            if coverage >= MATCH_SUCCESS_LEN:
                 return MatchResult.MATCH_SUCCESS
+            return MatchResult.NEED_MORE_CONTENT
 
-        # 5. content是多个字符串的开头，但长度都不满足50%条件
-        return MatchResult.NEED_MORE_CONTENT
+        # 4. 只有零散重合，按正常回复输出
+        return MatchResult.NO_MATCH
+
+    def match_string_with_set(self, content: str) -> MatchResult:
+        """对完整字符串做一次匹配"""
+        matcher = self.index.matcher()
+        matcher.feed(content)
+        return self.match(matcher)
 
     @classmethod
     def get_instance(cls):
         """获取单例实例的便捷方法"""
         return cls()
+
+
+class BanDetector:
+    """
+    增量封号检测，流式与非流式共用：每收到一段上游文本调用一次 feed
+    每段只对新增的 shingle 查索引，文本积累到一定长度仍不像任何封号文案时，后续分片不再匹配
+    """
+    __slots__ = ('text', 'contents', 'delays', '_last_timestamp_ms', '_settled', '_matcher')
+
+    def __init__(self):
+        self.text = ''
+        self._matcher = CheckBanContent.get_instance().index.matcher()
+        self.contents: List[str] = []
+        self.delays: List[int] = []
+        self._last_timestamp_ms: Optional[int] = None
+        self._settled = False
+
+    def feed(self, content: str) -> MatchResult:
+        now_timestamp_ms = int(time.time() * 1000)
+        if self._last_timestamp_ms:
+            self.delays.append(now_timestamp_ms - self._last_timestamp_ms)
+        self._last_timestamp_ms = now_timestamp_ms
+        self.contents.append(content)
+        self.text += content
+
+        if self._settled:
+            return MatchResult.NO_MATCH
+        self._matcher.feed(content)
+        result = CheckBanContent.get_instance().match(self._matcher)
+        # 开头几个字不同的改写文案也要能识别，积累到足够内容后才不再匹配
+        if result == MatchResult.NO_MATCH and self._matcher.shingle_count >= MIN_DECISIVE_SHINGLES:
+            self._settled = True
+        return result
+
+    def check_delay(self) -> bool:
+        """回复结束后按分片间隔特征判断是否疑似封号"""
+        return check_ban_delay(self.delays, self.contents)
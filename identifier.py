@@ -1,6 +1,7 @@
 import base64
 import json
 import secrets
+from functools import lru_cache
 
 from Crypto.Cipher import AES
 from Crypto.Hash import SHA256
@@ -27,6 +28,7 @@ jr = {
 Sh = 16
 
 
+@lru_cache(maxsize=4096)
 def Th(n):
     salt = Fl(Hr['r'], Hr['m']).encode('utf-8')
     return PBKDF2(n.encode('utf-8'), salt, 32, count=100000, hmac_hash_module=SHA256)
@@ -47,8 +49,8 @@ def Fl(n, e):
     return bytes(i).decode('utf-8')
 
 
-def kh(n, fixed_iv=None):
-    e = Th(n['userId'])
+def kh(n, fixed_iv=None, key=None):
+    e = key or Th(n['userId'])
     if fixed_iv:
         t = fixed_iv
     else:
@@ -78,9 +80,9 @@ def H7t(t=12):
     return ''.join(f'{b:02x}' for b in random_bytes)
 
 
-def get_identifier(userId, clientUUID, fixed_iv=None):
+def get_identifier(userId, clientUUID, fixed_iv=None, key=None):
     t = kh({
         'userId': userId,
         'clientUUID': clientUUID
-    }, fixed_iv)
+    }, fixed_iv, key)
     return f"{H7t()}:{t}"
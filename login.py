@@ -1,3 +1,5 @@
+import argparse
+import asyncio
 import base64
 import json
 import re
@@ -62,5 +64,39 @@ def main():
     print("----API KEY----")
 
 
+async def bulk_main(links_path: str, proxy: str = None, concurrency: int = None, save: bool = True):
+    """批量登录：links_path 中每行一个登录链接，成功的账号写入 ./config/accounts.json"""
+    from app.http_client import close_sessions
+    from app.login_service import bulk_login
+    from app.proxy_service import load_proxy_pool
+
+    with open(links_path, 'r', encoding='utf-8') as f:
+        login_links = [line.strip() for line in f if line.strip()]
+    # 与服务端一致，未指定代理时从代理池分配
+    load_proxy_pool()
+    try:
+        kwargs = {'concurrency': concurrency} if concurrency else {}
+        results = await bulk_login(login_links, proxy, save=save, **kwargs)
+    finally:
+        await close_sessions()
+
+    for result in results:
+        if result['success']:
+            logger.success(f"#{result['index']} 登录成功 {result['user_info']['user_id']} {result['user_info']['email']}")
+            if not save:
+                print(result['api_key'])
+        else:
+            logger.error(f"#{result['index']} 登录失败 {login_links[result['index']][:48]} {result['error']}")
+
+
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description="获取 Highlight API Key，指定登录链接文件时批量登录")
+    parser.add_argument('links', nargs='?', help="登录链接文件，每行一个 https://highlightai.com/deeplink?code=xxxxxxx")
+    parser.add_argument('--proxy', default=None, help="使用的代理，为空时从代理池分配")
+    parser.add_argument('--concurrency', type=int, default=None, help="同时进行的登录数，默认 LOGIN_CONCURRENCY")
+    parser.add_argument('--no-save', action='store_true', help="不写入 ./config/accounts.json，只输出 API Key")
+    args = parser.parse_args()
+    if args.links:
+        asyncio.run(bulk_main(args.links, args.proxy, args.concurrency, not args.no_save))
+    else:
+        main()
@@ -1,12 +1,41 @@
 """Highlight AI API Proxy - 主应用入口"""
+import asyncio
+from contextlib import asynccontextmanager
 
 from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
 
+from app.account_health import load_account_health
+from app.account_service import probe_accounts_forever
+from app.http_client import close_sessions
+from app.image_service import shutdown_executor
+from app.model_service import load_model_aliases
+from app.lifecycle import warmup, install_drain_handler
+from app.proxy_service import load_proxy_pool, probe_proxies_forever
+from app.routes.admin import router as admin_router
 from app.routes.api import router as api_router
 from app.routes.login import router as login_router
 
-app = FastAPI(title="Highlight AI API Proxy", version="1.0.0")
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    # 预热在后台进行，/health 立即可用，/ready 在预热完成后才返回成功
+    load_proxy_pool()
+    load_account_health()
+    load_model_aliases()
+    warmup_task = asyncio.create_task(warmup())
+    probe_task = asyncio.create_task(probe_proxies_forever())
+    account_probe_task = asyncio.create_task(probe_accounts_forever())
+    install_drain_handler()
+    yield
+    warmup_task.cancel()
+    probe_task.cancel()
+    account_probe_task.cancel()
+    await close_sessions()
+    shutdown_executor()
+
+
+app = FastAPI(title="Highlight AI API Proxy", version="1.0.0", lifespan=lifespan)
 
 # 挂载静态文件
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -14,6 +43,7 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 # 注册路由
 app.include_router(api_router)
 app.include_router(login_router)
+app.include_router(admin_router)
 
 if __name__ == "__main__":
     import uvicorn
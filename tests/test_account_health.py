@@ -0,0 +1,47 @@
+import json
+
+from app import account_health
+from app.account_health import (
+    health_key, is_live, is_blocked, load_account_health, mark_banned, mark_suspected, save_account_health,
+)
+
+
+def use_tmp_health(tmp_path, monkeypatch):
+    path = tmp_path / "account_health.json"
+    monkeypatch.setattr(account_health, "ACCOUNT_HEALTH_PATH", path)
+    monkeypatch.setattr(account_health, "account_health", {})
+    return path
+
+
+def test_saved_file_has_no_refresh_token(tmp_path, monkeypatch):
+    path = use_tmp_health(tmp_path, monkeypatch)
+    mark_banned("secret-refresh-token")
+    assert "secret-refresh-token" not in path.read_text(encoding="utf-8")
+
+    load_account_health()
+    assert is_blocked("secret-refresh-token")
+    assert is_live("another-token")
+
+
+def test_legacy_file_keyed_by_rt_is_migrated(tmp_path, monkeypatch):
+    path = use_tmp_health(tmp_path, monkeypatch)
+    path.write_text(json.dumps([{"rt": "legacy-token", "state": "banned"}]), encoding="utf-8")
+    load_account_health()
+    assert is_blocked("legacy-token")
+
+    save_account_health()
+    saved = json.loads(path.read_text(encoding="utf-8"))
+    assert saved[0]["key"] == health_key("legacy-token")
+    assert "rt" not in saved[0]
+
+
+def test_probing_disabled_keeps_accounts_recoverable(tmp_path, monkeypatch):
+    path = use_tmp_health(tmp_path, monkeypatch)
+    monkeypatch.setattr(account_health, "ACCOUNT_PROBE_INTERVAL", 0)
+    # 疑似封号无法探测确认，不标记
+    mark_suspected("suspected-token")
+    assert is_live("suspected-token")
+    # 封禁只在本次运行内有效，不写入文件
+    mark_banned("banned-token")
+    assert is_blocked("banned-token")
+    assert not path.exists()
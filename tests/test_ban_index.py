@@ -0,0 +1,38 @@
+import subprocess
+import sys
+from pathlib import Path
+
+from app.ban_index import BanTextIndex, minhash, shingles
+
+BAN_TEXT = ("We've temporarily restricted access to your account due to suspicious activity. "
+            "If you think this is a mistake, please reach out to us via support@highlightai.com or Discord.")
+
+
+def signature_in_subprocess(hash_seed: str) -> str:
+    code = f"from app.ban_index import minhash, shingles; print(minhash(shingles({BAN_TEXT!r})))"
+    return subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                          cwd=Path(__file__).resolve().parents[1], env={"PYTHONHASHSEED": hash_seed, "PATH": ""}).stdout
+
+
+def test_minhash_stable_across_processes():
+    # 签名不能受 PYTHONHASHSEED 影响，否则每次启动去重结果都可能不同
+    assert signature_in_subprocess("1") == signature_in_subprocess("2")
+    assert signature_in_subprocess("1").strip() == str(minhash(shingles(BAN_TEXT)))
+
+
+def test_near_duplicate_is_deduplicated():
+    index = BanTextIndex(0.8)
+    assert index.add(BAN_TEXT)
+    assert not index.add(BAN_TEXT.replace("Discord", "discord!"))
+    assert index.add("Access to your account has been paused pending a manual review by our trust team.")
+    assert len(index) == 2
+
+
+def test_matcher_scores_prefix():
+    index = BanTextIndex()
+    index.add(BAN_TEXT)
+    matcher = index.matcher()
+    matcher.feed(BAN_TEXT[:len(BAN_TEXT) // 2])
+    containment, coverage = matcher.best()
+    assert containment == 1.0
+    assert 0.4 < coverage < 0.6
@@ -0,0 +1,58 @@
+import asyncio
+
+import pytest
+
+from app import retry_policy
+from app.auth import Account
+from app.batch_service import BatchRunner
+from app.errors import HighlightError
+from app.retry_policy import retry_budget
+
+
+class FakeRunner(BatchRunner):
+    """按顺序抛出给定的错误，之后返回成功，记录每次使用的账号"""
+
+    def __init__(self, accounts, errors):
+        super().__init__(accounts)
+        self.errors = list(errors)
+        self.calls = []
+
+    async def run_on_account(self, request, account):
+        self.calls.append(account.user_id)
+        if self.errors:
+            raise self.errors.pop(0)
+        return {"ok": True}
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(retry_policy, "backoff_delay", lambda attempt: 0)
+    monkeypatch.setattr(retry_budget, "tokens", retry_budget.capacity)
+
+
+def make_accounts(*names):
+    return [Account(rt=f"batch-test-{name}", user_id=name, client_uuid=name) for name in names]
+
+
+def test_retryable_error_reuses_single_account():
+    runner = FakeRunner(make_accounts("a"), [HighlightError(502, 'bad gateway')])
+    result = asyncio.run(runner.run_item(0, object()))
+    assert result["status"] == 200
+    assert runner.calls == ["a", "a"]
+
+
+def test_failover_without_other_accounts_does_not_spend_budget():
+    runner = FakeRunner(make_accounts("a"), [HighlightError(429, 'rate limited', 429)])
+    before = retry_budget.tokens
+    result = asyncio.run(runner.run_item(0, object()))
+    assert result["status"] == 429
+    assert runner.calls == ["a"]
+    # run_item 开始时存入的令牌之外没有消耗
+    assert retry_budget.tokens >= before
+
+
+def test_failover_moves_to_next_account():
+    runner = FakeRunner(make_accounts("a", "b"), [HighlightError(429, 'rate limited', 429)])
+    result = asyncio.run(runner.run_item(0, object()))
+    assert result["status"] == 200
+    assert runner.calls[1] != runner.calls[0]
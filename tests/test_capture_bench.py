@@ -0,0 +1,26 @@
+import json
+
+from app import account_health
+from app.capture_service import isolated_state
+from app.utils import CheckBanContent
+
+
+def test_isolated_state_keeps_config_untouched(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    config = tmp_path / "config"
+    config.mkdir()
+    (config / "ban_contents.json").write_text(json.dumps(["Your account has been restricted."]), encoding="utf-8")
+    CheckBanContent._initialized = False
+
+    with isolated_state():
+        # 回放中用的是现有文案的副本
+        assert CheckBanContent.get_instance().index.texts == ["Your account has been restricted."]
+        account_health.mark_banned("replay")
+        CheckBanContent.get_instance().add_ban_content("A brand new restriction notice for this account.")
+        assert not account_health.is_live("replay")
+
+    assert account_health.is_live("replay")
+    assert not (config / "account_health.json").exists()
+    assert json.loads((config / "ban_contents.json").read_text(encoding="utf-8")) == ["Your account has been restricted."]
+    assert CheckBanContent.get_instance().index.texts == ["Your account has been restricted."]
+    CheckBanContent._initialized = False
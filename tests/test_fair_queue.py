@@ -0,0 +1,63 @@
+from app.limiter import FairQueue, INTERACTIVE, BATCH, _waiting
+
+
+def drain(queue: FairQueue, count: int):
+    return [queue.pop() for _ in range(count)]
+
+
+def test_weighted_order_between_priorities():
+    # 默认权重 interactive:4,batch:1，两个优先级都有积压时按 4:1 放行
+    queue = FairQueue()
+    for i in range(20):
+        queue.push(INTERACTIVE, 'user', object())
+        queue.push(BATCH, 'user', object())
+    priorities = [priority for _, priority, _ in drain(queue, 20)]
+    assert priorities.count(INTERACTIVE) == 16
+    assert priorities.count(BATCH) == 4
+    # 任意连续 5 次放行中 batch 至少有 1 次，不会被饿死
+    for i in range(len(priorities) - 4):
+        assert BATCH in priorities[i:i + 5]
+
+
+def test_round_robin_between_flows():
+    queue = FairQueue()
+    waiters = {}
+    for flow, count in (('a', 3), ('b', 1), ('c', 2)):
+        waiters[flow] = [object() for _ in range(count)]
+        for waiter in waiters[flow]:
+            queue.push(INTERACTIVE, flow, waiter)
+    order = [waiter for waiter, _, _ in drain(queue, 6)]
+    assert order == [waiters['a'][0], waiters['b'][0], waiters['c'][0],
+                     waiters['a'][1], waiters['c'][1], waiters['a'][2]]
+    assert queue.pop() is None
+
+
+def test_fifo_within_flow():
+    queue = FairQueue()
+    waiters = [object() for _ in range(3)]
+    for waiter in waiters:
+        queue.push(BATCH, 'user', waiter)
+    assert [waiter for waiter, _, _ in drain(queue, 3)] == waiters
+
+
+def test_remove_and_waiting_count():
+    before = _waiting.get(INTERACTIVE, 0)
+    queue = FairQueue()
+    first, second, third = object(), object(), object()
+    queue.push(INTERACTIVE, 'a', first)
+    queue.push(INTERACTIVE, 'a', second)
+    queue.push(INTERACTIVE, 'b', third)
+    assert len(queue) == 3
+    assert _waiting[INTERACTIVE] == before + 3
+
+    queue.remove(INTERACTIVE, 'a', second)
+    queue.remove(INTERACTIVE, 'b', third)
+    # 不在队列中的等待者忽略
+    queue.remove(INTERACTIVE, 'b', third)
+    assert len(queue) == 1
+    assert _waiting[INTERACTIVE] == before + 1
+    assert 'b' not in queue.queues[INTERACTIVE]
+
+    assert queue.pop()[0] is first
+    assert queue.pop() is None
+    assert _waiting[INTERACTIVE] == before
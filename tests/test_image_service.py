@@ -0,0 +1,74 @@
+from io import BytesIO
+
+import pytest
+
+Image = pytest.importorskip("PIL.Image")
+from PIL import PngImagePlugin
+
+from app.image_service import normalize_image
+
+
+def make_jpeg(size, orientation=None) -> bytes:
+    exif = Image.Exif()
+    exif[0x010F] = "camera"  # Make
+    if orientation:
+        exif[0x0112] = orientation
+    output = BytesIO()
+    Image.new("RGB", size, (200, 30, 30)).save(output, format="JPEG", exif=exif.tobytes(), comment=b"secret")
+    return output.getvalue()
+
+
+def test_small_jpeg_is_stripped_without_resize():
+    data = normalize_image(make_jpeg((40, 20)), 2048, 1 << 20, "jpeg", 85)
+    with Image.open(BytesIO(data)) as img:
+        assert img.format == "JPEG"
+        assert img.size == (40, 20)
+        assert not img.getexif()
+        assert "comment" not in img.info
+
+
+def test_orientation_is_applied_before_stripping():
+    # 6 表示需要顺时针旋转 90 度
+    data = normalize_image(make_jpeg((40, 20), orientation=6), 2048, 1 << 20, "jpeg", 85)
+    with Image.open(BytesIO(data)) as img:
+        assert img.size == (20, 40)
+        assert not img.getexif()
+
+
+def test_large_image_is_resized():
+    data = normalize_image(make_jpeg((400, 100)), 100, 1 << 20, "jpeg", 85)
+    with Image.open(BytesIO(data)) as img:
+        assert img.size == (100, 25)
+        assert not img.getexif()
+
+
+def test_png_text_chunks_are_removed():
+    info = PngImagePlugin.PngInfo()
+    info.add_text("Comment", "secret")
+    output = BytesIO()
+    Image.new("RGBA", (10, 10)).save(output, format="PNG", pnginfo=info)
+    data = normalize_image(output.getvalue(), 2048, 1 << 20, "jpeg", 85)
+    with Image.open(BytesIO(data)) as img:
+        assert img.format == "PNG"
+        assert "Comment" not in img.info
+
+
+def test_strip_only_keeps_size_and_removes_exif():
+    data = normalize_image(make_jpeg((400, 100)), None, None, "jpeg", 85)
+    with Image.open(BytesIO(data)) as img:
+        assert img.size == (400, 100)
+        assert not img.getexif()
+
+
+def test_animated_image_is_resized_frame_by_frame():
+    frames = [Image.new("RGB", (200, 100), color) for color in ((255, 0, 0), (0, 0, 255))]
+    output = BytesIO()
+    frames[0].save(output, format="GIF", save_all=True, append_images=frames[1:], duration=[120, 80], loop=0,
+                   comment=b"secret")
+    data = normalize_image(output.getvalue(), 50, 1 << 20, "jpeg", 85)
+    with Image.open(BytesIO(data)) as img:
+        assert img.format == "GIF"
+        assert img.size == (50, 25)
+        assert img.n_frames == 2
+        assert img.info.get("loop") == 0
+        assert "comment" not in img.info
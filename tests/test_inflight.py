@@ -0,0 +1,27 @@
+from app.lifecycle import app_state, inflight_scope, take_inflight
+
+
+def test_scope_releases_when_not_taken():
+    start = app_state["inflight"]
+    with inflight_scope():
+        assert app_state["inflight"] == start + 1
+    assert app_state["inflight"] == start
+
+
+def test_taken_count_outlives_scope():
+    start = app_state["inflight"]
+    with inflight_scope():
+        guard = take_inflight()
+    # 处理函数返回后仍计入，直到流结束
+    assert app_state["inflight"] == start + 1
+    guard.release()
+    guard.release()
+    assert app_state["inflight"] == start
+
+
+def test_take_outside_scope_creates_guard():
+    start = app_state["inflight"]
+    guard = take_inflight()
+    assert app_state["inflight"] == start + 1
+    guard.release()
+    assert app_state["inflight"] == start
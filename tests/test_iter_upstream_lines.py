@@ -0,0 +1,60 @@
+import asyncio
+import time
+
+import pytest
+
+from app.chat_service import iter_upstream_lines
+from app.deadline import deadline_scope
+from app.errors import HighlightError
+
+
+class FakeResponse:
+    """按给定间隔逐行返回的上游响应"""
+
+    def __init__(self, lines, interval=0.0):
+        self.lines = lines
+        self.interval = interval
+
+    async def aiter_lines(self):
+        for line in self.lines:
+            await asyncio.sleep(self.interval)
+            yield line
+
+
+async def collect(response, flush_deadline=None):
+    return [line async for line in iter_upstream_lines(response, flush_deadline)]
+
+
+def flush_after(seconds):
+    start = time.monotonic()
+    return lambda: start + seconds
+
+
+def test_plain_lines():
+    assert asyncio.run(collect(FakeResponse([b"a", b"b"]))) == [b"a", b"b"]
+
+
+def test_coalescing_without_deadline():
+    # 合并输出但请求没有截止时间时，刷新计时到点只产出 None，不能中止
+    lines = asyncio.run(collect(FakeResponse([b"a", b"b"], interval=0.05), flush_after(0.01)))
+    assert [line for line in lines if line is not None] == [b"a", b"b"]
+    assert None in lines
+
+
+def test_coalescing_with_deadline():
+    async def run():
+        with deadline_scope(0.1):
+            return await collect(FakeResponse([b"a"] * 10, interval=0.05), flush_after(0.01))
+
+    with pytest.raises(HighlightError) as e:
+        asyncio.run(run())
+    assert e.value.response_status_code == 504
+
+
+def test_deadline_without_coalescing():
+    async def run():
+        with deadline_scope(0.05):
+            return await collect(FakeResponse([b"a", b"b"], interval=0.2))
+
+    with pytest.raises(HighlightError):
+        asyncio.run(run())
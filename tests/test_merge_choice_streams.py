@@ -0,0 +1,37 @@
+import asyncio
+import json
+
+from app.chat_service import UsageChunk, merge_choice_streams
+from app.usage_service import build_usage
+
+
+def choice_stream(index: int, completion_tokens: int):
+    async def stream():
+        yield {"data": json.dumps({"choices": [{"index": index, "delta": {"content": "hi"}}]})}
+        # 文本中即使出现 "choices": [] 也不能被当成用量分片
+        yield {"data": json.dumps({"choices": [{"index": index, "delta": {"content": '"choices": []'}}]})}
+        yield UsageChunk(json.dumps({"choices": [], "usage": {}}), build_usage(10, completion_tokens))
+        yield {"data": "[DONE]"}
+
+    return stream()
+
+
+async def collect(include_usage: bool):
+    streams = [choice_stream(0, 3), choice_stream(1, 5)]
+    return [item["data"] async for item in merge_choice_streams(lambda: streams, "id", 0, "m", include_usage)]
+
+
+def test_usage_chunks_are_merged():
+    items = asyncio.run(collect(True))
+    assert items[-1] == "[DONE]"
+    usage = json.loads(items[-2])["usage"]
+    assert usage["prompt_tokens"] == 10
+    assert usage["completion_tokens"] == 8
+    assert len(items) == 6
+
+
+def test_usage_omitted_without_include_usage():
+    items = asyncio.run(collect(False))
+    assert items[-1] == "[DONE]"
+    assert all('"usage"' not in item for item in items)
+    assert len(items) == 5
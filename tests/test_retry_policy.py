@@ -0,0 +1,34 @@
+import time
+
+import pytest
+from curl_cffi.requests.exceptions import RequestException
+from fastapi import HTTPException
+
+from app.deadline import deadline_scope
+from app.errors import HighlightError
+from app.retry_policy import classify_error, RETRY, FAILOVER, FATAL
+
+
+@pytest.mark.parametrize("error, expected", [
+    (RequestException("connection reset"), RETRY),
+    (HighlightError(200, 'HighlightAI account suspended', 403), FAILOVER),
+    (HighlightError(401, 'unauthorized'), FAILOVER),
+    (HighlightError(403, 'cloudflare'), FAILOVER),
+    (HighlightError(429, 'rate limited'), FAILOVER),
+    (HighlightError(400, 'bad request'), FATAL),
+    (HighlightError(404, 'model not found'), FATAL),
+    (HighlightError(500, 'internal error'), RETRY),
+    (HighlightError(502, 'bad gateway'), RETRY),
+    (HTTPException(status_code=500, detail='token refresh failed'), FAILOVER),
+    (HTTPException(status_code=400, detail='invalid request'), FATAL),
+    (ValueError('unexpected'), FATAL),
+])
+def test_classify_error(error, expected):
+    assert classify_error(error) == expected
+
+
+def test_deadline_exceeded_is_fatal():
+    with deadline_scope(0.001):
+        time.sleep(0.01)
+        assert classify_error(RequestException("timeout")) == FATAL
+        assert classify_error(HighlightError(502, 'bad gateway')) == FATAL
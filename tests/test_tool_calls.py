@@ -0,0 +1,69 @@
+import json
+
+import pytest
+
+from app.errors import HighlightError
+from app.retry_policy import classify_error, FATAL
+from app.tool_calls import ToolCallAccumulator, could_be_json_prefix, CUMULATIVE, DELTA
+
+TOOLS = [{"name": "search", "parameters": {"type": "object", "properties": {"q": {"type": "string"}},
+                                           "required": ["q"]}}]
+
+
+def feed(accumulator, *inputs, tool_id="call_1", name="search"):
+    return [accumulator.add(tool_id, name, tool_input)[2] for tool_input in inputs]
+
+
+def test_delta_fragments():
+    accumulator = ToolCallAccumulator(TOOLS)
+    assert feed(accumulator, '{"q": ', '"cats"', '}') == ['{"q": ', '"cats"', '}']
+    assert accumulator.mode == DELTA
+    accumulator.finish()
+    assert json.loads(accumulator.calls["call_1"]["arguments"]) == {"q": "cats"}
+
+
+def test_cumulative_fragments():
+    accumulator = ToolCallAccumulator(TOOLS)
+    assert feed(accumulator, '{"q": ', '{"q": "ca', '{"q": "cats"}') == ['{"q": ', '"ca', 'ts"}']
+    assert accumulator.mode == CUMULATIVE
+    accumulator.finish()
+    assert accumulator.calls["call_1"]["arguments"] == '{"q": "cats"}'
+
+
+def test_delta_that_starts_with_the_buffer():
+    # 第二个增量恰好以已有参数开头，按完整参数解释得到的 '{"a": [{"a": [1]}]}' 多出括号，只能是增量
+    accumulator = ToolCallAccumulator([])
+    assert feed(accumulator, '{"a": [', '{"a": [1]}]}', name="nested") == ['{"a": [', '{"a": [1]}]}']
+    assert accumulator.mode == DELTA
+    accumulator.finish()
+    assert json.loads(accumulator.calls["call_1"]["arguments"]) == {"a": [{"a": [1]}]}
+
+
+def test_delta_mode_is_kept_once_known():
+    accumulator = ToolCallAccumulator([])
+    feed(accumulator, '{"s": ', '"x"}', name="first")
+    assert accumulator.mode == DELTA
+    # 两种解释都可能构成合法 JSON 时，沿用已确定的格式按增量处理
+    feed(accumulator, '{"s": [', '{"s": [1', tool_id="call_2", name="second")
+    assert accumulator.calls["call_2"]["arguments"] == '{"s": [{"s": [1'
+
+
+def test_malformed_arguments_are_not_retried():
+    accumulator = ToolCallAccumulator(TOOLS)
+    feed(accumulator, '{"q": 1}')
+    with pytest.raises(HighlightError) as excinfo:
+        accumulator.finish()
+    assert excinfo.value.response_status_code == 422
+    assert classify_error(excinfo.value) == FATAL
+
+
+@pytest.mark.parametrize("text, expected", [
+    ('{"a": [', True),
+    ('{"a": "x}]"', True),
+    ('{"a": 1, "b": tr', True),
+    ('{"a": [1]}]}', False),
+    ('{"a": 1{"a"', False),
+    ('{"a": 1} {', False),
+])
+def test_could_be_json_prefix(text, expected):
+    assert could_be_json_prefix(text) is expected